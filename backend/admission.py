@@ -0,0 +1,180 @@
+"""
+Admission control and deadline-based load shedding for the gRPC handlers.
+
+Every handler belongs to a lane, recognition or enrollment. A lane can have a limit on the calls it runs
+at once (off by default). A call over its lane's limit is rejected right away with RESOURCE_EXHAUSTED
+instead of taking a thread and waiting, and the limits leave threads to the other lane, so a boarding
+surge can't starve enrollment and a bulk enrollment can't starve the kiosks. Streams don't hold a slot
+while they are open, every message takes one while it is processed (message_slot).
+
+The gRPC deadline of a call is checked when it starts and again before detection and the database
+work (check_deadline). A call whose client has already given up is dropped with DEADLINE_EXCEEDED
+instead of being processed for nobody.
+"""
+import contextlib
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+
+import grpc
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+DEADLINE_MARGIN_MS = float(os.getenv("DEADLINE_MARGIN_MS", 0))  # also drop calls with less time than this left
+
+# time.monotonic() deadline of the current call, None without a deadline
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExpired(BaseException):
+    """
+    Raised by check_deadline. Not an Exception, so the handlers' catch-all error handling doesn't turn
+    it into INTERNAL, lane() answers it with DEADLINE_EXCEEDED.
+    """
+
+
+class LaneFull(Exception):
+    """Raised by message_slot when the lane is at its limit"""
+
+
+class Lane:
+    def __init__(self, name, limit=0):
+        self.name = name
+        self.limit = limit  # calls at once, 0: no limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        with self._lock:
+            if self.limit > 0 and self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+
+LANES = {"recognition": Lane("recognition"), "enrollment": Lane("enrollment")}
+
+
+def configure(**limits):
+    """Sets the lane limits, e.g. configure(recognition=9, enrollment=2)"""
+    for name, limit in limits.items():
+        LANES[name].limit = limit
+
+
+def check_deadline(stage):
+    """Drops the current call if its deadline has passed, stage names the work it would have done next"""
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() > deadline - DEADLINE_MARGIN_MS / 1000.0:
+        raise DeadlineExpired(stage)
+
+
+@contextlib.contextmanager
+def message_slot(name):
+    """Holds a slot of the lane while one message of a stream is processed, raises LaneFull without one"""
+    target = LANES[name]
+    if not target.try_enter():
+        metrics.shed(name, "overload")
+        raise LaneFull(name)
+    try:
+        yield
+    finally:
+        target.leave()
+
+
+def _admit(lane, context, hold=True):
+    """
+    Returns (deadline token, None) for an admitted call, (None, (code, details)) for a rejected one.
+    hold=False only checks the deadline, streams take a slot per message.
+    """
+    remaining = context.time_remaining()
+    if remaining is not None and remaining <= DEADLINE_MARGIN_MS / 1000.0:
+        metrics.shed(lane.name, "deadline")
+        return None, (grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline expired before the call started.")
+    if hold and not lane.try_enter():
+        metrics.shed(lane.name, "overload")
+        return None, (grpc.StatusCode.RESOURCE_EXHAUSTED, f"Server busy ({lane.name}), try again later.")
+    return _deadline.set(time.monotonic() + remaining if remaining is not None else None), None
+
+
+def _expired(lane, error):
+    metrics.shed(lane.name, "deadline")
+    return grpc.StatusCode.DEADLINE_EXCEEDED, f"Deadline expired before {error.args[0]}."
+
+
+def _leave(lane, token, hold=True):
+    # Sync handlers share pool threads, the next call on this thread must not see this deadline
+    _deadline.reset(token)
+    if hold:
+        lane.leave()
+
+
+def lane(name):
+    """
+    Decorator for the servicer methods: admits the call to the lane, drops it when its deadline passes.
+    Streaming handlers (generators) only get the deadline, they take a message_slot per message.
+    """
+    target = LANES[name]
+
+    def decorator(handler):
+        if inspect.isasyncgenfunction(handler):
+            @functools.wraps(handler)
+            async def wrapper(self, request, context):
+                token, rejection = _admit(target, context, hold=False)
+                if rejection:
+                    await context.abort(*rejection)
+                try:
+                    async for response in handler(self, request, context):
+                        yield response
+                except DeadlineExpired as e:
+                    await context.abort(*_expired(target, e))
+                finally:
+                    _leave(target, token, hold=False)
+        elif inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def wrapper(self, request, context):
+                token, rejection = _admit(target, context)
+                if rejection:
+                    await context.abort(*rejection)
+                try:
+                    return await handler(self, request, context)
+                except DeadlineExpired as e:
+                    await context.abort(*_expired(target, e))
+                finally:
+                    _leave(target, token)
+        elif inspect.isgeneratorfunction(handler):
+            @functools.wraps(handler)
+            def wrapper(self, request, context):
+                token, rejection = _admit(target, context, hold=False)
+                if rejection:
+                    context.abort(*rejection)
+                    return  # abort() raises in the sync server, in the aio server's thread pool it doesn't
+                try:
+                    yield from handler(self, request, context)
+                except DeadlineExpired as e:
+                    context.abort(*_expired(target, e))
+                finally:
+                    _leave(target, token, hold=False)
+        else:
+            @functools.wraps(handler)
+            def wrapper(self, request, context):
+                token, rejection = _admit(target, context)
+                if rejection:
+                    context.abort(*rejection)
+                    return None
+                try:
+                    return handler(self, request, context)
+                except DeadlineExpired as e:
+                    context.abort(*_expired(target, e))
+                finally:
+                    _leave(target, token)
+        return wrapper
+    return decorator
@@ -0,0 +1,241 @@
+"""
+Bulk enrollment of a passenger manifest.
+
+    python bulk_enroll.py manifest.csv --images photos/ --workers 8
+
+The manifest has the columns name, surname, age, nationality, flight_no, passport_no and optionally
+images: image paths relative to --images, separated by ";". Without an images column every image in
+<images>/<passport_no>/ (or the single file <images>/<passport_no>.jpg/.jpeg/.png) is used.
+
+Images are decoded and embedded in worker processes, each with its own EmbeddingModel. People are
+inserted in batches through db_bulk_insert_people (COPY into staging tables, one INSERT ... SELECT).
+Every committed batch is appended to a checkpoint file, so an interrupted run resumes where it
+stopped. Rows that fail, and images that were skipped, are written to an error log CSV.
+"""
+import argparse
+import csv
+import glob
+import multiprocessing as mp
+import os
+import time
+from concurrent import futures
+
+import cv2
+
+from db import db_bulk_insert_people, PERSON_COLUMNS
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+_model = None
+
+
+def store_batch(rows):
+    """
+    Inserts a batch of people with one db_bulk_insert_people call. rows is a list of
+    (key, info, embeddings), key identifies the row for the caller (manifest row, stream index).
+    Returns (enrolled, skipped, errors), errors is a list of (key, passport_no, message).
+    """
+    errors, skipped = [], 0
+    people, seen = [], set()
+    for key, info, embeddings in rows:
+        passport_no = info["passport_no"]
+        if not embeddings:
+            errors.append((key, passport_no, "No face detected in any image."))
+        elif passport_no in seen:
+            errors.append((key, passport_no, "Duplicate passport_no in the same batch."))
+        else:
+            seen.add(passport_no)
+            people.append((info, embeddings))
+
+    if people:
+        inserted = db_bulk_insert_people(people)
+        skipped = len(people) - len(inserted)
+    return len(people) - skipped, skipped, errors
+
+
+def _init_worker(intra_op_threads):
+    global _model
+    # Imported here so that only the worker processes load the models
+    from embedding_model import EmbeddingModel
+    _model = EmbeddingModel(intra_op_threads=intra_op_threads)
+
+
+def _embed_row(row_number, paths):
+    """Worker process: decodes and embeds the images of one manifest row"""
+    images, errors = [], []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            errors.append(f"{path}: could not read image")
+        else:
+            images.append((path, image))
+
+    embeddings = []
+    if images:
+        try:
+            results = _model.get_embeddings([image for _, image in images])
+        except Exception as e:
+            # E.g. an image that decodes to something the models can't take, the row fails, not the run
+            errors.append(f"embedding failed: {str(e)}")
+            return row_number, [], errors
+        for (path, _), embedding in zip(images, results):
+            if embedding is None:
+                errors.append(f"{path}: no face detected")
+            else:
+                embeddings.append(embedding)
+    return row_number, embeddings, errors
+
+
+def _image_paths(row, image_dir):
+    if row.get("images"):
+        return [os.path.join(image_dir, path.strip()) for path in row["images"].split(";") if path.strip()]
+
+    passport_no = row["passport_no"]
+    paths = sorted(glob.glob(os.path.join(glob.escape(image_dir), glob.escape(passport_no), "*")))
+    paths += [os.path.join(image_dir, passport_no + ext) for ext in IMAGE_EXTENSIONS]
+    return [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path)]
+
+
+def _person_info(row):
+    info = {column: (row.get(column) or "").strip() for column in PERSON_COLUMNS}
+    info["age"] = int(info["age"])
+    info["flight_no"] = info["flight_no"] or None
+    if not all(info[column] for column in ("name", "surname", "nationality", "passport_no")):
+        raise ValueError("name, surname, nationality and passport_no are required")
+    return info
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def _append_checkpoint(checkpoint, row_numbers):
+    for row_number in row_numbers:
+        checkpoint.write(f"{row_number}\n")
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+
+def enroll_manifest(manifest, image_dir, workers, intra_op_threads=1, batch_size=500, checkpoint_path=None,
+                    errors_path=None):
+    checkpoint_path = checkpoint_path or manifest + ".checkpoint"
+    errors_path = errors_path or manifest + ".errors.csv"
+    done = _read_checkpoint(checkpoint_path)
+
+    with open(manifest, newline="", encoding="utf-8") as f:
+        rows = [(row_number, row) for row_number, row in enumerate(csv.DictReader(f), 1) if row_number not in done]
+    print(f"Bulk enroll: {len(rows)} rows to process, {len(done)} already done according to {checkpoint_path}.")
+
+    new_errors_file = not os.path.exists(errors_path)
+    totals = {"enrolled": 0, "skipped": 0, "failed": 0}
+    started = time.perf_counter()
+
+    with open(checkpoint_path, "a") as checkpoint, open(errors_path, "a", newline="", encoding="utf-8") as errors_file:
+        error_log = csv.writer(errors_file)
+        if new_errors_file:
+            error_log.writerow(["row", "passport_no", "error"])
+
+        def log_error(row_number, passport_no, message):
+            error_log.writerow([row_number, passport_no, message])
+
+        def flush(batch, processed):
+            enrolled, skipped, errors = store_batch(batch)
+            for row_number, passport_no, message in errors:
+                log_error(row_number, passport_no, message)
+            errors_file.flush()
+            # Only committed rows are checkpointed, a crash before this line redoes the batch, and
+            # people it already inserted are then skipped by the passport_no conflict check
+            _append_checkpoint(checkpoint, processed)
+            totals["enrolled"] += enrolled
+            totals["skipped"] += skipped
+            totals["failed"] += len(errors)
+            elapsed = time.perf_counter() - started
+            print(f"Bulk enroll: {totals['enrolled']} enrolled, {totals['skipped']} already enrolled, "
+                  f"{totals['failed']} failed ({totals['enrolled'] / elapsed * 3600:.0f} enrollments/hour).")
+
+        # spawn: the workers must not inherit the database connections of this process
+        ctx = mp.get_context("spawn")
+        with futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                         initargs=(intra_op_threads,)) as pool:
+            infos, pending, submitted = {}, set(), {}
+            batch, processed = [], []
+            row_iter = iter(rows)
+            max_pending = workers * 4  # keeps memory bounded while the workers stay busy
+
+            while True:
+                for row_number, row in row_iter:
+                    try:
+                        infos[row_number] = _person_info(row)
+                        paths = _image_paths(row, image_dir)
+                        if not paths:
+                            raise ValueError("no images found")
+                    except Exception as e:
+                        log_error(row_number, row.get("passport_no", ""), f"Invalid row: {str(e)}")
+                        totals["failed"] += 1
+                        infos.pop(row_number, None)
+                        processed.append(row_number)
+                        continue
+                    future = pool.submit(_embed_row, row_number, paths)
+                    submitted[future] = row_number
+                    pending.add(future)
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                completed, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in completed:
+                    row_number = submitted.pop(future)
+                    info = infos.pop(row_number)
+                    try:
+                        _, embeddings, image_errors = future.result()
+                    except Exception as e:
+                        # Logged and checkpointed like any failed row, so a resume doesn't hit it again
+                        log_error(row_number, info["passport_no"], f"Embedding failed: {str(e)}")
+                        totals["failed"] += 1
+                        processed.append(row_number)
+                        continue
+                    for message in image_errors:
+                        log_error(row_number, info["passport_no"], f"Image skipped: {message}")
+                    batch.append((row_number, info, embeddings))
+                    processed.append(row_number)
+
+                if len(batch) >= batch_size:
+                    flush(batch, processed)
+                    batch, processed = [], []
+
+            if batch or processed:
+                flush(batch, processed)
+
+    print(f"Bulk enroll finished: {totals['enrolled']} enrolled, {totals['skipped']} already enrolled, "
+          f"{totals['failed']} failed. Errors: {errors_path}")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll the passengers of a manifest CSV in bulk.")
+    parser.add_argument("manifest", help="CSV with name, surname, age, nationality, flight_no, passport_no[, images]")
+    parser.add_argument("--images", help="image directory (default: the manifest's directory)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="embedding processes")
+    parser.add_argument("--intra-op-threads", type=int, default=1, help="ONNX Runtime threads per process")
+    parser.add_argument("--batch-size", type=int, default=500, help="people per database transaction")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <manifest>.checkpoint)")
+    parser.add_argument("--errors", help="error log CSV (default: <manifest>.errors.csv)")
+    args = parser.parse_args()
+
+    enroll_manifest(
+        args.manifest,
+        args.images or os.path.dirname(os.path.abspath(args.manifest)),
+        args.workers,
+        intra_op_threads=args.intra_op_threads,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        errors_path=args.errors,
+    )
+
+
+if __name__ == "__main__":
+    main()
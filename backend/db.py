@@ -1,7 +1,21 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+import csv
+import io
+import logging
 import os
+import random
+import threading
+import time
+from concurrent import futures
+import numpy as np
 from dotenv import load_dotenv
 
+from gallery import Gallery, GOOD_MATCH_THRESHOLD, parse_vector
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
@@ -15,68 +29,430 @@ DB_URL = (
     f"@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
 
+# "window": one SQL query over every embedding (default), "ann": vector index candidates reranked in
+# Python, "memory": in-process NumPy gallery, "prototype": per-person centroids pick the candidate
+# people, then only their embeddings are compared
+SEARCH_MODE = os.getenv("SEARCH_MODE", "window")
+ANN_CANDIDATES = int(os.getenv("ANN_CANDIDATES", 100))  # embeddings fetched through the index per search
+ANN_PROBES = int(os.getenv("ANN_PROBES", 10))  # ivfflat lists to visit, more is slower but more accurate
+# Vector index on face_embeddings (see db/init.sql): "ivfflat" (default) or "hnsw". The hnsw.* settings
+# only exist from pgvector 0.5, so they are only set for an HNSW index
+ANN_INDEX = os.getenv("ANN_INDEX", "ivfflat")
+# ann mode: walk the index on half precision copies of the vectors (see the halfvec index in init.sql),
+# the candidates are still scored with the full precision distance
+ANN_HALFVEC = os.getenv("ANN_HALFVEC", "0") == "1"
+
+# memory mode: "int8" keeps the gallery as int8 codes, the GALLERY_RERANK_CANDIDATES best rows of each
+# search are rescored with their float vectors, from a memory-mapped file in GALLERY_EXACT_DIR or, if
+# that is empty, from face_embeddings (one extra query per search)
+GALLERY_QUANTIZATION = os.getenv("GALLERY_QUANTIZATION", "none")
+GALLERY_RERANK_CANDIDATES = int(os.getenv("GALLERY_RERANK_CANDIDATES", 200))
+GALLERY_EXACT_DIR = os.getenv("GALLERY_EXACT_DIR", "") or None
+# Share of approximate searches (ann, prototype, int8 gallery) repeated with the exact window query in
+# the background to measure recall, 0 turns it off
+SEARCH_RECALL_SAMPLE_RATE = float(os.getenv("SEARCH_RECALL_SAMPLE_RATE", 0))
+
+PROTOTYPE_CANDIDATES = int(os.getenv("PROTOTYPE_CANDIDATES", 10))  # prototype mode: people reranked per search
+CHECKPOINT_CACHE_TTL = float(os.getenv("CHECKPOINT_CACHE_TTL", 60))  # seconds a checkpoint's flight list is reused
+
+PERSON_COLUMNS = ("name", "surname", "age", "nationality", "flight_no", "passport_no")
+
 engine = create_engine(DB_URL)
+tracing.instrument_engine(engine)  # a span per SQL statement of traced calls
+
+
+@event.listens_for(engine, "connect")
+def _set_index_search_params(dbapi_connection, connection_record):
+    # Set once per pooled connection so the search itself stays a single round trip.
+    # hnsw.ef_search caps the rows an HNSW scan returns, so it must cover ANN_CANDIDATES.
+    if SEARCH_MODE not in ("ann", "prototype"):
+        return
+    with dbapi_connection.cursor() as cur:
+        cur.execute("SET ivfflat.probes = %s", (ANN_PROBES,))
+        if ANN_INDEX == "hnsw" or ANN_HALFVEC:  # the half precision index is always HNSW
+            cur.execute("SET hnsw.ef_search = %s", (max(40, ANN_CANDIDATES),))
+    dbapi_connection.commit()
+
+# Callbacks called with a person id whenever that person's embeddings change or the person is deleted
+_person_change_listeners = []
+
+
+def add_person_change_listener(callback):
+    _person_change_listeners.append(callback)
+
+
+def _notify_person_changed(person_id):
+    for callback in _person_change_listeners:
+        callback(person_id)
+
+
+# In-memory copy of face_embeddings, only used when SEARCH_MODE=memory
+gallery = Gallery(quantization=GALLERY_QUANTIZATION, rerank_candidates=GALLERY_RERANK_CANDIDATES,
+                  exact_dir=GALLERY_EXACT_DIR) if SEARCH_MODE == "memory" else None
+if gallery is not None:
+    gallery.on_change = _notify_person_changed  # changes made by other writers
+
+
+def _fetch_embeddings(embedding_ids):
+    """Float vectors of the given face_embeddings rows, for the exact rerank of the int8 gallery"""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT id, embedding FROM face_embeddings WHERE id = ANY(:ids)"),
+            dict(ids=embedding_ids)
+        ).fetchall()
+    return {row[0]: parse_vector(row[1]) for row in rows}
+
+
+if gallery is not None and GALLERY_QUANTIZATION == "int8":
+    gallery.fetch_embeddings = _fetch_embeddings
+
+
+def load_gallery():
+    """
+    Loads the in-memory gallery and starts following database changes (memory mode), or brings the
+    person prototypes up to date (prototype mode). No-op in other modes.
+    """
+    if gallery is not None:
+        gallery.start_listener(engine)
+    if SEARCH_MODE == "prototype":
+        db_sync_prototypes()
+
+
+def _build_match(person_id, person, similarity, good_match_count):
+    """Applies the confidence boost and returns the match dict used by the server"""
+    confidence_boost = min(0.1, (good_match_count * 0.02))  # Max 0.1 boost, can be adjusted
+    adjusted_similarity = min(1.0, similarity + confidence_boost)
+    logger.debug("Good match count: %d, confidence boost: %s, original similarity: %s, adjusted similarity: %s",
+                 good_match_count, confidence_boost, similarity, adjusted_similarity)
+
+    return {
+        "person_id": person_id,
+        "name": person["name"],
+        "surname": person["surname"],
+        "age": person["age"],
+        "nationality": person["nationality"],
+        "flight_no": person["flight_no"],
+        "passport_no": person["passport_no"],
+        "similarity": adjusted_similarity
+    }
 
 
 # Functions for database operations
 
-def find_most_similar_face(embedding, top_k=3):
+def find_most_similar_face(embedding, top_k=3, flights=None):
+    """flights: only search the passengers of these flights (see resolve_search_scope), None searches everyone"""
+    return find_most_similar_faces([embedding], top_k, flights)[0]
+
+
+def find_most_similar_faces(embeddings, top_k=3, flights=None):
+    """find_most_similar_face for a batch of embeddings, searched together. Returns one result per embedding"""
+    if not embeddings:
+        return []
+    with metrics.stage("search"):
+        return _search(embeddings, top_k, flights)
+
+
+def _search(embeddings, top_k, flights):
+    if flights is not None and not flights:
+        return [None] * len(embeddings)  # scoped to a checkpoint without flights
+    if gallery is not None:
+        results = [_gallery_match(*found) for found in gallery.search_many(embeddings, top_k, flights)]
+        if GALLERY_QUANTIZATION == "int8":
+            _sample_recall(embeddings, results, flights)
+        return results
+    if flights is not None:
+        # A filtered exact search, not a partitioned one: the people(flight_no) index finds the scope's
+        # passengers and the window query scores only their embeddings. A scope holds a few hundred
+        # people at most, so this is cheaper and more accurate than any of the shortcuts below
+        with engine.connect() as conn:
+            return _find_many_with_window_query(embeddings, top_k, conn, flights)
+    if SEARCH_MODE == "ann":
+        results = _find_many_with_ann_query(embeddings)
+    elif SEARCH_MODE == "prototype":
+        with engine.connect() as conn:
+            results = _find_many_with_prototype_query(embeddings, conn)
+    else:
+        with engine.connect() as conn:
+            return _find_many_with_window_query(embeddings, top_k, conn)
+    _sample_recall(embeddings, results)
+    return results
+
+
+# Recall of the approximate searches against the exact window query, see SEARCH_RECALL_SAMPLE_RATE
+recall_stats = {"checked": 0, "mismatched": 0, "skipped": 0}
+_recall_lock = threading.Lock()
+_recall_executor = futures.ThreadPoolExecutor(max_workers=1)  # one check at a time, never slows searches
+# The executor's queue has no bound: a sample taken while a check is still pending is skipped instead of
+# queued, so under load the checks fall behind by at most one and hold no embeddings meanwhile
+_recall_pending = threading.Semaphore(1)
+
+
+def _sample_recall(embeddings, results, flights=None):
+    if SEARCH_RECALL_SAMPLE_RATE <= 0:
+        return
+    for embedding, result in zip(embeddings, results):
+        if random.random() < SEARCH_RECALL_SAMPLE_RATE:
+            if not _recall_pending.acquire(blocking=False):
+                with _recall_lock:
+                    recall_stats["skipped"] += 1
+                continue
+            _recall_executor.submit(_check_recall, np.asarray(embedding, dtype=np.float32), result, flights)
+
+
+def _check_recall(embedding, result, flights):
+    try:
+        with engine.connect() as conn:
+            exact = _find_with_window_query(embedding, 1, conn, flights)
+    except Exception as e:
+        logger.warning("Recall check failed: %s", e)
+        return
+    finally:
+        _recall_pending.release()
+    found = result["person_id"] if result else None
+    expected = exact["person_id"] if exact else None
+    with _recall_lock:
+        recall_stats["checked"] += 1
+        if found != expected:
+            recall_stats["mismatched"] += 1
+        checked, mismatched = recall_stats["checked"], recall_stats["mismatched"]
+    if found != expected:
+        logger.warning("Approximate search (%s) returned person %s, exact search %s. Recall so far: %.4f (%d checks)",
+                       SEARCH_MODE, found, expected, 1 - mismatched / checked, checked)
+
+
+def measure_search_recall(samples=100, noise=0.05):
+    """
+    Offline recall measurement: takes random stored embeddings, adds Gaussian noise to look like a new
+    photo, and compares the configured search with the exact window query. Returns the share of
+    queries where both found the same person.
+    """
     with engine.connect() as conn:
-        res = conn.execute(
-            text("""
-                WITH person_matches AS (
-                    SELECT
-                        p.id, p.name, p.surname, p.age, p.nationality, p.flight_no, p.passport_no,
-                        1 - (fe.embedding <=> (:embedding)::vector) AS similarity,
-                        ROW_NUMBER() OVER (PARTITION BY p.id ORDER BY fe.embedding <=> (:embedding)::vector ASC) as rank
-                    FROM people p
-                    JOIN face_embeddings fe ON p.id = fe.person_id
-                )
-                SELECT id, name, surname, age, nationality, flight_no, passport_no, similarity
-                FROM person_matches
-                WHERE rank = 1  -- best match for each person
-                ORDER BY similarity DESC
-                LIMIT :top_k
+        rows = conn.execute(
+            text("SELECT embedding FROM face_embeddings ORDER BY random() LIMIT :samples"),
+            dict(samples=samples)
+        ).fetchall()
+    if not rows:
+        return None
+
+    queries = []
+    for row in rows:
+        query = parse_vector(row[0]) + np.random.normal(0, noise, 512).astype(np.float32)
+        queries.append(query / np.linalg.norm(query))
+
+    results = find_most_similar_faces(queries, top_k=1)
+    with engine.connect() as conn:
+        exact_results = _find_many_with_window_query(queries, 1, conn)
+    hits = 0
+    for result, exact in zip(results, exact_results):
+        hits += (result["person_id"] if result else None) == (exact["person_id"] if exact else None)
+    return hits / len(queries)
+
+
+def resolve_search_scope(flight_nos=(), checkpoint_id=""):
+    """
+    Turns the scope of a request into the sorted list of flight numbers to search, or None when the
+    request is not scoped. A checkpoint adds the flights mapped to it in checkpoint_flights.
+    """
+    flights = set(flight_nos)
+    if checkpoint_id:
+        flights.update(_checkpoint_flights(checkpoint_id))
+    elif not flights:
+        return None
+    return sorted(flights)
+
+
+_checkpoint_cache = {}  # checkpoint id -> (expires at, flight numbers)
+
+
+def _checkpoint_flights(checkpoint_id):
+    """Flights served by a checkpoint, cached for CHECKPOINT_CACHE_TTL seconds"""
+    cached = _checkpoint_cache.get(checkpoint_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    with engine.connect() as conn:
+        flights = conn.execute(
+            text("SELECT flight_no FROM checkpoint_flights WHERE checkpoint_id = :checkpoint_id"),
+            {"checkpoint_id": checkpoint_id}
+        ).scalars().all()
+    if not flights:
+        logger.warning("Checkpoint %s has no flights in checkpoint_flights, its searches match nobody", checkpoint_id)
+    _checkpoint_cache[checkpoint_id] = (time.monotonic() + CHECKPOINT_CACHE_TTL, flights)
+    return flights
+
+
+def _vector_literal(embedding):
+    return "[" + ",".join(str(float(v)) for v in embedding) + "]"
+
+
+def _gallery_match(matches, good_match_count):
+    if not matches:
+        return None
+    person_id, similarity = matches[0]
+    person = gallery.person_info(person_id)
+    if person is None:
+        return None
+    return _build_match(person_id, person, similarity, good_match_count)
+
+
+# The query vectors of a batch as rows (ord, q), ord numbers them from 1 in the order given
+_QUERIES_CTE = """
+    queries AS (
+        SELECT ord, CAST(q AS vector) AS q
+        FROM unnest(CAST(:embeddings AS text[])) WITH ORDINALITY AS t(q, ord)
+    )
+"""
+
+
+def _rows_per_query(rows, count, ord_column=8):
+    """Splits the rows of a batched query by the query they belong to, keeping their order"""
+    rows_per_query = [[] for _ in range(count)]
+    for row in rows:
+        rows_per_query[row[ord_column] - 1].append(row)
+    return rows_per_query
+
+
+def _find_many_with_ann_query(embeddings):
+    """
+    Single round trip: for every query vector the index returns the ANN_CANDIDATES nearest
+    embeddings, then they are regrouped by person here. The confidence boost is counted from the same
+    candidates, which always contain the best person's close embeddings as long as ANN_CANDIDATES is
+    well above the number of embeddings per person.
+    """
+    # The ORDER BY expression has to match an index expression for the index to be used
+    order_by = "embedding::halfvec(512) <=> queries.q::halfvec(512)" if ANN_HALFVEC else "embedding <=> queries.q"
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(f"""
+                WITH {_QUERIES_CTE}
+                SELECT p.id, p.name, p.surname, p.age, p.nationality, p.flight_no, p.passport_no,
+                       1 - c.distance AS similarity, queries.ord
+                FROM queries
+                CROSS JOIN LATERAL (
+                    SELECT person_id, embedding <=> queries.q AS distance
+                    FROM face_embeddings
+                    ORDER BY {order_by}
+                    LIMIT :candidates
+                ) c
+                JOIN people p ON p.id = c.person_id
+                ORDER BY queries.ord, c.distance ASC
             """),
-            dict(embedding=embedding.tolist(), top_k=top_k)
-        )
-        rows = res.fetchall()
+            dict(embeddings=[_vector_literal(e) for e in embeddings], candidates=ANN_CANDIDATES)
+        ).fetchall()
+
+    return [_rerank_candidates(query_rows) for query_rows in _rows_per_query(rows, len(embeddings))]
+
+
+def _find_with_prototype_query(embedding, conn):
+    return _find_many_with_prototype_query([embedding], conn)[0]
+
+
+def _find_many_with_prototype_query(embeddings, conn):
+    """
+    Two stages in one query for the whole batch: per query vector the PROTOTYPE_CANDIDATES people
+    whose centroid is closest, then every embedding of only those people. All embeddings of the best
+    person are among the rows, so the confidence boost counts the same as in the window query.
+    """
+    rows = conn.execute(
+        text(f"""
+            WITH {_QUERIES_CTE}
+            SELECT p.id, p.name, p.surname, p.age, p.nationality, p.flight_no, p.passport_no,
+                   1 - (fe.embedding <=> queries.q) AS similarity, queries.ord
+            FROM queries
+            CROSS JOIN LATERAL (
+                SELECT person_id
+                FROM person_prototypes
+                ORDER BY centroid <=> queries.q
+                LIMIT :candidates
+            ) c
+            JOIN face_embeddings fe ON fe.person_id = c.person_id
+            JOIN people p ON p.id = c.person_id
+            ORDER BY queries.ord, similarity DESC
+        """),
+        dict(embeddings=[_vector_literal(e) for e in embeddings], candidates=PROTOTYPE_CANDIDATES)
+    ).fetchall()
+
+    return [_rerank_candidates(query_rows) for query_rows in _rows_per_query(rows, len(embeddings))]
+
 
-        if not rows:
-            return None
+def _rerank_candidates(rows):
+    """Picks the best person from candidate rows ordered by similarity, best first"""
+    if not rows:
+        return None
 
-        # Get the best match
-        best_match = rows[0]
-        similarity = float(best_match[7])
+    best_match = rows[0]
+    person_id = best_match[0]
+    good_match_count = sum(
+        1 for row in rows if row[0] == person_id and float(row[7]) > GOOD_MATCH_THRESHOLD
+    )
+    return _build_match(person_id, best_match._mapping, float(best_match[7]), good_match_count)
 
-        # Confidence score boost, %70 threshold for each embedding match
-        person_id = best_match[0]
-        confidence_query = conn.execute(
+
+def _find_with_window_query(embedding, top_k, conn, flights=None):
+    return _find_many_with_window_query([embedding], top_k, conn, flights)[0]
+
+
+def _find_many_with_window_query(embeddings, top_k, conn, flights=None):
+    """
+    Exact search for a whole batch in two round trips: the window query ranks every person by their
+    best embedding for each query vector, then the confidence boost counts the good matches of each
+    query's best person.
+    """
+    scope_filter = "WHERE p.flight_no = ANY(:flights)" if flights is not None else ""
+    literals = [_vector_literal(e) for e in embeddings]
+    with metrics.stage("similarity_query"):
+        rows = conn.execute(
+            text(f"""
+                WITH {_QUERIES_CTE}
+                SELECT best.id, best.name, best.surname, best.age, best.nationality, best.flight_no,
+                       best.passport_no, best.similarity, queries.ord
+                FROM queries
+                CROSS JOIN LATERAL (
+                    SELECT id, name, surname, age, nationality, flight_no, passport_no, similarity
+                    FROM (
+                        SELECT
+                            p.id, p.name, p.surname, p.age, p.nationality, p.flight_no, p.passport_no,
+                            1 - (fe.embedding <=> queries.q) AS similarity,
+                            ROW_NUMBER() OVER (PARTITION BY p.id ORDER BY fe.embedding <=> queries.q ASC) as rank
+                        FROM people p
+                        JOIN face_embeddings fe ON p.id = fe.person_id
+                        {scope_filter}
+                    ) person_matches
+                    WHERE rank = 1  -- best match for each person
+                    ORDER BY similarity DESC
+                    LIMIT :top_k
+                ) best
+                ORDER BY queries.ord, best.similarity DESC
+            """),
+            dict(embeddings=literals, top_k=top_k, flights=flights)
+        ).fetchall()
+
+    # Get the best match of each query
+    best_matches = [query_rows[0] if query_rows else None for query_rows in _rows_per_query(rows, len(embeddings))]
+    found = [(i, row) for i, row in enumerate(best_matches) if row is not None]
+    if not found:
+        return [None] * len(embeddings)
+
+    # Confidence score boost, %70 threshold for each embedding match
+    with metrics.stage("confidence_boost_query"):
+        counts = dict(conn.execute(
             text("""
-                SELECT COUNT(*) 
-                FROM face_embeddings 
-                WHERE person_id = :person_id 
-                AND (1 - (embedding <=> (:embedding)::vector)) > 0.70
+                SELECT t.ord, COUNT(*)
+                FROM unnest(CAST(:embeddings AS text[]), CAST(:person_ids AS integer[])) WITH ORDINALITY
+                     AS t(q, person_id, ord)
+                JOIN face_embeddings fe ON fe.person_id = t.person_id
+                WHERE (1 - (fe.embedding <=> CAST(t.q AS vector))) > :threshold
+                GROUP BY t.ord
             """),
-            dict(person_id=person_id, embedding=embedding.tolist())
-        )
-        good_match_count = confidence_query.scalar()
-        print(f"Good match count for person {person_id}: {good_match_count}")
-        confidence_boost = min(0.1, (good_match_count * 0.02))  # Max 0.1 boost, can be adjusted
-        print(f"Confidence boost: {confidence_boost}")
-        adjusted_similarity = min(1.0, similarity + confidence_boost)
-        print(f"original similarity: {similarity}, adjusted similarity: {adjusted_similarity}")
-
-        # Return the best match details
-        return {
-            "name": best_match[1],
-            "surname": best_match[2],
-            "age": best_match[3],
-            "nationality": best_match[4],
-            "flight_no": best_match[5],
-            "passport_no": best_match[6],
-            "similarity": adjusted_similarity
-        }
+            dict(embeddings=[literals[i] for i, _ in found], person_ids=[row[0] for _, row in found],
+                 threshold=GOOD_MATCH_THRESHOLD)
+        ).fetchall())
+
+    # Return the best match details
+    results = [None] * len(embeddings)
+    for n, (i, row) in enumerate(found, start=1):
+        results[i] = _build_match(row[0], row._mapping, float(row[7]), counts.get(n, 0))
+    return results
 
 
 def db_get_person_by_passport(passport_no):
@@ -109,20 +485,216 @@ def db_insert_person(info):
 
         # Print the person ID of the newly created person
         person_id = result.scalar()
-        print(f"DB: Inserted person ID: {person_id}")
+        logger.debug("Inserted person id: %s", person_id)
 
         # 2. Then add the embedding
-        conn.execute(
+        embedding_id = conn.execute(
             text("""
                 INSERT INTO face_embeddings
                 (person_id, embedding)
                 VALUES (:person_id, :embedding)
+                RETURNING id
             """),
             {"person_id": person_id, "embedding": info["embedding"]}
+        ).scalar()
+        _add_to_prototypes(conn, {person_id: [info["embedding"]]})
+
+    if gallery is not None:
+        gallery.set_person((person_id, info["name"], info["surname"], info["age"], info["nationality"],
+                            info["flight_no"], info["passport_no"]))
+        gallery.add_embedding(embedding_id, person_id, info["embedding"])
+
+    # Return the person ID
+    return person_id
+
+
+def db_insert_person_with_embeddings(info, embeddings):
+    """
+    Inserts a person and all of their embeddings in one transaction, the embeddings with a single
+    multi-row insert. Either everything is stored or nothing is. Returns the new person ID.
+    """
+    with engine.begin() as conn:
+        person_id = conn.execute(
+            text("""
+                INSERT INTO people
+                (name, surname, age, nationality, flight_no, passport_no)
+                VALUES (:name, :surname, :age, :nationality, :flight_no, :passport_no)
+                RETURNING id
+            """),
+            {column: info[column] for column in PERSON_COLUMNS}
+        ).scalar()
+
+        conn.execute(
+            text("""
+                INSERT INTO face_embeddings (person_id, embedding)
+                SELECT :person_id, CAST(e AS vector)
+                FROM unnest(CAST(:embeddings AS text[])) AS e
+            """),
+            {"person_id": person_id, "embeddings": [_vector_literal(e) for e in embeddings]}
         )
+        _add_to_prototypes(conn, {person_id: list(embeddings)})
+
+    if gallery is not None:
+        _add_people_to_gallery([person_id])
+    return person_id
+
+
+def db_bulk_insert_people(people):
+    """
+    Enrolls many people in one transaction. people is a list of (info, embeddings) pairs, info holds
+    the PERSON_COLUMNS fields. Rows are streamed with COPY into temporary staging tables and moved
+    into people and face_embeddings by a single INSERT ... SELECT. People whose passport_no is
+    already enrolled are left untouched. Returns {passport_no: person_id} of the inserted people.
+    """
+    people_csv, embeddings_csv = io.StringIO(), io.StringIO()
+    people_writer, embeddings_writer = csv.writer(people_csv), csv.writer(embeddings_csv)
+    for info, embeddings in people:
+        # None becomes an unquoted empty field, which COPY reads as NULL
+        people_writer.writerow([info.get(column) for column in PERSON_COLUMNS])
+        for embedding in embeddings:
+            embeddings_writer.writerow([info["passport_no"], _vector_literal(embedding)])
+    people_csv.seek(0)
+    embeddings_csv.seek(0)
+
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE staging_people
+                (name TEXT, surname TEXT, age INTEGER, nationality TEXT, flight_no TEXT, passport_no TEXT)
+                ON COMMIT DROP;
+            CREATE TEMP TABLE staging_embeddings (passport_no TEXT, embedding VECTOR(512)) ON COMMIT DROP;
+        """)
+        cursor.copy_expert("COPY staging_people FROM STDIN WITH (FORMAT csv)", people_csv)
+        cursor.copy_expert("COPY staging_embeddings FROM STDIN WITH (FORMAT csv)", embeddings_csv)
+
+        inserted = conn.execute(text("""
+            WITH inserted AS (
+                INSERT INTO people (name, surname, age, nationality, flight_no, passport_no)
+                SELECT name, surname, age, nationality, flight_no, passport_no FROM staging_people
+                ON CONFLICT (passport_no) DO NOTHING
+                RETURNING id, passport_no
+            ), embeddings AS (
+                INSERT INTO face_embeddings (person_id, embedding)
+                SELECT i.id, s.embedding
+                FROM staging_embeddings s
+                JOIN inserted i USING (passport_no)
+            )
+            SELECT id, passport_no FROM inserted
+        """)).fetchall()
+
+        embeddings_by_passport = {info["passport_no"]: embeddings for info, embeddings in people}
+        _add_to_prototypes(conn, {person_id: embeddings_by_passport[passport_no]
+                                  for person_id, passport_no in inserted})
+
+    person_ids = {passport_no: person_id for person_id, passport_no in inserted}
+    if gallery is not None and person_ids:
+        _add_people_to_gallery(list(person_ids.values()))
+    return person_ids
+
+
+def _add_people_to_gallery(person_ids):
+    with engine.connect() as conn:
+        people = conn.execute(
+            text("""
+                SELECT id, name, surname, age, nationality, flight_no, passport_no
+                FROM people WHERE id = ANY(:ids)
+            """),
+            {"ids": person_ids}
+        ).fetchall()
+        embeddings = conn.execute(
+            text("SELECT id, person_id, embedding::text FROM face_embeddings WHERE person_id = ANY(:ids)"),
+            {"ids": person_ids}
+        ).fetchall()
+
+    for row in people:
+        gallery.set_person(row)
+    for embedding_id, person_id, embedding in embeddings:
+        gallery.add_embedding(embedding_id, person_id, parse_vector(embedding))
 
-        # Return the person ID
-        return person_id
+
+def _add_to_prototypes(conn, embeddings_by_person):
+    """
+    Adds new embeddings to the people's prototypes (running sum, count and normalized centroid) in
+    the caller's transaction. The people rows are locked first, so concurrent writers of the same
+    person can't lose each other's update. No-op outside prototype mode.
+    """
+    if SEARCH_MODE != "prototype" or not embeddings_by_person:
+        return
+
+    rows = conn.execute(
+        text("""
+            SELECT p.id, pp.embedding_sum::text, pp.embedding_count
+            FROM people p
+            LEFT JOIN person_prototypes pp ON pp.person_id = p.id
+            WHERE p.id = ANY(:ids)
+            FOR UPDATE OF p
+        """),
+        {"ids": list(embeddings_by_person)}
+    ).fetchall()
+    existing = {row[0]: (parse_vector(row[1]), row[2]) for row in rows if row[1] is not None}
+
+    prototypes = {}
+    for person_id, embeddings in embeddings_by_person.items():
+        total = np.sum(np.asarray(embeddings, dtype=np.float32), axis=0)
+        count = len(embeddings)
+        if person_id in existing:
+            total += existing[person_id][0]
+            count += existing[person_id][1]
+        prototypes[person_id] = (total, count)
+    _upsert_prototypes(conn, prototypes)
+
+
+def _upsert_prototypes(conn, prototypes):
+    """prototypes: {person_id: (embedding sum, embedding count)}"""
+    ids, sums, centroids, counts = [], [], [], []
+    for person_id, (total, count) in prototypes.items():
+        norm = np.linalg.norm(total)
+        ids.append(person_id)
+        sums.append(_vector_literal(total))
+        centroids.append(_vector_literal(total / norm if norm > 0 else total))
+        counts.append(count)
+
+    conn.execute(
+        text("""
+            INSERT INTO person_prototypes (person_id, embedding_sum, centroid, embedding_count)
+            SELECT person_id, CAST(embedding_sum AS vector), CAST(centroid AS vector), embedding_count
+            FROM unnest(CAST(:ids AS integer[]), CAST(:sums AS text[]), CAST(:centroids AS text[]),
+                        CAST(:counts AS integer[])) AS t(person_id, embedding_sum, centroid, embedding_count)
+            ON CONFLICT (person_id) DO UPDATE SET
+                embedding_sum = EXCLUDED.embedding_sum,
+                centroid = EXCLUDED.centroid,
+                embedding_count = EXCLUDED.embedding_count
+        """),
+        dict(ids=ids, sums=sums, centroids=centroids, counts=counts)
+    )
+
+
+def db_sync_prototypes():
+    """
+    Rebuilds the prototypes that are missing or out of date (their count differs from the person's
+    embeddings), e.g. after switching to prototype mode. Returns the number of rebuilt prototypes.
+    """
+    with engine.begin() as conn:
+        stale = conn.execute(text("""
+            SELECT fe.person_id
+            FROM (SELECT person_id, COUNT(*) AS n FROM face_embeddings GROUP BY person_id) fe
+            LEFT JOIN person_prototypes pp ON pp.person_id = fe.person_id
+            WHERE pp.person_id IS NULL OR pp.embedding_count <> fe.n
+        """)).scalars().all()
+
+        if stale:
+            rows = conn.execute(
+                text("SELECT person_id, embedding::text FROM face_embeddings WHERE person_id = ANY(:ids)"),
+                {"ids": list(stale)}
+            ).fetchall()
+            grouped = {}
+            for person_id, embedding in rows:
+                grouped.setdefault(person_id, []).append(parse_vector(embedding))
+            _upsert_prototypes(conn, {person_id: (np.sum(embeddings, axis=0), len(embeddings))
+                                      for person_id, embeddings in grouped.items()})
+
+    logger.info("Person prototypes: rebuilt %d", len(stale))
+    return len(stale)
 
 
 def db_check_person_exists(person_id):
@@ -144,17 +716,23 @@ def db_add_embedding(person_id, embedding):
         embedding_list = embedding
 
     with engine.begin() as conn:
-        conn.execute(
+        embedding_id = conn.execute(
             text("""
                 INSERT INTO face_embeddings
                 (person_id, embedding)
                 VALUES (:person_id, :embedding)
+                RETURNING id
             """),
             {
                 "person_id": person_id,
                 "embedding": embedding_list
             }
-        )
+        ).scalar()
+        _add_to_prototypes(conn, {person_id: [embedding_list]})
+
+    if gallery is not None:
+        gallery.add_embedding(embedding_id, person_id, embedding_list)
+    _notify_person_changed(person_id)
 
 
 def db_delete_person(person_id):
@@ -164,6 +742,7 @@ def db_delete_person(person_id):
 
     try:
         with engine.begin() as conn:
+            # The prototype goes with the person (ON DELETE CASCADE)
             # First delete all embeddings for the person
             conn.execute(
                 text("DELETE FROM face_embeddings WHERE person_id = :person_id"),
@@ -176,7 +755,10 @@ def db_delete_person(person_id):
                 {"person_id": person_id}
             )
 
+        if gallery is not None:
+            gallery.remove_person(person_id)
+        _notify_person_changed(person_id)
         return True
-    except Exception as e:
-        print(f"Person deleteion error: {str(e)}")
+    except Exception:
+        logger.exception("Person deletion error")
         return False
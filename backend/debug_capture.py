@@ -0,0 +1,122 @@
+import collections
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import cv2
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DEBUG_SAMPLE_RATE = float(os.getenv("DEBUG_SAMPLE_RATE", 0.0))  # share of requests kept, 0 disables capturing
+DEBUG_BUFFER_SIZE = int(os.getenv("DEBUG_BUFFER_SIZE", 100))  # captures kept in memory
+DEBUG_CAPTURE_DIR = os.getenv("DEBUG_CAPTURE_DIR", "debug_captures")
+DEBUG_WRITE_SAMPLES = os.getenv("DEBUG_WRITE_SAMPLES", "0") == "1"  # also write every sample, in the background
+
+
+class DebugCapture:
+    """
+    Keeps recent request images and face crops in an in-memory ring buffer.
+
+    The request path only does a sampling check and a deque append. sample() decides once per request
+    and returns a capture id, which goes down to the embedding call with the image, so a request's
+    image and its crop are kept together and share the id in their file names. Files are written by a
+    background thread, either when dump() is called or, with write_samples, for every sampled capture.
+    The writer queue is bounded and drops captures instead of slowing requests down.
+    """
+
+    def __init__(self, sample_rate=DEBUG_SAMPLE_RATE, capacity=DEBUG_BUFFER_SIZE, output_dir=DEBUG_CAPTURE_DIR,
+                 write_samples=DEBUG_WRITE_SAMPLES):
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.write_samples = write_samples
+        self._buffer = collections.deque(maxlen=capacity)
+        self._queue = queue.Queue(maxsize=max(capacity, 1))
+        self._capture_ids = itertools.count()
+        self._forwarded = None  # set in inference worker processes, see forward()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sample(self):
+        """Decides once per request whether its images are captured, returns a capture id or None"""
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return next(self._capture_ids)
+        return None
+
+    def capture(self, capture_id, kind, data):
+        """
+        Stores one image of the sampled request capture_id. data is either encoded image bytes (kept as
+        they are) or a BGR array (encoded by the writer thread). Arrays are not copied, callers must not
+        modify them afterwards.
+        """
+        item = (time.time(), capture_id, kind, data)
+        if self._forwarded is not None:
+            self._forwarded.append(item)
+        else:
+            self.store([item])
+
+    def store(self, items):
+        """Adds captures to the ring buffer, e.g. the ones an inference worker sent back"""
+        for item in items or ():
+            self._buffer.append(item)
+        if items and self.write_samples:
+            self._enqueue(items)
+
+    def forward(self):
+        """Called in a worker process: captures are kept for take_forwarded() instead of buffered"""
+        self._forwarded = []
+
+    def take_forwarded(self):
+        """The captures collected since the last call, None outside of worker processes"""
+        if self._forwarded is None:
+            return None
+        taken, self._forwarded = self._forwarded, []
+        return taken
+
+    def dump(self):
+        """Writes everything in the ring buffer to output_dir in the background, returns the number of captures"""
+        items = list(self._buffer)
+        self._enqueue(items)
+        return len(items)
+
+    def _enqueue(self, items):
+        self._ensure_writer()
+        for item in items:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                break
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        while True:
+            timestamp, capture_id, kind, data = self._queue.get()
+            name = time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp))
+            path = os.path.join(self.output_dir, f"{name}-{capture_id:06d}-{kind}.jpg")
+            try:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    with open(path, "wb") as f:
+                        f.write(data)
+                elif data is not None and data.size != 0:
+                    cv2.imwrite(path, data)
+            except Exception as e:
+                logger.warning("Debug capture write error: %s", e)
+
+
+# Shared by the server and the embedding model
+debug_capture = DebugCapture()
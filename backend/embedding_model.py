@@ -1,48 +1,323 @@
 import cv2
-from insightface.app import FaceAnalysis
+import glob
+import hashlib
+import json
+import logging
+import numpy as np
+import onnxruntime as ort
+from insightface.app.common import Face
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.retinaface import RetinaFace
+from insightface.utils import face_align
+from insightface.utils.storage import ensure_available
 import os
+import time
 from dotenv import load_dotenv
 
+from debug_capture import debug_capture
+import metrics
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 width = int(os.getenv("DET_SIZE_W", 640))
 height = int(os.getenv("DET_SIZE_H", 640))
 model_name = os.getenv("MODEL_NAME", "buffalo_l")
+model_root = os.getenv("MODEL_ROOT", "~/.insightface")  # insightface downloads the model packs here
+intra_op_threads = int(os.getenv("ORT_INTRA_OP_THREADS", 0))  # 0 lets ONNX Runtime use all cores
+inter_op_threads = int(os.getenv("ORT_INTER_OP_THREADS", 0))  # >0: independent branches of a graph run in parallel
+allow_spinning = os.getenv("ORT_ALLOW_SPINNING", "1") == "1"  # 0: idle ORT threads sleep, for many processes per host
+model_precision = os.getenv("MODEL_PRECISION", "float32")  # "int8": the models made by quantize_models.py
+quantized_model_dir = os.getenv("QUANTIZED_MODEL_DIR", "models_int8")
+ort_cache_dir = os.getenv("ORT_CACHE_DIR", "ort_cache")  # optimized model graphs, empty disables the cache
+# Face box hints: detection runs on the hint padded by ROI_PADDING box sizes per side, at the smallest of
+# ROI_DET_SIZES (multiples of 32) that covers that region
+roi_padding = float(os.getenv("ROI_PADDING", 0.5))
+roi_det_sizes = sorted(int(size) for size in os.getenv("ROI_DET_SIZES", "128,192,256,320").split(","))
+# Submodels of the pack that are loaded, as module or module:file to pick the file of a module, e.g.
+# "detection:det_500m.onnx,recognition". The pack's landmark and gender-age models are never used here
+model_modules = os.getenv("MODEL_MODULES", "detection,recognition")
+
+# If you are working with a CPU, CPUExecutionProvider is fine. Otherwise, you can use CUDAExecutionProvider for GPU and make some other adjustments with libraries.
+PROVIDERS = ['CPUExecutionProvider']
+MODEL_CLASSES = {"detection": RetinaFace, "recognition": ArcFaceONNX}
+ACCURACY_REPORT = "accuracy.json"  # written to quantized_model_dir by quantize_models.py check
+
+
+def _parse_modules(value):
+    """MODEL_MODULES -> {module: file name, None to find it in the pack}, fails on unknown or missing modules"""
+    modules = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        task, _, file_name = entry.partition(":")
+        if task not in MODEL_CLASSES:
+            raise RuntimeError(f"MODEL_MODULES: unknown module {task!r}, the modules are {', '.join(MODEL_CLASSES)}.")
+        modules[task] = file_name.strip() or None
+    missing = [task for task in MODEL_CLASSES if task not in modules]
+    if missing:
+        raise RuntimeError(f"MODEL_MODULES: the {' and '.join(missing)} module is required.")
+    return modules
+
+
+MODULES = _parse_modules(model_modules)
+
+
+def _taskname(model_file):
+    """Module of a pack model file, by the same input/output rules as insightface's model router"""
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL  # only the signature is needed
+    session = ort.InferenceSession(model_file, sess_options=sess_options, providers=PROVIDERS)
+    inputs, outputs = session.get_inputs(), session.get_outputs()
+    shape = inputs[0].shape
+    if len(outputs) >= 5:
+        return "detection"
+    if len(inputs) == 1 and isinstance(shape[2], int) and shape[2] == shape[3] and shape[2] not in (96, 192) \
+            and shape[2] >= 112 and shape[2] % 16 == 0:
+        return "recognition"
+    return None
+
+
+def _pack_files(model_dir):
+    """Module -> model file of the pack. Worked out once per pack and kept in ort_cache_dir"""
+    manifest = os.path.join(ort_cache_dir, f"{model_name}-modules.json") if ort_cache_dir else None
+    if manifest and os.path.exists(manifest):
+        with open(manifest) as f:
+            return {task: os.path.join(model_dir, name) for task, name in json.load(f).items()}
+
+    files = {}
+    for model_file in sorted(glob.glob(os.path.join(model_dir, "*.onnx"))):
+        task = _taskname(model_file)
+        if task is not None:
+            files.setdefault(task, model_file)  # like FaceAnalysis, the first file of a module wins
+    if manifest:
+        os.makedirs(ort_cache_dir, exist_ok=True)
+        with open(manifest, "w") as f:
+            json.dump({task: os.path.basename(path) for task, path in files.items()}, f)
+    return files
+
+
+def quantized_file(model_file):
+    return os.path.join(quantized_model_dir, os.path.basename(model_file))
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _checked_quantized_files(files):
+    """The int8 models of the pack, only if quantize_models.py's accuracy check passed for exactly these files"""
+    report_path = os.path.join(quantized_model_dir, ACCURACY_REPORT)
+    if not os.path.exists(report_path):
+        raise RuntimeError(f"MODEL_PRECISION=int8: no accuracy report {report_path}, run quantize_models.py first.")
+    with open(report_path) as f:
+        report = json.load(f)
+    if not report.get("passed"):
+        raise RuntimeError(f"MODEL_PRECISION=int8: the int8 models failed their accuracy check, see {report_path}.")
+
+    quantized = {task: quantized_file(files[task]) for task in MODULES}
+    for path in quantized.values():
+        if not os.path.exists(path):
+            raise RuntimeError(f"MODEL_PRECISION=int8: {path} is missing, run quantize_models.py first.")
+    if report.get("files") != {task: file_digest(path) for task, path in quantized.items()}:
+        raise RuntimeError("MODEL_PRECISION=int8: the int8 models changed after their accuracy check, "
+                           "run quantize_models.py check again.")
+    return quantized
+
+
+def _optimized_model(model_file):
+    """
+    Copy of model_file with ONNX Runtime's basic graph optimizations (constant folding, redundant node
+    removal) applied, created on first use. Only this level is hardware-independent, the extended
+    fusions and layout changes can depend on the execution provider and CPU, so sessions of the copy
+    still run them at load time. Later starts skip the basic pass over the full graph.
+    """
+    name = os.path.splitext(os.path.basename(model_file))[0]
+    stat = os.stat(model_file)  # a rewritten file (e.g. quantized again) gets a new entry
+    cached = os.path.join(ort_cache_dir,
+                          f"{name}-{stat.st_size}-{stat.st_mtime_ns}-ort{ort.__version__}-basic.onnx")
+    if not os.path.exists(cached):
+        os.makedirs(ort_cache_dir, exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        sess_options.optimized_model_filepath = tmp
+        ort.InferenceSession(model_file, sess_options=sess_options, providers=PROVIDERS)
+        os.replace(tmp, cached)  # worker processes may be writing the same file
+        logger.info("Cached the optimized graph of %s in %s", model_file, cached)
+    return cached
+
 
 class EmbeddingModel:
-    def __init__(self):
-        # If you are working with a CPU, CPUExecutionProvider is fine. Otherwise, you can use CUDAExecutionProvider for GPU and make some other adjustments with libraries.
-        self.app = FaceAnalysis(name=model_name, providers=['CPUExecutionProvider'])
-        print("FaceAnalysis det_size for detection:", width, height)
-        self.app.prepare(ctx_id=-1, det_size=(width, height))  # -1 for CPU, 0 for GPU, det_size is the size of the detection model input
-
-    def get_embedding(self, image):
-        faces = self.app.get(image)
-        print(f"Detected faces: {len(faces)}")
-        if len(faces) == 0:
-            print("No faces detected in the image.")
-            return None
-        # Choosing the face with the highest detection score
-        face = max(faces, key=lambda f: getattr(f, 'det_score', 0.0))
-
-        # Safe crop debug
-        img_cropped = getattr(face, "crop", None)
-        if img_cropped is not None and hasattr(img_cropped, "size") and img_cropped.size != 0:
-            cv2.imwrite("debug_face_crop.jpg", img_cropped)
-            print("Debug: Cropped face saved.")
+    def __init__(self, intra_op_threads=intra_op_threads, precision=model_precision, check_accuracy=True):
+        started = time.perf_counter()
+        model_dir = ensure_available("models", model_name, root=model_root)
+        files = _pack_files(model_dir) if None in MODULES.values() else {}
+        for task, file_name in MODULES.items():
+            if file_name is not None:
+                path = os.path.join(model_dir, file_name)
+                if not os.path.exists(path):
+                    raise RuntimeError(f"MODEL_MODULES: {file_name} is not in the model pack {model_name}.")
+                if _taskname(path) != task:
+                    raise RuntimeError(f"MODEL_MODULES: {file_name} is not a {task} model.")
+                files[task] = path
+            elif task not in files:
+                raise RuntimeError(f"Model pack {model_name} has no {task} model.")
+        if precision == "int8":
+            # check_accuracy=False is for quantize_models.py, which runs the check
+            session_files = _checked_quantized_files(files) if check_accuracy else \
+                {task: quantized_file(files[task]) for task in MODULES}
+        elif precision == "float32":
+            session_files = files
         else:
-            # Some models may not have a crop method, so we check for bbox
-            bbox = getattr(face, "bbox", None)
-            if bbox is not None:
-                x1, y1, x2, y2 = [int(val) for val in bbox]
-                img_bounding = image[y1:y2, x1:x2]
-                if img_bounding is not None and hasattr(img_bounding, "size") and img_bounding.size != 0:
-                    cv2.imwrite("debug_face_bbox.jpg", img_bounding)
-                    print("Debug: Bounding box face saved.")
-                else:
-                    print("Debug: Bounding box face is empty or invalid.")
-            else:
-                print("Debug: Neither crop nor bbox available for the detected face.")
-        # Getting and returning the embedding
-        embedding = face.normed_embedding  # insightface can return normed embeddings directly
-        print(f"Embedding shape: {embedding.shape}")
-        return embedding
\ No newline at end of file
+            raise ValueError(f"Unknown model precision: {precision}")
+
+        models = {}
+        for task, model_class in MODEL_CLASSES.items():
+            # The models get the sessions built here, insightface does not pass session options through.
+            # model_file stays the float32 file, ArcFaceONNX reads its input normalization from the first
+            # nodes of the graph and quantization renames them.
+            models[task] = model_class(model_file=files[task],
+                                       session=self._session(session_files[task], intra_op_threads))
+
+        self.det_model = models["detection"]
+        self.rec_model = models["recognition"]
+        # Models exported with a fixed input size can't run at the smaller region sizes
+        self.dynamic_det_size = self.det_model.input_size is None
+        # ctx_id 0: the sessions already run on the CPU, with -1 insightface would create them once more
+        self.det_model.prepare(0, input_size=(width, height), det_thresh=0.5)  # det_size is the size of the detection model input
+        self.rec_model.prepare(0)
+        logger.info("Loaded %s (%s, det_size %d %d) in %.1f s", ", ".join(os.path.basename(files[task]) for task in MODULES),
+                    precision, width, height, time.perf_counter() - started)
+
+    def _session(self, model_file, intra_op_threads):
+        sess_options = ort.SessionOptions()
+        if intra_op_threads > 0:
+            sess_options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+            sess_options.inter_op_num_threads = inter_op_threads
+        if not allow_spinning:
+            sess_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        if ort_cache_dir:
+            model_file = _optimized_model(model_file)
+        return ort.InferenceSession(model_file, sess_options=sess_options, providers=PROVIDERS)
+
+    def warm_up(self):
+        """
+        Runs both models once on blank input, so that the first request does not pay for ONNX Runtime's
+        lazy allocations. Calls the models directly, warm-up is not recorded in the stage metrics.
+        """
+        started = time.perf_counter()
+        self.det_model.detect(np.zeros((height, width, 3), dtype=np.uint8), max_num=0, metric="default")
+        crop_width, crop_height = self.rec_model.input_size
+        self.rec_model.get_feat([np.zeros((crop_height, crop_width, 3), dtype=np.uint8)])
+        logger.info("Model warm-up took %.1f s", time.perf_counter() - started)
+
+    def detect(self, image, box=None):
+        """
+        Returns the face with the highest detection score, None if there is no face. box (x1, y1, x2, y2)
+        is a hint where the face is, detection then runs on a region around it at a smaller input size
+        first, and on the full image only if that finds nothing.
+        """
+        if box is None:
+            return self._detect(image)
+        region = self._region(image, box)
+        if region is not None:
+            x1, y1, x2, y2, size = region
+            with metrics.stage("roi_detection"):
+                face = self._detect(image[y1:y2, x1:x2], size, (x1, y1))
+            if face is not None:
+                return face
+        with metrics.stage("roi_fallback"):
+            return self._detect(image)
+
+    def _detect(self, image, size=None, offset=(0, 0)):
+        bboxes, kpss = self.det_model.detect(image, input_size=size, max_num=0, metric="default")
+        if bboxes.shape[0] == 0:
+            return None
+        best = int(np.argmax(bboxes[:, 4]))
+        x, y = offset
+        return Face(bbox=bboxes[best, 0:4] + (x, y, x, y), kps=kpss[best] + (x, y) if kpss is not None else None,
+                    det_score=bboxes[best, 4])
+
+    def _region(self, image, box):
+        """Padded region around a face box hint, clipped to the image, and its detection input size"""
+        x1, y1, x2, y2 = box
+        pad_x, pad_y = (x2 - x1) * roi_padding, (y2 - y1) * roi_padding
+        image_height, image_width = image.shape[:2]
+        x1, y1 = max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y))
+        x2, y2 = min(image_width, int(x2 + pad_x)), min(image_height, int(y2 + pad_y))
+        if x2 - x1 < 32 or y2 - y1 < 32:
+            return None  # outside the image or too small to hold a detectable face
+        if not self.dynamic_det_size:
+            return x1, y1, x2, y2, None
+        longest = max(x2 - x1, y2 - y1)
+        size = next((size for size in roi_det_sizes if size >= longest), roi_det_sizes[-1])
+        size = min(size, width, height)  # never more work than the full frame pass
+        return x1, y1, x2, y2, (size, size)
+
+    def align(self, image, face):
+        """Crops and aligns the face with its landmarks to the recognition model input size (112x112)"""
+        return face_align.norm_crop(image, landmark=face.kps, image_size=self.rec_model.input_size[0])
+
+    def detect_and_align(self, image, box=None, capture=None):
+        """
+        Aligned crop of the best face in the image, None if there is no face. box: see detect(),
+        capture: the debug capture id of a sampled request, its crop is captured too
+        """
+        with metrics.stage("detection"):
+            face = self.detect(image, box)
+            if face is None:
+                return None
+            crop = self.align(image, face)
+        if capture is not None:
+            debug_capture.capture(capture, "crop", crop)
+        return crop
+
+    def embed_aligned(self, crops):
+        """Runs the recognition model once for all aligned crops, returns normalized (N, 512) embeddings"""
+        with metrics.stage("embedding"):
+            features = self.rec_model.get_feat([self._fit_crop(crop) for crop in crops])
+            return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+    def _fit_crop(self, crop):
+        # Aligned crops from other sources may come in another (square) size, alignment survives a resize
+        size = tuple(self.rec_model.input_size)
+        if crop.shape[1::-1] != size:
+            crop = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        return crop
+
+    def get_embeddings(self, images, aligned=None, boxes=None, captures=None):
+        """
+        Batched get_embedding: detection runs per image, then a single recognition inference embeds
+        every detected face. Images flagged in `aligned` are already aligned face crops and skip
+        detection, `boxes` are optional face box hints (see detect()), `captures` the debug capture ids
+        of sampled requests (see detect_and_align()). Returns one embedding per image, None where no
+        face was detected.
+        """
+        embeddings = [None] * len(images)
+        aligned = aligned or [False] * len(images)
+        boxes = boxes or [None] * len(images)
+        captures = captures or [None] * len(images)
+        crops, indexes = [], []
+        for i, (image, is_aligned, box, capture) in enumerate(zip(images, aligned, boxes, captures)):
+            if is_aligned:
+                crops.append(image)
+                indexes.append(i)
+                continue
+            crop = self.detect_and_align(image, box, capture)
+            if crop is not None:
+                crops.append(crop)
+                indexes.append(i)
+        logger.debug("Detected faces: %d/%d images", len(crops), len(images))
+
+        if crops:
+            for i, embedding in zip(indexes, self.embed_aligned(crops)):
+                embeddings[i] = embedding
+        return embeddings
+
+    def get_embedding(self, image, aligned=False, box=None):
+        return self.get_embeddings([image], [aligned], [box])[0]
@@ -0,0 +1,436 @@
+import logging
+import select
+import tempfile
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "face_embeddings_changed"
+GOOD_MATCH_THRESHOLD = 0.70
+
+
+def parse_vector(value):
+    """Turns a pgvector text value like '[0.1,0.2,...]' into a float32 array"""
+    if isinstance(value, str):
+        return np.fromstring(value.strip("[]"), dtype=np.float32, sep=",")
+    return np.asarray(value, dtype=np.float32)
+
+
+class Gallery:
+    """
+    In-process copy of the face_embeddings table.
+
+    Embeddings are kept in one contiguous float32 matrix next to an array of person ids, so a search
+    is a single matrix-vector product followed by a per-person max reduction. Postgres stays the
+    source of truth: the gallery is loaded from it at startup, updated by the db_* write functions
+    and kept in sync with other writers through LISTEN/NOTIFY.
+
+    Writers never modify rows a reader can see. Appends go into spare capacity behind the current
+    size, deletions build new arrays, so search() only needs the lock to take a snapshot.
+    """
+
+    def __init__(self, dim=512, quantization="none", rerank_candidates=200, exact_dir=None):
+        self.dim = dim
+        # "int8": rows are kept as int8 codes with one float scale per row (4x less memory), scored
+        # approximately, and the rerank_candidates best rows per query are rescored with exact vectors
+        self.quantization = quantization
+        if quantization == "int8" and rerank_candidates < 1:
+            raise ValueError(f"rerank_candidates must be at least 1, got {rerank_candidates}")
+        self.rerank_candidates = rerank_candidates
+        # int8 mode: the exact vectors come from a memory-mapped file in exact_dir (read from disk, not
+        # kept in RAM), without it from fetch_embeddings, a database round trip per search
+        self.exact_dir = exact_dir if quantization == "int8" else None
+        self.fetch_embeddings = None  # embedding ids -> {id: float32 vector}
+        self._dtype = np.int8 if quantization == "int8" else np.float32
+        self._lock = threading.RLock()
+        self._matrix = np.empty((0, dim), dtype=self._dtype)
+        self._exact = self._exact_rows(0)
+        self._scales = np.empty(0, dtype=np.float32)
+        self._embedding_ids = np.empty(0, dtype=np.int64)
+        self._person_ids = np.empty(0, dtype=np.int64)
+        self._size = 0
+        self._known_ids = set()
+        self._people = {}  # person_id -> person info dict
+        self._generation = 0  # bumped on a full reload, invalidates every flight shard
+        self._flight_versions = {}  # flight_no -> version, bumped when rows of its passengers change
+        self._shards = {}  # frozenset of flight numbers -> (versions, rows snapshot)
+        self._listener = None
+        self._stop = threading.Event()
+        self._loaded = threading.Event()
+        self.on_change = None  # called with the person id of changes received through LISTEN/NOTIFY
+
+    def __len__(self):
+        return self._size
+
+    # Loading and syncing
+
+    def load(self, engine):
+        """(Re)loads every person and embedding from the database"""
+        with engine.connect() as conn:
+            people = conn.execute(text(
+                "SELECT id, name, surname, age, nationality, flight_no, passport_no FROM people"
+            )).fetchall()
+            rows = conn.execute(text(
+                "SELECT id, person_id, embedding::text FROM face_embeddings ORDER BY id"
+            )).fetchall()
+
+        matrix = np.empty((max(len(rows), 1024), self.dim), dtype=self._dtype)
+        exact = self._exact_rows(len(matrix))
+        scales = np.ones(len(matrix), dtype=np.float32)
+        embedding_ids = np.empty(len(matrix), dtype=np.int64)
+        person_ids = np.empty(len(matrix), dtype=np.int64)
+        for i, (embedding_id, person_id, embedding) in enumerate(rows):
+            vector = parse_vector(embedding)
+            matrix[i], scales[i] = self._encode(vector)
+            if exact is not None:
+                exact[i] = vector
+            embedding_ids[i] = embedding_id
+            person_ids[i] = person_id
+
+        with self._lock:
+            self._matrix = matrix
+            self._exact = exact
+            self._scales = scales
+            self._embedding_ids = embedding_ids
+            self._person_ids = person_ids
+            self._size = len(rows)
+            self._known_ids = {int(r[0]) for r in rows}
+            self._people = {int(p[0]): _person_info(p) for p in people}
+            self._generation += 1
+        self._loaded.set()
+
+        logger.info("Gallery: Loaded %d embeddings for %d people.", len(rows), len(people))
+
+    def start_listener(self, engine, timeout=60.0):
+        """
+        Starts a background thread that applies changes made by other writers. The thread does the
+        initial load right after LISTEN, so no change can slip in between; this call waits for it.
+        """
+        if self._listener is None:
+            self._stop.clear()
+            self._listener = threading.Thread(target=self._listen, args=(engine,), daemon=True)
+            self._listener.start()
+        if not self._loaded.wait(timeout):
+            raise RuntimeError("Gallery could not be loaded from the database.")
+
+    def stop_listener(self):
+        self._stop.set()
+
+    def _listen(self, engine):
+        while not self._stop.is_set():
+            raw = None
+            try:
+                raw = engine.raw_connection()
+                raw.detach()  # autocommit connection, must not go back to the pool
+                dbapi_conn = raw.dbapi_connection
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # Changes may have been missed while we were not listening
+                self.load(engine)
+
+                while not self._stop.is_set():
+                    if select.select([dbapi_conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        notify = dbapi_conn.notifies.pop(0)
+                        self._apply_notification(engine, notify.payload)
+            except Exception as e:
+                logger.warning("Gallery: Listener error, reconnecting: %s", e)
+                time.sleep(1.0)
+            finally:
+                if raw is not None:
+                    raw.close()
+
+    def _apply_notification(self, engine, payload):
+        # payload format: "<table>:<operation>:<row id>/<person id>,...", one notification per statement
+        # (per 200 rows), applied with one fetch for all of its rows
+        table, op, entries = payload.split(":")
+        rows = [tuple(int(v) for v in entry.split("/")) for entry in entries.split(",")]
+        person_ids = sorted({person_id for _, person_id in rows})
+        if self.on_change is not None and not (table == "people" and op == "INSERT"):
+            for person_id in person_ids:
+                self.on_change(person_id)
+
+        if table == "people":
+            if op == "DELETE":
+                for person_id in person_ids:
+                    self.remove_person(person_id)
+            else:
+                self._refresh_people(engine, person_ids)
+            return
+
+        row_ids = [row_id for row_id, _ in rows]
+        if op == "DELETE":
+            self.remove_embeddings(row_ids)
+            return
+        if op == "UPDATE":
+            self.remove_embeddings(row_ids)
+        else:
+            row_ids = [row_id for row_id in row_ids if row_id not in self._known_ids]  # not our own writes
+            if not row_ids:
+                return
+
+        with engine.connect() as conn:
+            fetched = conn.execute(
+                text("SELECT id, person_id, embedding::text FROM face_embeddings WHERE id = ANY(:ids) ORDER BY id"),
+                {"ids": row_ids}
+            ).fetchall()
+        unknown = sorted({int(row[1]) for row in fetched} - self._people.keys())
+        if unknown:
+            self._refresh_people(engine, unknown)
+        for row_id, person_id, embedding in fetched:
+            self.add_embedding(int(row_id), int(person_id), parse_vector(embedding))
+
+    def _refresh_people(self, engine, person_ids):
+        with engine.connect() as conn:
+            rows = conn.execute(
+                text("""
+                    SELECT id, name, surname, age, nationality, flight_no, passport_no
+                    FROM people WHERE id = ANY(:ids)
+                """),
+                {"ids": list(person_ids)}
+            ).fetchall()
+        for row in rows:
+            self.set_person(row)
+
+    # Mutations
+
+    def set_person(self, row):
+        """Stores person info, row is (id, name, surname, age, nationality, flight_no, passport_no)"""
+        with self._lock:
+            info = _person_info(row)
+            old = self._people.get(int(row[0]))
+            self._people[int(row[0])] = info
+            if old is None or old["flight_no"] != info["flight_no"]:
+                # The person's rows move between shards (or enter one, if they came before the info)
+                self._touch_flights([info["flight_no"]] + ([old["flight_no"]] if old else []))
+
+    def add_embedding(self, embedding_id, person_id, embedding):
+        with self._lock:
+            if embedding_id in self._known_ids:
+                return
+            if self._size == len(self._matrix):
+                self._grow()
+            self._matrix[self._size], self._scales[self._size] = self._encode(embedding)
+            if self._exact is not None:
+                self._exact[self._size] = embedding
+            self._embedding_ids[self._size] = embedding_id
+            self._person_ids[self._size] = person_id
+            self._known_ids.add(embedding_id)
+            self._size += 1
+            self._touch_people([person_id])
+
+    def remove_embeddings(self, embedding_ids):
+        with self._lock:
+            if not self._known_ids.intersection(embedding_ids):
+                return
+            keep = ~np.isin(self._embedding_ids[:self._size], embedding_ids)
+            self._touch_people(np.unique(self._person_ids[:self._size][~keep]).tolist())
+            self._compact(keep)
+
+    def remove_person(self, person_id):
+        with self._lock:
+            self._touch_people([person_id])
+            self._people.pop(person_id, None)
+            keep = self._person_ids[:self._size] != person_id
+            if not keep.all():
+                self._compact(keep)
+
+    def _grow(self):
+        # Reallocate instead of resizing in place so that readers keep a consistent snapshot
+        capacity = max(1024, 2 * len(self._matrix))
+        matrix = np.empty((capacity, self.dim), dtype=self._dtype)
+        exact = self._exact_rows(capacity)
+        scales = np.ones(capacity, dtype=np.float32)
+        embedding_ids = np.empty(capacity, dtype=np.int64)
+        person_ids = np.empty(capacity, dtype=np.int64)
+        matrix[:self._size] = self._matrix[:self._size]
+        if exact is not None:
+            exact[:self._size] = self._exact[:self._size]
+        scales[:self._size] = self._scales[:self._size]
+        embedding_ids[:self._size] = self._embedding_ids[:self._size]
+        person_ids[:self._size] = self._person_ids[:self._size]
+        self._matrix, self._scales, self._embedding_ids, self._person_ids = matrix, scales, embedding_ids, person_ids
+        self._exact = exact
+
+    def _compact(self, keep):
+        size = int(keep.sum())
+        capacity = max(1024, len(self._matrix))
+        matrix = np.empty((capacity, self.dim), dtype=self._dtype)
+        exact = self._exact_rows(capacity)
+        scales = np.ones(capacity, dtype=np.float32)
+        embedding_ids = np.empty(capacity, dtype=np.int64)
+        person_ids = np.empty(capacity, dtype=np.int64)
+        matrix[:size] = self._matrix[:self._size][keep]
+        if exact is not None:
+            exact[:size] = self._exact[:self._size][keep]
+        scales[:size] = self._scales[:self._size][keep]
+        embedding_ids[:size] = self._embedding_ids[:self._size][keep]
+        person_ids[:size] = self._person_ids[:self._size][keep]
+        self._known_ids = set(embedding_ids[:size].tolist())
+        self._matrix, self._scales, self._embedding_ids, self._person_ids = matrix, scales, embedding_ids, person_ids
+        self._exact = exact
+        self._size = size
+
+    def _exact_rows(self, capacity):
+        """Float32 rows in a new memory-mapped file (int8 mode with exact_dir), None otherwise"""
+        if self.exact_dir is None:
+            return None
+        # The file is deleted when closed, the mapping keeps it until the array is dropped
+        with tempfile.NamedTemporaryFile(dir=self.exact_dir, prefix="gallery-", suffix=".f32") as f:
+            return np.memmap(f, dtype=np.float32, mode="w+", shape=(max(capacity, 1), self.dim))
+
+    def _encode(self, embedding):
+        """Row representation of an embedding: (float32 row, 1.0) or, in int8 mode, (int8 codes, scale)"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.quantization != "int8":
+            return embedding, 1.0
+        max_abs = float(np.abs(embedding).max())
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        return np.round(embedding / scale).astype(np.int8), scale
+
+    def _touch_people(self, person_ids):
+        self._touch_flights([self._people[pid]["flight_no"] for pid in person_ids if pid in self._people])
+
+    def _touch_flights(self, flights):
+        """Invalidates the shards of these flights, shards of other flights stay valid"""
+        for flight_no in flights:
+            self._flight_versions[flight_no] = self._flight_versions.get(flight_no, 0) + 1
+
+    def _rows(self):
+        """Snapshot of the current rows: (matrix, scales, person ids, embedding ids, exact rows or None)"""
+        size = self._size
+        exact = self._exact[:size] if self._exact is not None else None
+        return self._matrix[:size], self._scales[:size], self._person_ids[:size], self._embedding_ids[:size], exact
+
+    def _shard(self, flights):
+        """
+        Rows of the passengers of the given flights as their own contiguous arrays, so a scoped search
+        only touches those rows. Built on first use and rebuilt on the first search after a change to
+        the rows of one of its flights, writes for other flights leave it alone.
+        """
+        key = frozenset(flights)
+        versions = (self._generation,) + tuple(self._flight_versions.get(f, 0) for f in sorted(key))
+        shard = self._shards.get(key)
+        if shard is None or shard[0] != versions:
+            people = [pid for pid, info in self._people.items() if info["flight_no"] in key]
+            rows = np.flatnonzero(np.isin(self._person_ids[:self._size], people))
+            if len(self._shards) >= 256:
+                self._shards.clear()  # scopes are few in practice, this only guards against unbounded growth
+            shard = (versions, tuple(None if array is None else array[rows] for array in self._rows()))
+            self._shards[key] = shard
+        return shard[1]
+
+    # Search
+
+    def person_info(self, person_id):
+        return self._people.get(person_id)
+
+    def search(self, embedding, top_k=3, flights=None):
+        """
+        Returns the top_k people as a list of (person_id, best similarity) together with the number
+        of the best person's embeddings above GOOD_MATCH_THRESHOLD (used for the confidence boost).
+        flights limits the search to the passengers of those flights.
+        """
+        return self.search_many([embedding], top_k, flights)[0]
+
+    def search_many(self, embeddings, top_k=3, flights=None):
+        """search() for several embeddings with a single matrix product, returns one result per embedding"""
+        with self._lock:
+            matrix, scales, person_ids, embedding_ids, exact = self._rows() if flights is None else self._shard(flights)
+        if len(matrix) == 0:
+            return [([], 0) for _ in embeddings]
+
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if self.quantization == "int8":
+            return self._search_quantized(queries, matrix, scales, person_ids, embedding_ids, exact, top_k)
+        scores = queries @ matrix.T  # embeddings are normalized, so this is cosine similarity
+        return [_top_people(row, person_ids, top_k) for row in scores]
+
+    def _search_quantized(self, queries, codes, scales, person_ids, embedding_ids, exact, top_k):
+        """
+        Scores every row from the int8 codes, then rescores the rerank_candidates best rows of each
+        query with their exact float vectors (from the mapped file, or one fetch for all queries) and
+        ranks people on those.
+        """
+        scores = _quantized_scores(queries, codes, scales)
+        size = len(codes)
+        k = min(size, max(self.rerank_candidates, top_k))  # never fewer candidates than people asked for
+        candidates = [np.argpartition(-row, k - 1)[:k] if k < size else np.arange(size) for row in scores]
+
+        rows = np.unique(np.concatenate(candidates))
+        if exact is not None:
+            vectors = np.asarray(exact[rows])
+        else:
+            vectors = codes[rows].astype(np.float32) * scales[rows, None]  # dequantized, used if a fetch fails
+        if exact is None and self.fetch_embeddings is not None:
+            try:
+                exact = self.fetch_embeddings(embedding_ids[rows].tolist())
+                for i, embedding_id in enumerate(embedding_ids[rows].tolist()):
+                    if embedding_id in exact:
+                        vectors[i] = exact[embedding_id]
+            except Exception as e:
+                logger.warning("Gallery: exact rerank failed, using quantized scores: %s", e)
+
+        results = []
+        for query, candidate_rows in zip(queries, candidates):
+            positions = np.searchsorted(rows, candidate_rows)
+            results.append(_top_people(vectors[positions] @ query, person_ids[candidate_rows], top_k))
+        return results
+
+
+def _quantized_scores(queries, codes, scales, chunk_rows=65536):
+    """queries @ dequantized(codes).T, converting one chunk of rows at a time to keep memory flat"""
+    scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), chunk_rows):
+        end = start + chunk_rows
+        scores[:, start:end] = (queries @ codes[start:end].astype(np.float32).T) * scales[start:end]
+    return scores
+
+
+def _top_people(scores, person_ids, top_k):
+    # Sort only a small prefix of the rows, widening it until it holds top_k distinct people
+    size = len(scores)
+    window = min(size, max(top_k * 16, 64))
+    while True:
+        if window < size:
+            candidates = np.argpartition(-scores, window - 1)[:window]
+        else:
+            candidates = np.arange(size)
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        matches = []
+        seen = set()
+        for row in candidates:
+            person_id = int(person_ids[row])
+            if person_id in seen:
+                continue
+            seen.add(person_id)
+            matches.append((person_id, float(scores[row])))
+            if len(matches) == top_k:
+                break
+
+        if len(matches) == top_k or window == size:
+            break
+        window = min(size, window * 4)
+
+    best_person = matches[0][0]
+    good_match_count = int(np.count_nonzero((person_ids == best_person) & (scores > GOOD_MATCH_THRESHOLD)))
+    return matches, good_match_count
+
+
+def _person_info(row):
+    return {
+        "name": row[1],
+        "surname": row[2],
+        "age": row[3],
+        "nationality": row[4],
+        "flight_no": row[5],
+        "passport_no": row[6],
+    }
@@ -0,0 +1,74 @@
+import asyncio
+from concurrent import futures
+
+
+class InferenceScheduler:
+    """
+    Collects aligned face crops from concurrent requests into batches and runs one recognition
+    inference per batch.
+
+    A batch is closed when it reaches max_batch_size or when max_wait_ms passed since its first crop,
+    so a lone request waits at most max_wait_ms while a burst of requests shares inferences. Batches
+    run one at a time on a dedicated thread, the next batch fills up meanwhile.
+    """
+
+    def __init__(self, embed_batch, max_batch_size=32, max_wait_ms=5.0):
+        self._embed_batch = embed_batch  # callable: list of crops -> (N, 512) embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """Starts the batching loop, must be called from the server's event loop"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def embed(self, crop):
+        """Returns the normalized embedding of one aligned face crop"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((crop, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Callers that gave up (cancelled RPCs) are not worth an inference
+            batch = [(crop, future) for crop, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                embeddings = await loop.run_in_executor(
+                    self._executor, self._embed_batch, [crop for crop, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
@@ -0,0 +1,192 @@
+"""
+Prometheus metrics of the backend, served over HTTP on METRICS_PORT next to the gRPC port.
+
+- facerecognizer_rpc_duration_seconds{method}: duration of each gRPC call
+- facerecognizer_stage_duration_seconds{stage}: decode, detection, embedding, search,
+  similarity_query and confidence_boost_query
+- facerecognizer_requests_total{method, code}, facerecognizer_errors_total{method}
+- facerecognizer_recognitions_total{outcome}: match, cached, no_face, below_threshold, no_match, invalid_image
+- facerecognizer_in_flight_requests{method}, facerecognizer_executor_queue_depth,
+  facerecognizer_db_pool_checked_out
+
+METRICS_PORT=0 turns it all off. stage() and instrument_rpc() also open the tracing spans (see
+tracing.py), so they stay in place for traced calls.
+"""
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+import tracing
+
+load_dotenv()
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+ENABLED = METRICS_PORT > 0
+
+# 1 ms to 10 s, a search over a small gallery and a slow batched enrollment both fall inside
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+RPC_LATENCY = Histogram("facerecognizer_rpc_duration_seconds", "Duration of the gRPC calls", ["method"],
+                        buckets=BUCKETS)
+STAGE_LATENCY = Histogram("facerecognizer_stage_duration_seconds", "Duration of the recognition stages", ["stage"],
+                          buckets=BUCKETS)
+REQUESTS = Counter("facerecognizer_requests", "gRPC calls by status code", ["method", "code"])
+ERRORS = Counter("facerecognizer_errors", "Unexpected errors in the handlers", ["method"])
+RECOGNITIONS = Counter("facerecognizer_recognitions", "Recognized images by outcome", ["outcome"])
+SHED = Counter("facerecognizer_shed", "Calls rejected by admission control", ["lane", "reason"])
+IN_FLIGHT = Gauge("facerecognizer_in_flight_requests", "gRPC calls being handled", ["method"])
+EXECUTOR_QUEUE = Gauge("facerecognizer_executor_queue_depth", "Calls waiting for a thread of the server executor")
+DB_POOL_CHECKED_OUT = Gauge("facerecognizer_db_pool_checked_out", "Database connections in use")
+
+# Set in inference worker processes: their stage timings are sent back with each result and
+# recorded by the server process, see forward_stages()
+_forwarded = None
+
+
+def start(executor, engine):
+    """Starts the HTTP endpoint, executor is the gRPC server's thread pool, engine the SQLAlchemy engine"""
+    if not ENABLED:
+        return
+    EXECUTOR_QUEUE.set_function(lambda: executor._work_queue.qsize())
+    DB_POOL_CHECKED_OUT.set_function(lambda: engine.pool.checkedout())
+    start_http_server(METRICS_PORT)
+
+
+@contextmanager
+def stage(name):
+    """Times the with block as one observation of the given stage, and as a span when the call is traced"""
+    traced = tracing.active()
+    if not (ENABLED or traced or _forwarded is not None):
+        yield
+        return
+    start, started = time.time(), time.perf_counter()
+    try:
+        if traced:
+            with tracing.span(name):
+                yield
+        else:
+            yield
+    finally:
+        seconds = time.perf_counter() - started
+        if _forwarded is not None:
+            _forwarded.append((name, start, seconds))
+        elif ENABLED:
+            STAGE_LATENCY.labels(name).observe(seconds)
+
+
+def forward_stages():
+    """Called in a worker process: stage timings are kept for take_forwarded() instead of recorded"""
+    global _forwarded
+    _forwarded = []
+
+
+def take_forwarded():
+    """The stage timings collected since the last call, None outside of worker processes"""
+    if _forwarded is None:
+        return None
+    taken = list(_forwarded)
+    _forwarded.clear()
+    return taken
+
+
+def observe_stages(timings):
+    """Records stage timings sent back by a worker process, called on the thread of the request"""
+    for name, start, seconds in timings or ():
+        if ENABLED:
+            STAGE_LATENCY.labels(name).observe(seconds)
+        tracing.record(name, start, seconds)
+
+
+def recognition(outcome):
+    if ENABLED:
+        RECOGNITIONS.labels(outcome).inc()
+
+
+def shed(lane, reason):
+    if ENABLED:
+        SHED.labels(lane, reason).inc()
+
+
+def error(method):
+    if ENABLED:
+        ERRORS.labels(method).inc()
+
+
+def _status(context, failed):
+    code = context.code()  # set by context.set_code() or abort()
+    if code is not None:
+        return code.name
+    return "UNKNOWN" if failed else "OK"
+
+
+def instrument_rpc(handler):
+    """
+    Decorator for the servicer methods: duration, in-flight count and status code per call, and the
+    call's tracing span. Works on sync and async handlers, streaming responses are timed until the
+    last message.
+    """
+    method = handler.__name__
+    latency, in_flight = RPC_LATENCY.labels(method), IN_FLIGHT.labels(method)
+
+    def begin():
+        if ENABLED:
+            in_flight.inc()
+
+    def finish(context, started, failed):
+        if ENABLED:
+            latency.observe(time.perf_counter() - started)
+            in_flight.dec()
+            REQUESTS.labels(method, _status(context, failed)).inc()
+
+    if inspect.isasyncgenfunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, request, context):
+            started, failed = time.perf_counter(), True
+            begin()
+            try:
+                with tracing.rpc_span(method, context):
+                    async for response in handler(self, request, context):
+                        yield response
+                failed = False
+            finally:
+                finish(context, started, failed)
+    elif inspect.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, request, context):
+            started, failed = time.perf_counter(), True
+            begin()
+            try:
+                with tracing.rpc_span(method, context):
+                    response = await handler(self, request, context)
+                failed = False
+                return response
+            finally:
+                finish(context, started, failed)
+    elif inspect.isgeneratorfunction(handler):
+        @functools.wraps(handler)
+        def wrapper(self, request, context):
+            started, failed = time.perf_counter(), True
+            begin()
+            try:
+                with tracing.rpc_span(method, context):
+                    yield from handler(self, request, context)
+                failed = False
+            finally:
+                finish(context, started, failed)
+    else:
+        @functools.wraps(handler)
+        def wrapper(self, request, context):
+            started, failed = time.perf_counter(), True
+            begin()
+            try:
+                with tracing.rpc_span(method, context):
+                    response = handler(self, request, context)
+                failed = False
+                return response
+            finally:
+                finish(context, started, failed)
+    return wrapper
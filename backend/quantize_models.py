@@ -0,0 +1,249 @@
+"""
+INT8 versions of the detection and recognition models, and the accuracy check that gates them.
+
+    python quantize_models.py quantize --calibration calibration_photos/ --reference reference_photos/
+    python quantize_models.py check --reference reference_photos/
+
+quantize runs ONNX Runtime static quantization (QDQ format, per-channel int8 weights, uint8 activations)
+on the detection and recognition models of the MODEL_NAME pack. Activation ranges are calibrated on the
+images in --calibration, the recognition model on the aligned faces found in them. The models are
+written to QUANTIZED_MODEL_DIR with the pack's file names, then the check runs.
+
+check runs every image in --reference (searched recursively, one face per image) through the float32 and
+the int8 models and compares:
+- detection: images where only one of them finds a face, IoU of the face boxes
+- embeddings: cosine similarity of the float32 and int8 embedding of each face
+- matching: similarity of every pair of reference faces, how far it moved and the share of pairs that
+  changed sides of the match threshold (MIN_SIMILARITY)
+- speed: detection + embedding time per image
+The result is written to QUANTIZED_MODEL_DIR/accuracy.json. The server loads the int8 models
+(MODEL_PRECISION=int8) only if the check passed for exactly these files. Use calibration and reference
+photos from the kiosk cameras, and keep the two sets apart.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+import embedding_model
+from embedding_model import EmbeddingModel, ACCURACY_REPORT, file_digest, quantized_file
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+
+
+def _image_paths(directory):
+    paths = glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+    return sorted(path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _images(directory, limit=None):
+    for path in _image_paths(directory)[:limit]:
+        image = cv2.imread(path)
+        if image is not None:
+            yield path, image
+
+
+class _BlobReader(CalibrationDataReader):
+    """Feeds model inputs to the calibration, blobs may be a generator (full frames are a few MB each)"""
+
+    def __init__(self, input_name, blobs):
+        self._feeds = ({input_name: blob} for blob in blobs)
+
+    def get_next(self):
+        return next(self._feeds, None)
+
+
+def _float_files(model):
+    return {"detection": model.det_model.model_file, "recognition": model.rec_model.model_file}
+
+
+def _detection_blob(model, image):
+    """Detection model input for an image, the same letterboxing and normalization as RetinaFace.detect"""
+    size = (embedding_model.width, embedding_model.height)
+    scale = min(size[0] / image.shape[1], size[1] / image.shape[0])
+    resized = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)))
+    padded = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    padded[:resized.shape[0], :resized.shape[1]] = resized
+    det = model.det_model
+    return cv2.dnn.blobFromImage(padded, 1.0 / det.input_std, size, (det.input_mean,) * 3, swapRB=True)
+
+
+def _recognition_blob(model, crop):
+    """Recognition model input for an aligned crop, the same normalization as ArcFaceONNX.get_feat"""
+    rec = model.rec_model
+    return cv2.dnn.blobFromImages([model._fit_crop(crop)], 1.0 / rec.input_std, rec.input_size,
+                                  (rec.input_mean,) * 3, swapRB=True)
+
+
+def _quantize(model_file, output_file, blobs, input_name, method):
+    preprocessed = output_file + ".pre.onnx"
+    # Shape inference and graph cleanup first, as recommended for static quantization
+    quant_pre_process(model_file, preprocessed)
+    try:
+        quantize_static(preprocessed, output_file, _BlobReader(input_name, blobs), quant_format=QuantFormat.QDQ,
+                        per_channel=True, weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8,
+                        calibrate_method=method)
+    finally:
+        os.remove(preprocessed)
+    print(f"{model_file} -> {output_file} ({os.path.getsize(model_file) / 1e6:.0f} MB -> "
+          f"{os.path.getsize(output_file) / 1e6:.0f} MB)")
+
+
+def quantize(calibration_dir, limit, method):
+    model = EmbeddingModel(precision="float32")
+    rec_blobs = []
+    for path, image in _images(calibration_dir, limit):
+        crop = model.detect_and_align(image)
+        if crop is not None:
+            rec_blobs.append(_recognition_blob(model, crop))
+    if not rec_blobs:
+        raise SystemExit(f"No faces found in {calibration_dir}, nothing to calibrate with.")
+    print(f"Calibrating on the images of {calibration_dir}, {len(rec_blobs)} faces")
+
+    os.makedirs(embedding_model.quantized_model_dir, exist_ok=True)
+    # A report of older models must not vouch for the new ones
+    report_path = os.path.join(embedding_model.quantized_model_dir, ACCURACY_REPORT)
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    det_blobs = (_detection_blob(model, image) for _, image in _images(calibration_dir, limit))
+    files = _float_files(model)
+    _quantize(files["detection"], quantized_file(files["detection"]), det_blobs,
+              model.det_model.session.get_inputs()[0].name, method)
+    _quantize(files["recognition"], quantized_file(files["recognition"]), rec_blobs,
+              model.rec_model.session.get_inputs()[0].name, method)
+
+
+def _embed(model, image):
+    """(face box, embedding) of the best face, (None, None) without a face"""
+    face = model.detect(image)
+    if face is None:
+        return None, None
+    return face.bbox, model.embed_aligned([model.align(image, face)])[0]
+
+
+def _iou(a, b):
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def check(reference_dir, threshold, min_cosine, max_detection_mismatch, max_flip_rate):
+    models = {"float32": EmbeddingModel(precision="float32"), "int8": EmbeddingModel(precision="int8", check_accuracy=False)}
+    seconds = {name: 0.0 for name in models}
+    images = detection_mismatches = 0
+    ious, cosines, embeddings = [], [], {name: [] for name in models}
+    for path, image in _images(reference_dir):
+        images += 1
+        results = {}
+        for name, model in models.items():
+            started = time.perf_counter()
+            results[name] = _embed(model, image)
+            seconds[name] += time.perf_counter() - started
+
+        (float_box, float_embedding), (int8_box, int8_embedding) = results["float32"], results["int8"]
+        if (float_box is None) != (int8_box is None):
+            detection_mismatches += 1
+            print(f"Detection mismatch: {path} (face found by {'float32' if int8_box is None else 'int8'} only)")
+        elif float_box is not None:
+            ious.append(_iou(float_box, int8_box))
+            cosines.append(float(np.dot(float_embedding, int8_embedding)))
+            embeddings["float32"].append(float_embedding)
+            embeddings["int8"].append(int8_embedding)
+    if len(cosines) < 2:
+        raise SystemExit(f"Need at least two faces found by both models in {reference_dir}.")
+
+    # Similarity of every pair of reference faces with each model
+    upper = np.triu_indices(len(cosines), k=1)
+    float_similarities = (np.stack(embeddings["float32"]) @ np.stack(embeddings["float32"]).T)[upper]
+    int8_similarities = (np.stack(embeddings["int8"]) @ np.stack(embeddings["int8"]).T)[upper]
+    drift = np.abs(int8_similarities - float_similarities)
+    flips = int(np.count_nonzero((float_similarities >= threshold) != (int8_similarities >= threshold)))
+
+    results = {
+        "images": images,
+        "faces": len(cosines),
+        "detection_mismatch_rate": detection_mismatches / images,
+        "box_iou_min": float(np.min(ious)),
+        "box_iou_mean": float(np.mean(ious)),
+        "embedding_cosine_min": float(np.min(cosines)),
+        "embedding_cosine_mean": float(np.mean(cosines)),
+        "pairs": len(drift),
+        "similarity_drift_mean": float(drift.mean()),
+        "similarity_drift_max": float(drift.max()),
+        "match_threshold": threshold,
+        "decision_flips": flips,
+        "decision_flip_rate": flips / len(drift),
+        "float32_ms_per_image": seconds["float32"] * 1000.0 / images,
+        "int8_ms_per_image": seconds["int8"] * 1000.0 / images,
+        "speedup": seconds["float32"] / seconds["int8"] if seconds["int8"] > 0 else None,
+    }
+    thresholds = {
+        "embedding_cosine_min": min_cosine,
+        "detection_mismatch_rate": max_detection_mismatch,
+        "decision_flip_rate": max_flip_rate,
+    }
+    passed = (results["embedding_cosine_min"] >= min_cosine
+              and results["detection_mismatch_rate"] <= max_detection_mismatch
+              and results["decision_flip_rate"] <= max_flip_rate)
+
+    report = {
+        "passed": passed,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "onnxruntime": ort.__version__,
+        "reference": os.path.abspath(reference_dir),
+        "files": {task: file_digest(quantized_file(path)) for task, path in _float_files(models["int8"]).items()},
+        "thresholds": thresholds,
+        "results": results,
+    }
+    report_path = os.path.join(embedding_model.quantized_model_dir, ACCURACY_REPORT)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"{'PASSED' if passed else 'FAILED'}, report written to {report_path}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the face models to int8 and check their accuracy.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    quantize_parser = subparsers.add_parser("quantize", help="make the int8 models, then run the check")
+    quantize_parser.add_argument("--calibration", required=True, help="directory of calibration photos")
+    quantize_parser.add_argument("--calibration-limit", type=int, default=100,
+                                 help="max calibration photos, the calibration keeps the activations of each in memory")
+    quantize_parser.add_argument("--method", choices=sorted(CALIBRATION_METHODS), default="minmax",
+                                 help="activation range calibration")
+    for subparser in (quantize_parser, subparsers.add_parser("check", help="compare the int8 models with float32")):
+        subparser.add_argument("--reference", required=True, help="directory of reference photos, one face each")
+        subparser.add_argument("--threshold", type=float, default=float(os.getenv("MIN_SIMILARITY", 0.80)),
+                               help="match threshold whose decisions must not change (default: MIN_SIMILARITY)")
+        subparser.add_argument("--min-cosine", type=float, default=0.95,
+                               help="lowest allowed float32/int8 embedding cosine of any face")
+        subparser.add_argument("--max-detection-mismatch", type=float, default=0.01,
+                               help="highest allowed share of images where only one model finds a face")
+        subparser.add_argument("--max-flip-rate", type=float, default=0.001,
+                               help="highest allowed share of face pairs whose match decision changes")
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        quantize(args.calibration, args.calibration_limit, CALIBRATION_METHODS[args.method])
+    passed = check(args.reference, args.threshold, args.min_cosine, args.max_detection_mismatch, args.max_flip_rate)
+    raise SystemExit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
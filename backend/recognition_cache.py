@@ -0,0 +1,79 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RecognitionCache:
+    """
+    Short-lived cache of successful recognitions, keyed by embedding proximity per source (kiosk).
+
+    A passenger standing in front of a kiosk produces many nearly identical embeddings. When a new
+    embedding from the same source is at least min_similarity close to a cached one that has not
+    expired, the cached response is returned and the gallery search is skipped. Entries expire after
+    ttl seconds, the least recently used ones are evicted beyond max_entries, and every entry of a
+    person is dropped when that person's embeddings change.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3.0, min_similarity=0.95, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (source, person_id, embedding, response, expires_at), LRU order
+        self._by_source = {}  # source -> set of keys
+        self._keys = itertools.count()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def lookup(self, source, embedding):
+        """Returns the cached response for a close embedding from the same source, None on a miss"""
+        if not self.enabled:
+            return None
+        now = self._clock()
+        with self._lock:
+            keys = list(self._by_source.get(source, ()))
+            if not keys:
+                return None
+            for key in keys:
+                if self._entries[key][4] <= now:
+                    self._remove(key)
+            keys = list(self._by_source.get(source, ()))
+            if not keys:
+                return None
+
+            cached = np.stack([self._entries[key][2] for key in keys])
+            similarities = cached @ np.asarray(embedding, dtype=np.float32)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.min_similarity:
+                return None
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][3]
+
+    def store(self, source, embedding, person_id, response):
+        if not self.enabled:
+            return
+        with self._lock:
+            key = next(self._keys)
+            self._entries[key] = (source, person_id, np.asarray(embedding, dtype=np.float32), response,
+                                  self._clock() + self.ttl)
+            self._by_source.setdefault(source, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_person(self, person_id):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[1] == person_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        source = self._entries.pop(key)[0]
+        keys = self._by_source[source]
+        keys.discard(key)
+        if not keys:
+            del self._by_source[source]
@@ -1,80 +1,372 @@
 import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 from concurrent import futures
+import asyncio
 import base64
+import contextvars
 import cv2
 import numpy as np
 import time
 import os
+import signal
+import logging
 
 import facerecognizer_pb2 as pb2
 import facerecognizer_pb2_grpc as pb2_grpc
-from db import db_insert_person, db_get_person_by_passport, find_most_similar_face, db_check_person_exists, \
-    db_add_embedding, db_delete_person
+from db import db_insert_person, find_most_similar_faces, db_check_person_exists, \
+    db_add_embedding, db_insert_person_with_embeddings, load_gallery, add_person_change_listener, resolve_search_scope, \
+    engine
+from bulk_enroll import store_batch
+from inference_scheduler import InferenceScheduler
+from worker_pool import WorkerPool
+from debug_capture import debug_capture
+from recognition_cache import RecognitionCache
+import admission
+import metrics
 
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 MIN_SIMILARITY = float(os.getenv("MIN_SIMILARITY", 0.80))  # Minimum similarity threshold for face recognition, default is 0.80. Can be adjusted in .env file.
+SERVER_MODE = os.getenv("SERVER_MODE", "sync")  # "sync": thread pool server, "aio": asyncio server with batched inference
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 10))
+# Edge clients keep their channels open with keepalive pings, accept them instead of answering with GOAWAY
+SERVER_OPTIONS = [
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ("grpc.http2.max_ping_strikes", 0),
+]
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 32))  # aio mode: max faces per recognition inference
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 5))  # aio mode: max time a face waits for its batch
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))  # >0: run the models in that many worker processes
+WORKER_INTRA_OP_THREADS = int(os.getenv("WORKER_INTRA_OP_THREADS", 1))  # ONNX Runtime threads per worker process
+WORKER_CALL_TIMEOUT = float(os.getenv("WORKER_CALL_TIMEOUT", 60))  # seconds, a worker slower than this is restarted
+BULK_ENROLL_BATCH_SIZE = int(os.getenv("BULK_ENROLL_BATCH_SIZE", 200))  # BulkEnroll: people per database transaction
+BULK_ENROLL_THREADS = int(os.getenv("BULK_ENROLL_THREADS", 4))  # BulkEnroll: people decoded and embedded at once
+# Admission control: calls gRPC accepts at once, running or queued for a thread (0: no limit), over it they
+# get RESOURCE_EXHAUSTED before reaching a handler
+MAX_CONCURRENT_RPCS = int(os.getenv("MAX_CONCURRENT_RPCS", 0))
+# Calls each lane runs at once, over it they get RESOURCE_EXHAUSTED (0: no limit, calls queue for a thread).
+# Off by default, e.g. MAX_WORKERS - 1 and MAX_WORKERS / 4 keep a thread for each lane in sync mode
+RECOGNITION_CONCURRENCY = int(os.getenv("RECOGNITION_CONCURRENCY", 0))
+ENROLLMENT_CONCURRENCY = int(os.getenv("ENROLLMENT_CONCURRENCY", 0))
 
 from embedding_model import EmbeddingModel
 
-embedding_model = EmbeddingModel()
+# Short-lived cache of recognitions per kiosk, entries of a person are dropped when their embeddings change
+recognition_cache = RecognitionCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", 3.0)),  # seconds, 0 disables the cache
+    min_similarity=float(os.getenv("RESULT_CACHE_SIMILARITY", 0.95)),
+)
+add_person_change_listener(recognition_cache.invalidate_person)
+
+# Decodes the images of a RegisterCompletePerson request in parallel (cv2 releases the GIL)
+_enroll_decode_executor = futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="enroll-decode")
+
+# Created in serve(): worker processes (spawned) import this module again and must not load a model here
+embedding_model = None
+
+
+def _load_embedding_model():
+    global embedding_model
+    if INFERENCE_WORKERS > 0:
+        embedding_model = WorkerPool(INFERENCE_WORKERS, WORKER_INTRA_OP_THREADS, call_timeout=WORKER_CALL_TIMEOUT)
+    else:
+        embedding_model = EmbeddingModel()
+        embedding_model.warm_up()  # the worker processes warm up before they report ready
+
+
+def _health_services():
+    # "" is the server as a whole, load balancers and Kubernetes gRPC probes ask for it
+    return ["", pb2.DESCRIPTOR.services_by_name["FaceRecognizer"].full_name]
+
+
+def _decode_base64_image(image_base64):
+    """Decodes a base64 encoded image, returns None if it is not a valid image"""
+    with metrics.stage("decode"):
+        image_data = base64.b64decode(image_base64)
+        np_array = np.frombuffer(image_data, np.uint8)
+        return cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+
+
+def _decode_image(image):
+    """
+    Turns a v2 Image message into a BGR image, returns None if it is not a valid image.
+    Raw BGR pixels are wrapped with np.frombuffer without copying.
+    """
+    with metrics.stage("decode"):
+        return _decode_image_data(image)
+
+
+def _decode_image_data(image):
+    kind = image.WhichOneof("data")
+    if kind == "encoded":
+        return cv2.imdecode(np.frombuffer(image.encoded, np.uint8), cv2.IMREAD_COLOR)
+    if kind != "raw":
+        return None
+
+    raw = image.raw
+    channels = 1 if raw.layout == pb2.RawImage.GRAY else 3
+    if raw.width <= 0 or raw.height <= 0 or len(raw.data) != raw.width * raw.height * channels:
+        return None
+    pixels = np.frombuffer(raw.data, np.uint8).reshape(raw.height, raw.width, channels)
+    if raw.layout == pb2.RawImage.RGB:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+    if raw.layout == pb2.RawImage.GRAY:
+        return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+    return pixels
+
+
+def _safe_decode(decode, image_item):
+    """decode that returns None instead of raising (e.g. invalid base64)"""
+    try:
+        return decode(image_item)
+    except Exception:
+        return None
+
+
+def _is_aligned(image_item):
+    """True when a request image is a pre-aligned face crop (v2 Image messages only)"""
+    return isinstance(image_item, pb2.Image) and image_item.aligned_face
+
+
+def _face_box(message):
+    """Face box hint of a v2 Image or a v1 FaceRequest as (x1, y1, x2, y2), None when it is not set"""
+    if not isinstance(message, (pb2.Image, pb2.FaceRequest)) or not message.HasField("face_box"):
+        return None
+    box = message.face_box
+    if box.width <= 0 or box.height <= 0:
+        return None
+    return box.x, box.y, box.x + box.width, box.y + box.height
+
+
+def _request_source(request, context):
+    """The kiosk a request comes from, used to scope the result cache. Falls back to the client address"""
+    return request.source_id or context.peer()
+
+
+def _request_scope(request):
+    """The SearchScope of a recognition request, None when the whole gallery is searched"""
+    return request.scope if request.HasField("scope") else None
+
+
+def _recognize_images(images, aligned=None, sources=None, scope=None, boxes=None):
+    """
+    Recognizes decoded images (None for images that failed to decode) with one batched embedding
+    inference and one gallery search. `aligned` flags pre-aligned face crops, which skip detection,
+    `sources` are the kiosks the images come from (result cache), `scope` limits the search to some flights,
+    `boxes` are face box hints (or None) that narrow down detection.
+    Returns a (status code, details, FaceResponse) tuple per image.
+    """
+    aligned = aligned or [False] * len(images)
+    boxes = boxes or [None] * len(images)
+    outcomes, valid, captures = _decode_outcomes(images)
+    admission.check_deadline("detection")
+    embeddings = embedding_model.get_embeddings([images[i] for i in valid], [aligned[i] for i in valid],
+                                                [boxes[i] for i in valid], [captures[i] for i in valid])
+    admission.check_deadline("search")
+    _search_outcomes(outcomes, valid, embeddings, sources, scope)
+    return outcomes
+
+
+def _decode_outcomes(images):
+    """
+    Sets the outcome of images that failed to decode. Returns the outcomes, the indexes of the other
+    images, and per image the debug capture id if the request was sampled (see DebugCapture.sample())
+    """
+    outcomes = [None] * len(images)
+    captures = [None] * len(images)
+    valid = []
+    for i, image in enumerate(images):
+        if image is None:
+            metrics.recognition("invalid_image")
+            outcomes[i] = (grpc.StatusCode.INVALID_ARGUMENT, 'Image data is not a valid image (decode error).',
+                           pb2.FaceResponse())
+        else:
+            valid.append(i)
+            captures[i] = debug_capture.sample()
+            if captures[i] is not None:
+                debug_capture.capture(captures[i], "request", image)
+    return outcomes, valid, captures
+
+
+def _search_outcomes(outcomes, indexes, embeddings, sources=None, scope=None):
+    """
+    Sets the outcome of the images at indexes from their embeddings (None: no face). Embeddings close
+    to a recent match from the same source are answered from the cache, the rest with one gallery search.
+    """
+    sources = sources or [""] * len(outcomes)
+    flights = resolve_search_scope(scope.flight_nos, scope.checkpoint_id) if scope is not None else None
+    if flights is not None:
+        # A cached match is only valid for the scope it was searched in
+        scope_key = "|" + ",".join(sorted(flights))
+        sources = [source + scope_key for source in sources]
+    detected = []
+    for i, embedding in zip(indexes, embeddings):
+        if embedding is None:
+            metrics.recognition("no_face")
+            outcomes[i] = (grpc.StatusCode.NOT_FOUND, 'No face detected in the image', pb2.FaceResponse())
+            continue
+        cached = recognition_cache.lookup(sources[i], embedding)
+        if cached is not None:
+            metrics.recognition("cached")
+            outcomes[i] = (grpc.StatusCode.OK, '', cached)
+        else:
+            detected.append((i, embedding))
+
+    results = find_most_similar_faces([embedding for _, embedding in detected], flights=flights)
+    for (i, embedding), result in zip(detected, results):
+        outcomes[i] = _match_outcome(result)
+        if outcomes[i][0] == grpc.StatusCode.OK:
+            recognition_cache.store(sources[i], embedding, result["person_id"], outcomes[i][2])
+
+
+def _match_outcome(result):
+    if not result:
+        metrics.recognition("no_match")
+        return grpc.StatusCode.NOT_FOUND, 'No match found in database', pb2.FaceResponse()
+
+    if result["similarity"] < MIN_SIMILARITY:
+        metrics.recognition("below_threshold")
+        logger.debug("similarity: %s similiar person: %s %s", result["similarity"], result["name"], result["surname"])
+        return grpc.StatusCode.NOT_FOUND, 'Below minimum similarity threshold.', pb2.FaceResponse()
+
+    # Found a match, return the response, flight_no can be empty
+    metrics.recognition("match")
+    return grpc.StatusCode.OK, '', pb2.FaceResponse(
+        name=result["name"],
+        surname=result["surname"],
+        age=result["age"],
+        nationality=result["nationality"],
+        flight_no=result["flight_no"] or "",
+        passport_no=result["passport_no"],
+        similarity=result["similarity"],
+    )
+
+
+def _apply_outcome(context, outcome):
+    """Returns the response of a unary recognition call, failures are reported through the call status"""
+    code, details, response = outcome
+    if code != grpc.StatusCode.OK:
+        context.set_code(code)
+        context.set_details(details)
+    return response
+
+
+def _face_result(outcome):
+    code, details, response = outcome
+    if code == grpc.StatusCode.OK:
+        return pb2.FaceResult(success=True, face=response)
+    return pb2.FaceResult(success=False, message=details)
 
 
 class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
     def Recognize(self, request, context):
         try:
-            image_data = base64.b64decode(request.image_base64)
+            image = _decode_base64_image(request.image_base64)
+            outcomes = _recognize_images([image], sources=[_request_source(request, context)],
+                                         scope=_request_scope(request), boxes=[_face_box(request)])
+            return _apply_outcome(context, outcomes[0])
+        except Exception:
+            logger.exception("Recognize failed")
+            metrics.error("Recognize")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceResponse()
 
-            with open("recived_image.jpg", "wb") as f:  # Debugging
-                f.write(image_data)
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    def RecognizeBatch(self, request, context):
+        try:
+            images = [_decode_base64_image(image_base64) for image_base64 in request.images]
+            sources = [_request_source(request, context)] * len(images)
+            outcomes = _recognize_images(images, sources=sources, scope=_request_scope(request))
+            return pb2.FaceBatchResponse(results=[_face_result(o) for o in outcomes])
+        except Exception:
+            logger.exception("RecognizeBatch failed")
+            metrics.error("RecognizeBatch")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceBatchResponse()
 
-            np_array = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-            if image is None:
-                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-                context.set_details('Image data is not a valid image (decode error).')
-                return pb2.FaceResponse()
-            embedding = embedding_model.get_embedding(image)
-            if embedding is None:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details('No face detected in the image')
-                return pb2.FaceResponse()
-
-            result = find_most_similar_face(embedding)
-            if not result:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details('No match found in database')
-                return pb2.FaceResponse()
-
-            if result["similarity"] < MIN_SIMILARITY:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                print("similarity:", result["similarity"], " similiar person:", result["name"], result["surname"])
-                context.set_details('Below minimum similarity threshold.')
-                return pb2.FaceResponse()
-
-            # Found a match, return the response, flight_no can be empty
-            return pb2.FaceResponse(
-                name=result["name"],
-                surname=result["surname"],
-                age=result["age"],
-                nationality=result["nationality"],
-                flight_no=result["flight_no"] or "",
-                passport_no=result["passport_no"],
-                similarity=result["similarity"],
-            )
-        except Exception as e:
-            print(f"[ERROR] {str(e)}")
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    def RecognizeStream(self, request_iterator, context):
+        for request in request_iterator:
+            try:
+                with admission.message_slot("recognition"):
+                    image = _decode_base64_image(request.image_base64)
+                    outcomes = _recognize_images([image], sources=[_request_source(request, context)],
+                                                 scope=_request_scope(request), boxes=[_face_box(request)])
+                yield _face_result(outcomes[0])
+            except admission.LaneFull:
+                yield pb2.FaceResult(success=False, message='Server busy, try again later.')
+            except Exception:
+                logger.exception("RecognizeStream failed")
+                metrics.error("RecognizeStream")
+                yield pb2.FaceResult(success=False, message='An error occured.')
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    def RecognizeV2(self, request, context):
+        try:
+            image = _decode_image(request.image)
+            outcomes = _recognize_images([image], [_is_aligned(request.image)], [_request_source(request, context)],
+                                         _request_scope(request), [_face_box(request.image)])
+            return _apply_outcome(context, outcomes[0])
+        except Exception:
+            logger.exception("RecognizeV2 failed")
+            metrics.error("RecognizeV2")
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details('An error occured.')
             return pb2.FaceResponse()
 
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    def RecognizeBatchV2(self, request, context):
+        try:
+            images = [_decode_image(image) for image in request.images]
+            aligned = [_is_aligned(image) for image in request.images]
+            sources = [_request_source(request, context)] * len(images)
+            boxes = [_face_box(image) for image in request.images]
+            outcomes = _recognize_images(images, aligned, sources, _request_scope(request), boxes)
+            return pb2.FaceBatchResponse(results=[_face_result(o) for o in outcomes])
+        except Exception:
+            logger.exception("RecognizeBatchV2 failed")
+            metrics.error("RecognizeBatchV2")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceBatchResponse()
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    def RecognizeStreamV2(self, request_iterator, context):
+        for request in request_iterator:
+            try:
+                with admission.message_slot("recognition"):
+                    image = _decode_image(request.image)
+                    outcomes = _recognize_images([image], [_is_aligned(request.image)],
+                                                 [_request_source(request, context)], _request_scope(request),
+                                                 [_face_box(request.image)])
+                yield _face_result(outcomes[0])
+            except admission.LaneFull:
+                yield pb2.FaceResult(success=False, message='Server busy, try again later.')
+            except Exception:
+                logger.exception("RecognizeStreamV2 failed")
+                metrics.error("RecognizeStreamV2")
+                yield pb2.FaceResult(success=False, message='An error occured.')
+
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
     def RegisterPerson(self, request, context):
         try:
             # 1. Decoding and embedding
-            image_data = base64.b64decode(request.image_base64)
-            np_array = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+            image = _decode_base64_image(request.image_base64)
             if image is None:
                 return pb2.RegisterPersonResponse(
                     success=False,
@@ -106,37 +398,39 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                 'embedding': embedding
             })
 
-            # Debugging: print the person_id
-            print(f"Server: Returning person id from db_insert_person: {person_id}")
-
-            response = pb2.RegisterPersonResponse(
+            logger.debug("Registered person id: %s", person_id)
+            return pb2.RegisterPersonResponse(
                 success=True,
                 message="Person successfully registered.",
                 person_id=person_id
             )
 
-            # Debugging: print the person_id from the response
-            print(f"Server: Person id in response: {response.person_id}")
-
-            return response
-
-        except Exception as e:
-            print(f"[ERROR] {str(e)}") # Log the error on the server side
+        except Exception:
+            logger.exception("RegisterPerson failed")
+            metrics.error("RegisterPerson")
             return pb2.RegisterPersonResponse(
                 success=False,
                 message="An error occured.",
                 person_id=0
             )
 
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
     def AddEmbedding(self, request, context):
         """
         Service to add a new embedding for an existing person.
         """
+        return self._add_embedding(request.person_id, request.image_base64, _decode_base64_image)
+
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
+    def AddEmbeddingV2(self, request, context):
+        return self._add_embedding(request.person_id, request.image, _decode_image)
+
+    def _add_embedding(self, person_id, image_item, decode):
         try:
-            # 1 Decode the image from base64
-            image_data = base64.b64decode(request.image_base64)
-            np_array = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+            # 1 Decode the image
+            image = decode(image_item)
 
             if image is None:
                 return pb2.AddEmbeddingResponse(
@@ -145,7 +439,8 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                 )
 
             # 2 Getting the embedding from the image
-            embedding = embedding_model.get_embedding(image)
+            admission.check_deadline("detection")
+            embedding = embedding_model.get_embedding(image, aligned=_is_aligned(image_item), box=_face_box(image_item))
             if embedding is None:
                 return pb2.AddEmbeddingResponse(
                     success=False,
@@ -153,7 +448,6 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                 )
 
             # 3. Check if the person exists in the database
-            person_id = request.person_id
             if not db_check_person_exists(person_id):
                 return pb2.AddEmbeddingResponse(
                     success=False,
@@ -169,17 +463,89 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
             )
 
 
-        except Exception as e:
+        except Exception:
 
-            print(f"[ERROR] {str(e)}")  # Log the error on the server side
+            logger.exception("AddEmbedding failed")
+            metrics.error("AddEmbedding")
 
-            return pb2.RegisterPersonResponse(
+            return pb2.AddEmbeddingResponse(
                 success=False,
-                message="An error occurred while adding embedding.",
-                person_id=0
+                message="An error occurred while adding embedding."
             )
 
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
     def RegisterCompletePerson(self, request, context):
+        return self._register_complete_person(request, _decode_base64_image, context)
+
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
+    def RegisterCompletePersonV2(self, request, context):
+        return self._register_complete_person(request, _decode_image, context)
+
+    @metrics.instrument_rpc
+    @admission.lane("enrollment")
+    def BulkEnroll(self, request_iterator, context):
+        enrolled = skipped = 0
+        errors = []
+
+        def embed(request):
+            """Returns (embeddings, error) for one person"""
+            try:
+                images = [(_decode_image(item), _is_aligned(item), _face_box(item)) for item in request.images]
+                images = [(image, aligned, box) for image, aligned, box in images if image is not None]
+                if not images:
+                    return [], None
+                embeddings = embedding_model.get_embeddings([image for image, _, _ in images],
+                                                            [aligned for _, aligned, _ in images],
+                                                            [box for _, _, box in images])
+                return [embedding for embedding in embeddings if embedding is not None], None
+            except Exception as e:
+                return None, f"Embedding error: {str(e)}"
+
+        def store(batch, pool):
+            nonlocal enrolled, skipped
+            rows = []
+            # Decoding and detection run concurrently, with INFERENCE_WORKERS they spread over the workers
+            for (index, request), (embeddings, error) in zip(batch, pool.map(embed, [r for _, r in batch])):
+                if error is not None:
+                    errors.append(pb2.BulkEnrollError(index=index, passport_no=request.passport_no, message=error))
+                    continue
+                rows.append((index, {
+                    'name': request.name,
+                    'surname': request.surname,
+                    'age': request.age,
+                    'nationality': request.nationality,
+                    'flight_no': request.flight_no if request.HasField('flight_no') else None,
+                    'passport_no': request.passport_no,
+                }, embeddings))
+
+            batch_enrolled, batch_skipped, batch_errors = store_batch(rows)
+            enrolled += batch_enrolled
+            skipped += batch_skipped
+            errors.extend(pb2.BulkEnrollError(index=index, passport_no=passport_no, message=message)
+                          for index, passport_no, message in batch_errors)
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=BULK_ENROLL_THREADS) as pool:
+                batch = []
+                for index, request in enumerate(request_iterator):
+                    batch.append((index, request))
+                    if len(batch) >= BULK_ENROLL_BATCH_SIZE:
+                        store(batch, pool)
+                        batch = []
+                if batch:
+                    store(batch, pool)
+        except Exception as e:
+            # Batches stored so far stay committed, the counts tell the client where it stopped
+            logger.exception("BulkEnroll failed")
+            metrics.error("BulkEnroll")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(f"Bulk enrollment stopped after {enrolled + skipped} people: {str(e)}")
+
+        return pb2.BulkEnrollResponse(enrolled=enrolled, skipped=skipped, failed=len(errors), errors=errors)
+
+    def _register_complete_person(self, request, decode, context):
         try:
             images = request.images
 
@@ -192,13 +558,12 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                     person_id=0
                 )
 
-            # Get first images embedding
-            first_image = images[0]
-            image_data = base64.b64decode(first_image)
-            np_array = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-
-            if image is None:
+            # Decode all images concurrently, then embed them with one batched recognition inference
+            trace_context = contextvars.copy_context()  # one copy per image, a context can't be entered twice at once
+            decoded = list(_enroll_decode_executor.map(
+                lambda item: trace_context.copy().run(_safe_decode, decode, item), images
+            ))
+            if decoded[0] is None:
                 context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
                 context.set_details("First image is not a valid image (decode error).")
                 return pb2.RegisterCompletePersonResponse(
@@ -207,8 +572,13 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                     person_id=0
                 )
 
-            embedding = embedding_model.get_embedding(image)
-            if embedding is None:
+            indexes = [i for i, image in enumerate(decoded) if image is not None]
+            admission.check_deadline("detection")
+            embeddings = dict(zip(indexes, embedding_model.get_embeddings(
+                [decoded[i] for i in indexes], [_is_aligned(images[i]) for i in indexes],
+                [_face_box(images[i]) for i in indexes]
+            )))
+            if embeddings[0] is None:
                 context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
                 context.set_details("Can't detect face on the first image.")
                 return pb2.RegisterCompletePersonResponse(
@@ -217,33 +587,24 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                     person_id=0
                 )
 
+            for i in range(1, len(images)):
+                if decoded[i] is None:
+                    logger.info("Error in %d. embedding: not a valid image.", i + 1)
+                elif embeddings[i] is None:
+                    logger.info("Can't detect face in %d. embedding.", i + 1)
+
+            # The edge gave up on this registration, don't store a person it will register again
+            admission.check_deadline("database insert")
             try:
-                # Initilaze DB operation
-                person_id = db_insert_person({
+                # Person and embeddings in one transaction, nothing to revert if it fails
+                person_id = db_insert_person_with_embeddings({
                     'name': request.name,
                     'surname': request.surname,
                     'age': request.age,
                     'nationality': request.nationality,
                     'flight_no': request.flight_no,
                     'passport_no': request.passport_no,
-                    'embedding': embedding
-                })
-
-                # Other images processing
-                for i, image_base64 in enumerate(images[1:], 1):
-                    try:
-                        image_data = base64.b64decode(image_base64)
-                        np_array = np.frombuffer(image_data, np.uint8)
-                        image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-
-                        if image is not None:
-                            embedding = embedding_model.get_embedding(image)
-                            if embedding is not None:
-                                db_add_embedding(person_id, embedding)
-                            else:
-                                print(f"Can't detect face in {i + 1}. embedding.")
-                    except Exception as e:
-                        print(f"Error in {i + 1}. embedding: {str(e)}")
+                }, [embeddings[i] for i in indexes if embeddings[i] is not None])
 
                 return pb2.RegisterCompletePersonResponse(
                     success=True,
@@ -252,18 +613,19 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
                 )
 
             except Exception as e:
-                # When an error occurs, delete the person from the database
-                db_delete_person(person_id if 'person_id' in locals() else None)
-
+                logger.exception("RegisterCompletePerson: storing failed")
+                metrics.error("RegisterCompletePerson")
                 context.set_code(grpc.StatusCode.INTERNAL)
-                context.set_details(f"Error in register process. Reverting changes in database: {str(e)}")
+                context.set_details(f"Error in register process, nothing was stored: {str(e)}")
                 return pb2.RegisterCompletePersonResponse(
                     success=False,
-                    message=f"Error in register process. Reverting changes in database: {str(e)}",
+                    message=f"Error in register process, nothing was stored: {str(e)}",
                     person_id=0
                 )
 
         except Exception as e:
+            logger.exception("RegisterCompletePerson failed")
+            metrics.error("RegisterCompletePerson")
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f"Unexpected error: {str(e)}")
             return pb2.RegisterCompletePersonResponse(
@@ -273,20 +635,214 @@ class FaceRecognizerService(pb2_grpc.FaceRecognizerServicer):
             )
 
 
+class AsyncFaceRecognizerService(FaceRecognizerService):
+    """
+    Recognition RPCs for the grpc.aio server. Decoding, detection and the gallery search run on the
+    thread pool, the recognition model runs through the InferenceScheduler, so faces of concurrent
+    requests share batched inferences. Enrollment RPCs are the inherited sync handlers, grpc.aio runs
+    them on the same thread pool.
+    """
+
+    def __init__(self, scheduler, executor):
+        self._scheduler = scheduler
+        self._executor = executor
+
+    async def _run(self, fn, *args):
+        # The thread runs fn in a copy of this task's context, so its spans join the call's trace
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, fn, *args)
+
+    async def _embed(self, image, aligned, box=None, capture=None):
+        crop = image if aligned else await self._run(embedding_model.detect_and_align, image, box, capture)
+        if crop is None:
+            return None
+        return await self._scheduler.embed(crop)
+
+    async def _recognize_images(self, images, aligned=None, sources=None, scope=None, boxes=None):
+        aligned = aligned or [False] * len(images)
+        boxes = boxes or [None] * len(images)
+        outcomes, valid, captures = _decode_outcomes(images)
+        admission.check_deadline("detection")
+        embeddings = await asyncio.gather(*(self._embed(images[i], aligned[i], boxes[i], captures[i]) for i in valid))
+        admission.check_deadline("search")
+        await self._run(_search_outcomes, outcomes, valid, embeddings, sources, scope)
+        return outcomes
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def Recognize(self, request, context):
+        try:
+            image = await self._run(_decode_base64_image, request.image_base64)
+            outcomes = await self._recognize_images([image], sources=[_request_source(request, context)],
+                                                    scope=_request_scope(request), boxes=[_face_box(request)])
+            return _apply_outcome(context, outcomes[0])
+        except Exception:
+            logger.exception("Recognize failed")
+            metrics.error("Recognize")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceResponse()
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def RecognizeV2(self, request, context):
+        try:
+            image = await self._run(_decode_image, request.image)
+            outcomes = await self._recognize_images([image], [_is_aligned(request.image)],
+                                                    [_request_source(request, context)], _request_scope(request),
+                                                    [_face_box(request.image)])
+            return _apply_outcome(context, outcomes[0])
+        except Exception:
+            logger.exception("RecognizeV2 failed")
+            metrics.error("RecognizeV2")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceResponse()
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def RecognizeBatch(self, request, context):
+        try:
+            images = await self._run(lambda: [_decode_base64_image(image) for image in request.images])
+            outcomes = await self._recognize_images(images, sources=[_request_source(request, context)] * len(images),
+                                                    scope=_request_scope(request))
+            return pb2.FaceBatchResponse(results=[_face_result(o) for o in outcomes])
+        except Exception:
+            logger.exception("RecognizeBatch failed")
+            metrics.error("RecognizeBatch")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceBatchResponse()
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def RecognizeBatchV2(self, request, context):
+        try:
+            images = await self._run(lambda: [_decode_image(image) for image in request.images])
+            aligned = [_is_aligned(image) for image in request.images]
+            boxes = [_face_box(image) for image in request.images]
+            outcomes = await self._recognize_images(images, aligned, [_request_source(request, context)] * len(images),
+                                                    _request_scope(request), boxes)
+            return pb2.FaceBatchResponse(results=[_face_result(o) for o in outcomes])
+        except Exception:
+            logger.exception("RecognizeBatchV2 failed")
+            metrics.error("RecognizeBatchV2")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details('An error occured.')
+            return pb2.FaceBatchResponse()
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def RecognizeStream(self, request_iterator, context):
+        async for request in request_iterator:
+            try:
+                with admission.message_slot("recognition"):
+                    image = await self._run(_decode_base64_image, request.image_base64)
+                    outcomes = await self._recognize_images([image], sources=[_request_source(request, context)],
+                                                            scope=_request_scope(request), boxes=[_face_box(request)])
+                yield _face_result(outcomes[0])
+            except admission.LaneFull:
+                yield pb2.FaceResult(success=False, message='Server busy, try again later.')
+            except Exception:
+                logger.exception("RecognizeStream failed")
+                metrics.error("RecognizeStream")
+                yield pb2.FaceResult(success=False, message='An error occured.')
+
+    @metrics.instrument_rpc
+    @admission.lane("recognition")
+    async def RecognizeStreamV2(self, request_iterator, context):
+        async for request in request_iterator:
+            try:
+                with admission.message_slot("recognition"):
+                    image = await self._run(_decode_image, request.image)
+                    outcomes = await self._recognize_images([image], [_is_aligned(request.image)],
+                                                            [_request_source(request, context)],
+                                                            _request_scope(request), [_face_box(request.image)])
+                yield _face_result(outcomes[0])
+            except admission.LaneFull:
+                yield pb2.FaceResult(success=False, message='Server busy, try again later.')
+            except Exception:
+                logger.exception("RecognizeStreamV2 failed")
+                metrics.error("RecognizeStreamV2")
+                yield pb2.FaceResult(success=False, message='An error occured.')
+
+
+async def serve_aio():
+    _load_embedding_model()
+
+    # Load the in-memory gallery before accepting requests (only when SEARCH_MODE=memory)
+    load_gallery()
+
+    executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    scheduler = InferenceScheduler(embedding_model.embed_aligned, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+    scheduler.start()
+
+    # Sync handlers (enrollment) run on the migration thread pool
+    admission.configure(recognition=RECOGNITION_CONCURRENCY, enrollment=ENROLLMENT_CONCURRENCY)
+    server = grpc.aio.server(migration_thread_pool=executor, options=SERVER_OPTIONS,
+                             maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS or None)
+    pb2_grpc.add_FaceRecognizerServicer_to_server(AsyncFaceRecognizerService(scheduler, executor), server)
+    health_servicer = health.aio.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+
+    server.add_insecure_port('[::]:50051')
+    await server.start()
+    metrics.start(executor, engine)
+    # Models are loaded and warmed up and the gallery is in memory, traffic can be routed here
+    for service in _health_services():
+        await health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+
+    logger.info("Async server started on port 50051 (batch size: %d, max wait: %s ms)", BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+    try:
+        await server.wait_for_termination()
+    finally:
+        await health_servicer.enter_graceful_shutdown()
+        await scheduler.stop()
+
+
+def _dump_debug_captures(signum, frame):
+    count = debug_capture.dump()
+    logger.info("Dumping %d debug captures to %s", count, debug_capture.output_dir)
+
+
 def serve():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # kill -USR1 <pid> writes the debug capture buffer to disk (not available on Windows)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, _dump_debug_captures)
+
+    if SERVER_MODE == "aio":
+        asyncio.run(serve_aio())
+        return
+
+    _load_embedding_model()
+
+    # Load the in-memory gallery before accepting requests (only when SEARCH_MODE=memory)
+    load_gallery()
+
     # Create a gRPC server and add the FaceRecognizerService to it
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10)) # Adjust max_workers as needed
+    executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)  # Adjust MAX_WORKERS as needed
+    admission.configure(recognition=RECOGNITION_CONCURRENCY, enrollment=ENROLLMENT_CONCURRENCY)
+    server = grpc.server(executor, options=SERVER_OPTIONS, maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS or None)
     pb2_grpc.add_FaceRecognizerServicer_to_server(FaceRecognizerService(), server)
+    health_servicer = health.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
 
     server.add_insecure_port('[::]:50051') # Listen on all interfaces on port 50051, no TLS encryption
     server.start()
+    metrics.start(executor, engine)
+    # Models are loaded and warmed up and the gallery is in memory, traffic can be routed here
+    for service in _health_services():
+        health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
 
-    print("Server started on port 50051")
+    logger.info("Server started on port 50051")
 
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
+        health_servicer.enter_graceful_shutdown()
         server.stop(0)
 
 
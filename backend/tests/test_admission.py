@@ -0,0 +1,254 @@
+import asyncio
+import time
+
+import grpc
+import pytest
+
+import admission
+
+
+class Aborted(Exception):
+    """What abort() raises in the sync server and in grpc.aio"""
+
+
+class _Context:
+    """Servicer context of the sync server, abort() raises"""
+
+    def __init__(self, time_remaining=None):
+        self._time_remaining = time_remaining
+        self.code = None
+        self.details = None
+
+    def time_remaining(self):
+        return self._time_remaining
+
+    def abort(self, code, details):
+        self.code, self.details = code, details
+        raise Aborted()
+
+
+class _AioSyncContext(_Context):
+    """Context the aio server gives sync handlers on its thread pool, abort() only records the status"""
+
+    def abort(self, code, details):
+        self.code, self.details = code, details
+
+
+class _AsyncContext(_Context):
+    async def abort(self, code, details):
+        self.code, self.details = code, details
+        raise Aborted()
+
+
+@pytest.fixture(autouse=True)
+def lanes():
+    admission.configure(recognition=1, enrollment=1)
+    yield admission.LANES
+    admission.configure(recognition=0, enrollment=0)
+    for lane in admission.LANES.values():
+        assert lane.active == 0, f"{lane.name} lane kept {lane.active} slot(s)"
+
+
+class _Service:
+    """Handlers for every wrapper variant, behaviour picked by the request"""
+
+    @admission.lane("recognition")
+    def Unary(self, request, context):
+        assert admission.LANES["recognition"].active == 1
+        return _act(request)
+
+    @admission.lane("recognition")
+    def Stream(self, request_iterator, context):
+        for request in request_iterator:
+            with admission.message_slot("recognition"):
+                response = _act(request)
+            yield response
+
+    @admission.lane("enrollment")
+    async def AsyncUnary(self, request, context):
+        assert admission.LANES["enrollment"].active == 1
+        await asyncio.sleep(0)
+        return _act(request)
+
+    @admission.lane("recognition")
+    async def AsyncStream(self, request_iterator, context):
+        for request in request_iterator:
+            with admission.message_slot("recognition"):
+                await asyncio.sleep(0)
+                response = _act(request)
+            yield response
+
+
+def _act(request):
+    if request == "fail":
+        raise ValueError("handler error")
+    if request == "deadline":
+        raise admission.DeadlineExpired("detection")
+    if request == "slow":
+        time.sleep(0.05)
+        admission.check_deadline("search")
+    return f"ok {request}"
+
+
+service = _Service()
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def _collect(stream):
+    return [response async for response in stream]
+
+
+# Sync unary
+
+def test_unary_releases_its_slot_on_return_and_error():
+    assert service.Unary("a", _Context()) == "ok a"
+    assert admission.LANES["recognition"].active == 0
+    with pytest.raises(ValueError):
+        service.Unary("fail", _Context())
+    assert admission.LANES["recognition"].active == 0
+    assert admission._deadline.get() is None
+
+
+def test_unary_over_the_limit_is_rejected():
+    admission.LANES["recognition"].try_enter()  # another call holds the only slot
+    try:
+        context = _Context()
+        with pytest.raises(Aborted):
+            service.Unary("a", context)
+        assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+    finally:
+        admission.LANES["recognition"].leave()
+
+
+def test_unary_without_a_limit_is_not_rejected():
+    admission.configure(recognition=0)
+    admission.LANES["recognition"].try_enter()
+    try:
+        assert admission.LANES["recognition"].try_enter()
+        admission.LANES["recognition"].leave()
+    finally:
+        admission.LANES["recognition"].leave()
+
+
+def test_expired_deadline_becomes_deadline_exceeded():
+    context = _Context(time_remaining=10.0)
+    with pytest.raises(Aborted):
+        service.Unary("deadline", context)
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert "detection" in context.details
+
+
+def test_check_deadline_after_the_deadline_passed():
+    context = _Context(time_remaining=0.01)
+    with pytest.raises(Aborted):
+        service.Unary("slow", context)
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert "search" in context.details
+    assert admission._deadline.get() is None  # the next call on this thread starts without it
+
+
+def test_call_started_after_its_deadline_is_dropped():
+    context = _Context(time_remaining=0.0)
+    with pytest.raises(Aborted):
+        service.Unary("a", context)
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+def test_aio_server_sync_handler_returns_none_after_abort():
+    # abort() doesn't raise here, the wrapper must return instead of running the handler
+    admission.LANES["recognition"].try_enter()
+    try:
+        context = _AioSyncContext()
+        assert service.Unary("a", context) is None
+        assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+    finally:
+        admission.LANES["recognition"].leave()
+
+    context = _AioSyncContext(time_remaining=10.0)
+    assert service.Unary("deadline", context) is None
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+# Sync streams: no slot while open, one per message
+
+def test_stream_takes_a_slot_per_message():
+    stream = service.Stream(iter(["a", "b"]), _Context())
+    assert next(stream) == "ok a"
+    assert admission.LANES["recognition"].active == 0  # open, between messages
+    assert service.Unary("c", _Context()) == "ok c"  # a unary call still gets the lane's only slot
+    assert list(stream) == ["ok b"]
+
+
+def test_stream_message_over_the_limit():
+    admission.LANES["recognition"].try_enter()
+    try:
+        with pytest.raises(admission.LaneFull):
+            list(service.Stream(iter(["a"]), _Context()))
+    finally:
+        admission.LANES["recognition"].leave()
+
+
+def test_stream_releases_slots_on_error_close_and_deadline():
+    with pytest.raises(ValueError):
+        list(service.Stream(iter(["a", "fail", "b"]), _Context()))
+
+    stream = service.Stream(iter(["a", "b", "c"]), _Context())
+    next(stream)
+    stream.close()  # the client went away
+
+    context = _Context(time_remaining=10.0)
+    with pytest.raises(Aborted):
+        list(service.Stream(iter(["a", "deadline"]), context))
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert admission._deadline.get() is None
+
+
+def test_aio_server_sync_stream_rejected_at_start():
+    context = _AioSyncContext(time_remaining=0.0)
+    assert list(service.Stream(iter(["a"]), context)) == []
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+# Async handlers
+
+def test_async_unary_releases_its_slot():
+    assert _run(service.AsyncUnary("a", _AsyncContext())) == "ok a"
+    with pytest.raises(ValueError):
+        _run(service.AsyncUnary("fail", _AsyncContext()))
+
+    context = _AsyncContext(time_remaining=10.0)
+    with pytest.raises(Aborted):
+        _run(service.AsyncUnary("deadline", context))
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+def test_async_unary_over_the_limit_is_rejected():
+    admission.LANES["enrollment"].try_enter()
+    try:
+        context = _AsyncContext()
+        with pytest.raises(Aborted):
+            _run(service.AsyncUnary("a", context))
+        assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+    finally:
+        admission.LANES["enrollment"].leave()
+
+
+def test_async_stream_releases_slots_on_every_exit():
+    assert _run(_collect(service.AsyncStream(iter(["a", "b"]), _AsyncContext()))) == ["ok a", "ok b"]
+    with pytest.raises(ValueError):
+        _run(_collect(service.AsyncStream(iter(["a", "fail"]), _AsyncContext())))
+
+    context = _AsyncContext(time_remaining=10.0)
+    with pytest.raises(Aborted):
+        _run(_collect(service.AsyncStream(iter(["deadline"]), context)))
+    assert context.code == grpc.StatusCode.DEADLINE_EXCEEDED
+
+    async def close_early():
+        stream = service.AsyncStream(iter(["a", "b"]), _AsyncContext())
+        assert await stream.__anext__() == "ok a"
+        await stream.aclose()
+
+    _run(close_early())
@@ -0,0 +1,38 @@
+import time
+
+import numpy as np
+
+from debug_capture import DebugCapture
+
+
+def test_sampling_is_decided_once_per_request():
+    capture = DebugCapture(sample_rate=1.0)
+    first, second = capture.sample(), capture.sample()
+    assert first is not None and second is not None and first != second
+    assert DebugCapture(sample_rate=0.0).sample() is None
+
+
+def test_worker_captures_go_back_to_the_server_buffer():
+    server, worker = DebugCapture(sample_rate=1.0), DebugCapture()
+    worker.forward()
+    capture_id = server.sample()
+    server.capture(capture_id, "request", b"jpeg")
+    worker.capture(capture_id, "crop", np.zeros((112, 112, 3), dtype=np.uint8))
+    assert list(worker._buffer) == []
+
+    server.store(worker.take_forwarded())
+    assert worker.take_forwarded() == []
+    assert [(item[1], item[2]) for item in server._buffer] == [(capture_id, "request"), (capture_id, "crop")]
+
+
+def test_dump_writes_a_requests_image_and_crop_with_its_id(tmp_path):
+    capture = DebugCapture(sample_rate=1.0, output_dir=str(tmp_path))
+    capture_id = capture.sample()
+    capture.capture(capture_id, "request", b"jpeg")
+    capture.capture(capture_id, "crop", np.full((112, 112, 3), 128, dtype=np.uint8))
+    assert capture.dump() == 2
+    deadline = time.monotonic() + 5
+    while len(list(tmp_path.iterdir())) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(path.name.split("-", 2)[2] for path in tmp_path.iterdir()) == [
+        f"{capture_id:06d}-crop.jpg", f"{capture_id:06d}-request.jpg"]
@@ -0,0 +1,375 @@
+import importlib
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from gallery import Gallery, GOOD_MATCH_THRESHOLD
+
+DIM = 512
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _person(person_id, flight_no="TK1"):
+    return (person_id, f"name{person_id}", f"surname{person_id}", 30, "TR", flight_no, f"P{person_id}")
+
+
+def _random_gallery(rng, people=200, max_embeddings=4, noise=0.4):
+    """Like generate_gallery.py: a person's embeddings are noisy copies of one direction"""
+    rows = []  # (embedding id, person id, vector)
+    embedding_id = 1
+    for person_id in range(1, people + 1):
+        direction = rng.normal(size=DIM)
+        for _ in range(rng.integers(1, max_embeddings + 1)):
+            vector = _normalize(direction + rng.normal(scale=noise, size=DIM))
+            rows.append((embedding_id, person_id, vector))
+            embedding_id += 1
+    return rows
+
+
+def _fill(gallery, rows, flights=None):
+    for person_id in sorted({person_id for _, person_id, _ in rows}):
+        gallery.set_person(_person(person_id, (flights or {}).get(person_id, "TK1")))
+    for embedding_id, person_id, vector in rows:
+        gallery.add_embedding(embedding_id, person_id, vector)
+
+
+def _reference(rows, query, top_k):
+    """The window query of db.py by brute force: best embedding per person, top_k people, confidence count"""
+    best = {}
+    for _, person_id, vector in rows:
+        best[person_id] = max(best.get(person_id, -np.inf), float(vector @ query))
+    matches = sorted(best.items(), key=lambda match: -match[1])[:top_k]
+    if not matches:
+        return [], 0
+    count = sum(1 for _, person_id, vector in rows
+                if person_id == matches[0][0] and float(vector @ query) > GOOD_MATCH_THRESHOLD)
+    return matches, count
+
+
+def _assert_same(found, expected):
+    (matches, count), (expected_matches, expected_count) = found, expected
+    assert [person_id for person_id, _ in matches] == [person_id for person_id, _ in expected_matches]
+    np.testing.assert_allclose([s for _, s in matches], [s for _, s in expected_matches], atol=1e-5)
+    assert count == expected_count
+
+
+def _queries(rng, rows, count=50, noise=0.02):
+    """New photos of stored people: stored embeddings with a little noise"""
+    picks = rng.choice(len(rows), size=count, replace=False)
+    return _normalize([rows[i][2] + rng.normal(scale=noise, size=DIM) for i in picks])
+
+
+def test_search_matches_brute_force():
+    rng = np.random.default_rng(1)
+    rows = _random_gallery(rng)
+    gallery = Gallery(dim=DIM)
+    _fill(gallery, rows)
+    assert len(gallery) == len(rows)
+
+    queries = _queries(rng, rows)
+    for top_k in (1, 3, 10):
+        for query, found in zip(queries, gallery.search_many(queries, top_k)):
+            _assert_same(found, _reference(rows, query, top_k))
+    # Some queries must exercise the confidence count, or the comparison above proves little
+    assert any(gallery.search(query)[1] > 1 for query in queries)
+
+
+def test_top_k_widens_past_one_persons_embeddings():
+    rng = np.random.default_rng(2)
+    query = _normalize(rng.normal(size=DIM))
+    # 300 near copies of the query for one person fill every window _top_people starts with
+    rows = [(i, 1, _normalize(query + rng.normal(scale=0.01, size=DIM))) for i in range(1, 301)]
+    rows += [(300 + i, 1 + i, _normalize(rng.normal(size=DIM))) for i in range(1, 6)]
+    gallery = Gallery(dim=DIM)
+    _fill(gallery, rows)
+    _assert_same(gallery.search(query, top_k=4), _reference(rows, query, 4))
+    assert gallery.search(query, top_k=10)[0][-1][0] != 1  # fewer than top_k people: all of them
+    assert len(gallery.search(query, top_k=10)[0]) == 6
+
+
+def test_mutations():
+    rng = np.random.default_rng(3)
+    rows = _random_gallery(rng, people=20)
+    gallery = Gallery(dim=DIM)
+    _fill(gallery, rows)
+    query = rows[0][2]
+    assert gallery.search(query)[0][0] == (1, pytest.approx(1.0, abs=1e-5))
+
+    # Adding an embedding twice (our own write coming back through NOTIFY) is a no-op
+    gallery.add_embedding(*rows[0])
+    assert len(gallery) == len(rows)
+
+    removed = [embedding_id for embedding_id, person_id, _ in rows if person_id == 1]
+    gallery.remove_embeddings(removed)
+    rows = [row for row in rows if row[1] != 1]
+    assert len(gallery) == len(rows)
+    _assert_same(gallery.search(query), _reference(rows, query, 3))
+
+    gallery.remove_person(2)
+    rows = [row for row in rows if row[1] != 2]
+    assert gallery.person_info(2) is None
+    _assert_same(gallery.search(query), _reference(rows, query, 3))
+
+    gallery.set_person(_person(3, "LH9"))
+    assert gallery.person_info(3)["flight_no"] == "LH9"
+
+    gallery.remove_embeddings([embedding_id for embedding_id, _, _ in rows])
+    assert len(gallery) == 0
+    assert gallery.search(query) == ([], 0)
+
+
+def test_flight_scope_matches_brute_force_over_the_flights_passengers():
+    rng = np.random.default_rng(4)
+    rows = _random_gallery(rng, people=60)
+    flights = {person_id: ("TK1", "LH2", "BA3")[person_id % 3] for person_id in range(1, 61)}
+    gallery = Gallery(dim=DIM)
+    _fill(gallery, rows, flights)
+
+    scoped = [row for row in rows if flights[row[1]] in ("TK1", "BA3")]
+    for query in _queries(rng, rows, count=20):
+        _assert_same(gallery.search(query, flights=["TK1", "BA3"]), _reference(scoped, query, 3))
+
+    # A write for another flight keeps the shard, one for a scoped flight rebuilds it
+    shard = gallery._shards[frozenset(["TK1", "BA3"])]
+    gallery.add_embedding(10_000, 1, _normalize(rng.normal(size=DIM)))  # person 1 is on LH2
+    gallery.search(query, flights=["TK1", "BA3"])
+    assert gallery._shards[frozenset(["TK1", "BA3"])] is shard
+    new_row = (10_001, 3, _normalize(rng.normal(size=DIM)))  # person 3 is on TK1
+    gallery.add_embedding(*new_row)
+    _assert_same(gallery.search(new_row[2], flights=["TK1", "BA3"]), _reference(scoped + [new_row], new_row[2], 3))
+
+    # Moving a person to another flight moves their rows between the shards
+    gallery.set_person(_person(3, "LH2"))
+    scoped = [row for row in scoped + [new_row] if row[1] != 3]
+    _assert_same(gallery.search(new_row[2], flights=["TK1", "BA3"]), _reference(scoped, new_row[2], 3))
+
+
+def test_snapshots_under_concurrent_writes():
+    rng = np.random.default_rng(5)
+    rows = _random_gallery(rng, people=50)
+    gallery = Gallery(dim=DIM)
+    _fill(gallery, rows)
+    anchor = rows[0]  # its own embedding must stay the best match through every write
+    expected = _reference(rows, anchor[2], 1)
+
+    # Unrelated people, far from the anchor, three embeddings each. Every 10th is removed again
+    writes = [(300_000 + i, 1000 + i // 3, _normalize(rng.normal(size=DIM))) for i in range(3000)]
+    removed = {person_id for _, person_id, _ in writes if person_id % 10 == 0}
+    errors, stop = [], threading.Event()
+
+    def write():
+        try:
+            for embedding_id, person_id, vector in writes:
+                if embedding_id % 3 == 0:
+                    gallery.set_person(_person(person_id))
+                gallery.add_embedding(embedding_id, person_id, vector)  # grows the arrays several times
+                if embedding_id % 3 == 2 and person_id in removed:
+                    gallery.remove_person(person_id)  # compaction builds new arrays
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stop.set()
+
+    def read():
+        try:
+            while not stop.is_set():
+                matches, count = gallery.search(anchor[2], top_k=1)
+                assert matches[0][0] == anchor[1]
+                assert matches[0][1] == pytest.approx(1.0, abs=1e-5)
+                assert count == expected[1]
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    writer = threading.Thread(target=write)
+    for thread in readers + [writer]:
+        thread.start()
+    for thread in readers + [writer]:
+        thread.join()
+    assert not errors, errors[0]
+
+    final_rows = rows + [row for row in writes if row[1] not in removed]
+    assert len(gallery) == len(final_rows)
+    for query in _queries(rng, final_rows, count=20):
+        _assert_same(gallery.search(query), _reference(final_rows, query, 3))
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """db imported with SEARCH_MODE=memory, its gallery is filled by the test instead of Postgres"""
+    monkeypatch.setenv("SEARCH_MODE", "memory")
+    monkeypatch.setenv("GALLERY_QUANTIZATION", "none")
+    sys.modules.pop("db", None)
+    db = importlib.import_module("db")
+    yield db
+    sys.modules.pop("db", None)
+
+
+def test_find_most_similar_face_matches_brute_force(memory_db):
+    rng = np.random.default_rng(6)
+    rows = _random_gallery(rng)
+    _fill(memory_db.gallery, rows)
+
+    for query in _queries(rng, rows):
+        (person_id, similarity), = _reference(rows, query, 1)[0]
+        count = _reference(rows, query, 1)[1]
+        match = memory_db.find_most_similar_face(query)
+        assert match["person_id"] == person_id
+        assert match["passport_no"] == f"P{person_id}"
+        # The confidence boost of the window query path: 0.02 per good embedding, at most 0.1
+        assert match["similarity"] == pytest.approx(min(1.0, similarity + min(0.1, count * 0.02)), abs=1e-5)
+
+
+def test_int8_encoding_round_trip():
+    rng = np.random.default_rng(7)
+    gallery = Gallery(dim=DIM, quantization="int8")
+    for vector in _normalize(rng.normal(size=(20, DIM))):
+        codes, scale = gallery._encode(vector)
+        assert codes.dtype == np.int8 and np.abs(codes).max() == 127
+        assert np.abs(codes * scale - vector).max() <= scale / 2 + 1e-7
+    codes, scale = gallery._encode(np.zeros(DIM))
+    assert scale == 1.0 and not codes.any()
+
+
+def _int8_gallery(rows, rerank_candidates=50, **kwargs):
+    gallery = Gallery(dim=DIM, quantization="int8", rerank_candidates=rerank_candidates, **kwargs)
+    _fill(gallery, rows)
+    return gallery
+
+
+def _dequantized(gallery):
+    matrix, scales, person_ids, _, _ = gallery._rows()
+    return matrix.astype(np.float32) * scales[:, None], person_ids
+
+
+def test_int8_rerank_recall(tmp_path):
+    rng = np.random.default_rng(8)
+    rows = _random_gallery(rng, people=500)
+    vectors = {embedding_id: vector for embedding_id, _, vector in rows}
+    fetched = []
+
+    def fetch_embeddings(embedding_ids):
+        fetched.append(len(embedding_ids))
+        return {embedding_id: vectors[embedding_id] for embedding_id in embedding_ids}
+
+    float_gallery = Gallery(dim=DIM)
+    _fill(float_gallery, rows)
+    fetching = _int8_gallery(rows)
+    fetching.fetch_embeddings = fetch_embeddings
+    mapped = _int8_gallery(rows, exact_dir=str(tmp_path))
+
+    queries = _queries(rng, rows, count=100)
+    expected = float_gallery.search_many(queries, top_k=1)
+    for gallery in (fetching, mapped):
+        found = gallery.search_many(queries, top_k=1)
+        # recall@1 against the float gallery, and the exact similarity after the rerank
+        assert [f[0][0][0] for f in found] == [e[0][0][0] for e in expected]
+        np.testing.assert_allclose([f[0][0][1] for f in found], [e[0][0][1] for e in expected], atol=1e-5)
+    assert len(fetched) == 1  # one fetch for the whole batch
+
+
+def test_int8_memory_mapped_rows_follow_writes(tmp_path):
+    rng = np.random.default_rng(9)
+    rows = _random_gallery(rng, people=300)  # more rows than the initial capacity, so the file grows
+    gallery = _int8_gallery(rows, exact_dir=str(tmp_path))
+    gallery.remove_person(5)
+    rows = [row for row in rows if row[1] != 5]
+    for query in _queries(rng, rows, count=20):
+        _assert_same(gallery.search(query), _reference(rows, query, 3))
+    assert list(tmp_path.iterdir()) == []  # the files are unlinked, only the mappings keep them
+
+
+def test_int8_falls_back_to_dequantized_scores_when_the_fetch_fails(caplog):
+    rng = np.random.default_rng(10)
+    rows = _random_gallery(rng, people=100)
+    gallery = _int8_gallery(rows, rerank_candidates=len(rows))  # every row is a candidate
+
+    def fetch_embeddings(embedding_ids):
+        raise ConnectionError("database is down")
+
+    gallery.fetch_embeddings = fetch_embeddings
+    vectors, person_ids = _dequantized(gallery)
+    dequantized_rows = [(None, int(person_id), vector) for person_id, vector in zip(person_ids, vectors)]
+    for query in _queries(rng, rows, count=20):
+        _assert_same(gallery.search(query), _reference(dequantized_rows, query, 3))
+    assert "exact rerank failed" in caplog.text
+
+
+def test_int8_needs_rerank_candidates():
+    with pytest.raises(ValueError):
+        Gallery(dim=DIM, quantization="int8", rerank_candidates=0)
+    rng = np.random.default_rng(11)
+    rows = _random_gallery(rng, people=20, max_embeddings=1)
+    gallery = _int8_gallery(rows, rerank_candidates=1)
+    query = _queries(rng, rows, count=1)[0]
+    assert len(gallery.search(query, top_k=3)[0]) == 3  # widened to top_k candidates
+
+
+def test_recall_samples_are_skipped_while_a_check_is_pending(memory_db, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(memory_db, "SEARCH_RECALL_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(memory_db._recall_executor, "submit", lambda *args: submitted.append(args))
+    embeddings = _normalize(np.random.default_rng(12).normal(size=(3, DIM)))
+    memory_db._sample_recall(embeddings, [None] * 3)
+    memory_db._sample_recall(embeddings, [None] * 3)
+    assert len(submitted) == 1 and memory_db.recall_stats["skipped"] == 5
+
+
+class _Engine:
+    """Answers the listener's fetches from dicts, counting the queries"""
+
+    def __init__(self, people, embeddings):
+        self.people, self.embeddings, self.queries = people, embeddings, 0
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params):
+        self.queries += 1
+        if "FROM people" in str(statement):
+            self._rows = [_person(person_id, self.people[person_id])
+                          for person_id in params["ids"] if person_id in self.people]
+        else:
+            self._rows = [(row_id, self.embeddings[row_id][0], "[" + ",".join(map(str, self.embeddings[row_id][1])) + "]")
+                          for row_id in sorted(params["ids"]) if row_id in self.embeddings]
+        return self
+
+    def fetchall(self):
+        return self._rows
+
+
+def test_statement_notifications_are_applied_in_one_fetch():
+    rng = np.random.default_rng(13)
+    vectors = _normalize(rng.normal(size=(3, DIM)))
+    engine = _Engine({1: "TK1", 2: "LH2"}, {10: (1, vectors[0]), 11: (2, vectors[1]), 12: (2, vectors[2])})
+    gallery = Gallery(dim=DIM)
+    changed = []
+    gallery.on_change = changed.append
+
+    gallery._apply_notification(engine, "people:INSERT:1/1,2/2")
+    gallery._apply_notification(engine, "face_embeddings:INSERT:10/1,11/2,12/2")
+    assert engine.queries == 2  # one for the people, one for all three embeddings
+    assert len(gallery) == 3 and gallery.person_info(2)["flight_no"] == "LH2"
+    assert gallery.search(vectors[2])[0][0] == (2, pytest.approx(1.0, abs=1e-5))
+
+    gallery._apply_notification(engine, "face_embeddings:INSERT:10/1,11/2")  # our own writes coming back
+    assert engine.queries == 2
+
+    gallery._apply_notification(engine, "face_embeddings:DELETE:11/2,12/2")
+    assert len(gallery) == 1
+    gallery._apply_notification(engine, "people:DELETE:1/1")
+    assert gallery.person_info(1) is None and len(gallery) == 0
+    assert changed == [1, 2, 1, 2, 2, 1]  # new people are only announced with their embeddings
@@ -0,0 +1,88 @@
+import numpy as np
+
+from recognition_cache import RecognitionCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _unit(*values):
+    vector = np.zeros(8, dtype=np.float32)
+    vector[:len(values)] = values
+    return vector / np.linalg.norm(vector)
+
+
+def _cache(**kwargs):
+    clock = _Clock()
+    return RecognitionCache(clock=clock, **kwargs), clock
+
+
+def test_close_embedding_hits_and_distant_one_misses():
+    cache, _ = _cache(min_similarity=0.95)
+    cache.store("kiosk-1", _unit(1, 0), 7, "ada")
+    assert cache.lookup("kiosk-1", _unit(1, 0.1)) == "ada"  # cosine 0.995
+    assert cache.lookup("kiosk-1", _unit(1, 0.5)) is None  # cosine 0.894
+    assert cache.lookup("kiosk-1", _unit(0, 1)) is None
+
+
+def test_best_of_several_entries():
+    cache, _ = _cache(min_similarity=0.9)
+    cache.store("kiosk-1", _unit(1, 0), 7, "ada")
+    cache.store("kiosk-1", _unit(1, 0.3), 8, "grace")
+    assert cache.lookup("kiosk-1", _unit(1, 0.25)) == "grace"
+    assert cache.lookup("kiosk-1", _unit(1, 0.05)) == "ada"
+
+
+def test_entries_expire_after_ttl():
+    cache, clock = _cache(ttl=3.0)
+    cache.store("kiosk-1", _unit(1), 7, "ada")
+    clock.now += 2.9
+    assert cache.lookup("kiosk-1", _unit(1)) == "ada"
+    clock.now += 0.1
+    assert cache.lookup("kiosk-1", _unit(1)) is None
+    assert not cache._entries and not cache._by_source  # expired entries are dropped, not just skipped
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache, _ = _cache(max_entries=2)
+    cache.store("kiosk-1", _unit(1, 0), 1, "first")
+    cache.store("kiosk-1", _unit(0, 1), 2, "second")
+    assert cache.lookup("kiosk-1", _unit(1, 0)) == "first"  # now the most recently used
+    cache.store("kiosk-1", _unit(0, 0, 1), 3, "third")
+    assert cache.lookup("kiosk-1", _unit(0, 1)) is None
+    assert cache.lookup("kiosk-1", _unit(1, 0)) == "first"
+    assert cache.lookup("kiosk-1", _unit(0, 0, 1)) == "third"
+
+
+def test_sources_are_isolated():
+    cache, _ = _cache()
+    cache.store("kiosk-1", _unit(1), 7, "ada")
+    assert cache.lookup("kiosk-2", _unit(1)) is None
+    cache.store("kiosk-2", _unit(1), 8, "grace")
+    assert cache.lookup("kiosk-1", _unit(1)) == "ada"
+    assert cache.lookup("kiosk-2", _unit(1)) == "grace"
+
+
+def test_invalidate_person_drops_every_entry_of_the_person():
+    cache, _ = _cache()
+    cache.store("kiosk-1", _unit(1, 0), 7, "ada")
+    cache.store("kiosk-2", _unit(1, 0), 7, "ada")
+    cache.store("kiosk-1", _unit(0, 1), 8, "grace")
+    cache.invalidate_person(7)
+    assert cache.lookup("kiosk-1", _unit(1, 0)) is None
+    assert cache.lookup("kiosk-2", _unit(1, 0)) is None
+    assert cache.lookup("kiosk-1", _unit(0, 1)) == "grace"
+    assert "kiosk-2" not in cache._by_source
+
+
+def test_disabled_cache_stores_nothing():
+    for kwargs in ({"ttl": 0}, {"max_entries": 0}):
+        cache, _ = _cache(**kwargs)
+        cache.store("kiosk-1", _unit(1), 7, "ada")
+        assert cache.lookup("kiosk-1", _unit(1)) is None
+        assert not cache._entries
@@ -0,0 +1,48 @@
+import pytest
+
+import tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+SPAN_ID = "00f067aa0ba902b7"
+
+
+class _Context:
+    def __init__(self, traceparent):
+        self._metadata = [("traceparent", traceparent)]
+
+    def invocation_metadata(self):
+        return self._metadata
+
+
+@pytest.fixture(autouse=True)
+def no_sampling(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+
+
+def test_sampled_traceparent_continues_the_trace():
+    assert tracing._incoming(_Context(f"00-{TRACE_ID}-{SPAN_ID}-01")) == tracing.Span(TRACE_ID, SPAN_ID)
+
+
+def test_unsampled_traceparent():
+    assert tracing._incoming(_Context(f"00-{TRACE_ID}-{SPAN_ID}-00")) is None
+
+
+@pytest.mark.parametrize("traceparent", [
+    f"00-{TRACE_ID}-{SPAN_ID}-zz",
+    f"0x-{TRACE_ID}-{SPAN_ID}-01",
+    f"00-{TRACE_ID.upper()}-{SPAN_ID}-01",
+    f"00-{TRACE_ID[:-1]}-{SPAN_ID}-01",
+    f"00-{TRACE_ID}-{SPAN_ID}0-01",
+    f"ff-{TRACE_ID}-{SPAN_ID}-01",
+    f"00-{'0' * 32}-{SPAN_ID}-01",
+    f"00-{TRACE_ID}-{SPAN_ID}-01-extra",
+    "",
+])
+def test_malformed_traceparent_is_ignored(traceparent):
+    assert tracing._incoming(_Context(traceparent)) is None
+
+
+def test_malformed_traceparent_falls_back_to_sampling(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    parent = tracing._incoming(_Context(f"00-{TRACE_ID}-{SPAN_ID}-zz"))
+    assert parent.trace_id != TRACE_ID and parent.span_id is None
@@ -0,0 +1,154 @@
+"""
+Summarizes the traces written by edge/tracing.py and tracing.py.
+
+    python trace_report.py ../edge/traces.jsonl traces.jsonl [--root recognize_face] [--slowest 5] [--json]
+
+Spans of all files are joined by trace id into one tree per trace. For every trace the critical path
+is walked back from the end of the root span: the child that finished last is on it, then the child
+that finished last before that child started, and so on. Time of a span not covered by its critical
+children is its own (self) time. The report lists per stage how much of the traces' end-to-end
+latency it accounts for on the critical path, with percentiles over the traces.
+"""
+import argparse
+import json
+from collections import defaultdict
+
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    span = json.loads(line)
+                    span["end"] = span["start"] + span["duration_ms"] / 1000.0
+                    spans.append(span)
+    return spans
+
+
+def _percentile(values, q):
+    # Linear interpolation like numpy.percentile, the report needs no third-party packages
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def _label(span):
+    label = f"{span['service']}:{span['name']}"
+    if span["name"] == "sql":
+        label += " " + span["attrs"].get("statement", "")[:60]
+    elif span["name"] == "rpc" and span["attrs"].get("method"):
+        label += " " + span["attrs"]["method"]
+    return label
+
+
+def build_traces(spans):
+    """Returns a list of (root span, children by span id) per trace, spans without a known parent are roots"""
+    by_trace = defaultdict(list)
+    for span in spans:
+        by_trace[span["trace_id"]].append(span)
+
+    traces = []
+    for trace_spans in by_trace.values():
+        ids = {span["span_id"] for span in trace_spans}
+        children = defaultdict(list)
+        roots = []
+        for span in trace_spans:
+            if span.get("parent_id") in ids:
+                children[span["parent_id"]].append(span)
+            else:
+                roots.append(span)
+        # The outermost span is the root, others without a parent are spans whose parent was dropped
+        root = max(roots, key=lambda span: span["duration_ms"])
+        traces.append((root, children))
+    return traces
+
+
+def critical_path(span, children, contributions, path=None):
+    """Adds the self time of every span on the critical path below span to contributions (ms)"""
+    cursor = span["end"]
+    self_ms = span["duration_ms"]
+    for child in sorted(children.get(span["span_id"], ()), key=lambda c: c["end"], reverse=True):
+        if child["start"] >= cursor:
+            continue  # overlaps a later critical child, runs in parallel with it
+        # Clocks of the edge and the backend may differ a little, a child never counts beyond its parent
+        covered = (min(child["end"], cursor) - max(child["start"], span["start"])) * 1000.0
+        if covered <= 0:
+            continue
+        critical_path(child, children, contributions, path)
+        self_ms -= covered
+        cursor = child["start"]
+    contributions[_label(span)] += max(0.0, self_ms)
+    if path is not None:
+        path.append((_label(span), span["duration_ms"], max(0.0, self_ms)))
+
+
+def summarize(traces):
+    totals = [root["duration_ms"] for root, _ in traces]
+    per_trace = []
+    for root, children in traces:
+        contributions = defaultdict(float)
+        critical_path(root, children, contributions)
+        per_trace.append(contributions)
+
+    stages = sorted({label for contributions in per_trace for label in contributions})
+    total_sum = sum(totals) or 1.0
+    rows = []
+    for label in stages:
+        values = [contributions.get(label, 0.0) for contributions in per_trace]
+        rows.append({
+            "stage": label,
+            "share": sum(values) / total_sum,
+            "mean_ms": sum(values) / len(values),
+            "p50_ms": _percentile(values, 50),
+            "p95_ms": _percentile(values, 95),
+        })
+    rows.sort(key=lambda row: row["share"], reverse=True)
+    return {
+        "traces": len(traces),
+        "total_p50_ms": _percentile(totals, 50),
+        "total_p95_ms": _percentile(totals, 95),
+        "total_p99_ms": _percentile(totals, 99),
+        "stages": rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Critical path latency summary of edge and backend traces.")
+    parser.add_argument("files", nargs="+", help="trace files (JSON lines) of the edge and/or the backend")
+    parser.add_argument("--root", help="only traces whose root span has this name, e.g. recognize_face")
+    parser.add_argument("--slowest", type=int, default=0, help="also print the critical path of the N slowest traces")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    traces = build_traces(load_spans(args.files))
+    if args.root:
+        traces = [(root, children) for root, children in traces if root["name"] == args.root]
+    if not traces:
+        print("No traces found.")
+        return
+
+    summary = summarize(traces)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"{summary['traces']} traces, end to end p50 {summary['total_p50_ms']:.1f} ms, "
+              f"p95 {summary['total_p95_ms']:.1f} ms, p99 {summary['total_p99_ms']:.1f} ms\n")
+        print(f"{'stage (self time on the critical path)':<70} {'share':>7} {'mean':>9} {'p50':>9} {'p95':>9}")
+        for row in summary["stages"]:
+            print(f"{row['stage']:<70} {row['share'] * 100:>6.1f}% {row['mean_ms']:>7.1f}ms "
+                  f"{row['p50_ms']:>7.1f}ms {row['p95_ms']:>7.1f}ms")
+
+    for root, children in sorted(traces, key=lambda trace: trace[0]["duration_ms"], reverse=True)[:args.slowest]:
+        path = []
+        critical_path(root, children, defaultdict(float), path)
+        print(f"\nTrace {root['trace_id']}: {root['duration_ms']:.1f} ms")
+        for label, duration, self_ms in reversed(path):
+            print(f"  {label:<70} {duration:>8.1f} ms (self {self_ms:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
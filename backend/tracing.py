@@ -0,0 +1,174 @@
+"""
+Request tracing across the edge and the backend.
+
+The edge starts a trace per UI request and sends it in the W3C `traceparent` gRPC metadata
+("00-<trace id>-<parent span id>-<flags>"). Calls that carry a sampled traceparent are traced here,
+calls without one are sampled with TRACE_SAMPLE_RATE. Every stage (decode, detection, embedding,
+search, each SQL statement) becomes a span of the call's span.
+
+Finished spans are written as JSON lines to TRACE_FILE by a background thread, the same format as
+edge/tracing.py, so trace_report.py can join both files into one tree per trace. Nothing is
+measured or written for untraced calls.
+"""
+import collections
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.0))  # calls without a traceparent, 0 traces none
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+SERVICE = "backend"
+
+# (trace id, span id) of the innermost open span of this thread / asyncio task, None when not traced
+_current = contextvars.ContextVar("trace_span", default=None)
+
+Span = collections.namedtuple("Span", "trace_id span_id")
+
+# version-trace id-parent span id-flags, lowercase hex only
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class _Writer:
+    """Appends finished spans to TRACE_FILE on a background thread, drops spans if it falls behind"""
+
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                records = [self._queue.get()]
+                while not self._queue.empty() and len(records) < 1000:
+                    records.append(self._queue.get_nowait())
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+                f.flush()
+
+
+_writer = _Writer(TRACE_FILE)
+
+
+def active():
+    return _current.get() is not None
+
+
+def record(name, start, duration, parent=None, **attrs):
+    """Writes a finished span that started at `start` (epoch seconds) as a child of parent (default: current)"""
+    parent = parent or _current.get()
+    if parent is None:
+        return None
+    span = Span(parent.trace_id, _new_id(64))
+    _writer.write({
+        "trace_id": span.trace_id, "span_id": span.span_id, "parent_id": parent.span_id, "name": name,
+        "service": SERVICE, "start": start, "duration_ms": duration * 1000.0, "attrs": attrs,
+    })
+    return span
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the with block as a child span of the current span, does nothing when not traced"""
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    child = Span(parent.trace_id, _new_id(64))
+    token = _current.set(child)
+    start, started = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        _writer.write({
+            "trace_id": child.trace_id, "span_id": child.span_id, "parent_id": parent.span_id, "name": name,
+            "service": SERVICE, "start": start, "duration_ms": (time.perf_counter() - started) * 1000.0,
+            "attrs": attrs,
+        })
+
+
+def _incoming(context):
+    """
+    Parent span from the call's traceparent metadata, None if the caller did not sample this call.
+    A malformed traceparent is ignored, the call is then sampled like one without it.
+    """
+    for key, value in context.invocation_metadata() or ():
+        if key == "traceparent":
+            match = TRACEPARENT.match(value.strip())
+            if match is None:
+                break
+            version, trace_id, span_id, flags = match.groups()
+            if version == "ff" or trace_id == "0" * 32 or span_id == "0" * 16:
+                break  # invalid by the spec
+            return Span(trace_id, span_id) if int(flags, 16) & 1 else None
+    if TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE:
+        return Span(_new_id(128), None)
+    return None
+
+
+@contextmanager
+def rpc_span(method, context):
+    """Span of a whole gRPC call, continues the caller's trace"""
+    parent = _incoming(context)
+    if parent is None:
+        yield
+        return
+    token = _current.set(parent)
+    try:
+        with span(method, rpc=method, peer=context.peer()):
+            yield
+    finally:
+        _current.reset(token)
+
+
+def instrument_engine(engine):
+    """One span per SQL statement executed on the engine while a trace is active"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        conn.info.setdefault("trace_spans", []).append(
+            (parent, time.time(), time.perf_counter()) if parent is not None else None
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["trace_spans"].pop()
+        if started is not None:
+            parent, start, perf_start = started
+            record("sql", start, time.perf_counter() - perf_start, parent,
+                   statement=re.sub(r"\s+", " ", statement).strip()[:300])
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        # after_cursor_execute is not called for a failed statement
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("trace_spans"):
+            connection.info["trace_spans"].pop()
@@ -0,0 +1,231 @@
+import itertools
+import logging
+import multiprocessing as mp
+import threading
+from concurrent import futures
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import metrics
+from debug_capture import debug_capture
+
+logger = logging.getLogger(__name__)
+
+
+def _attach(name):
+    """Opens a shared memory block created by the front end without taking ownership of it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # Older versions register every attached block, the front end already unlinks it
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _run(model, op, arrays, args):
+    if op == "get_embeddings":
+        return model.get_embeddings(arrays, *args)
+    if op == "detect_and_align":
+        return model.detect_and_align(arrays[0], *args)
+    if op == "embed_aligned":
+        return model.embed_aligned(arrays)
+    raise ValueError(f"Unknown operation: {op}")
+
+
+def _worker_main(conn, intra_op_threads):
+    # Imported here so that only the worker processes load the models
+    from embedding_model import EmbeddingModel
+
+    model = EmbeddingModel(intra_op_threads=intra_op_threads)
+    model.warm_up()  # before reporting ready, so the pool only starts once every worker is warm
+    # The metrics endpoint and the debug capture buffer live in the server process, stage timings and
+    # captured crops go back with every result
+    metrics.forward_stages()
+    debug_capture.forward()
+    conn.send(("ready", None, None, None, None))
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        request_id, op, shm_name, layouts, args = message
+        shm = _attach(shm_name)
+        arrays = []
+        try:
+            arrays = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset) for offset, shape in layouts]
+            result = _run(model, op, arrays, args)
+            conn.send((request_id, result, None, metrics.take_forwarded(), debug_capture.take_forwarded()))
+        except Exception as e:
+            conn.send((request_id, None, str(e), metrics.take_forwarded(), debug_capture.take_forwarded()))
+        finally:
+            del arrays  # views into the block must be gone before it can be closed
+            shm.close()
+
+
+class _Worker:
+    def __init__(self, ctx, intra_op_threads):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, intra_op_threads), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.in_flight = 0
+        self.pending = {}  # request id -> Future
+        self.alive = True
+        self.respawning = False
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()  # also set when the worker exits, check alive
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, request_id, future, message):
+        """Sends a request, raises RuntimeError if the worker is gone"""
+        with self.send_lock:
+            if not self.alive:
+                raise RuntimeError("Inference worker exited.")
+            self.pending[request_id] = future
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                self.pending.pop(request_id, None)
+                raise RuntimeError("Inference worker exited.")
+
+    def _read(self):
+        while True:
+            try:
+                request_id, result, error, stages, captures = self.conn.recv()
+            except (EOFError, OSError):
+                # Under send_lock, so no request is registered after the pending ones are failed
+                with self.send_lock:
+                    self.alive = False
+                    pending, self.pending = self.pending, {}
+                self.ready.set()
+                for future in pending.values():
+                    if not future.done():
+                        future.set_exception(RuntimeError("Inference worker exited."))
+                return
+
+            if request_id == "ready":
+                self.ready.set()
+                continue
+            debug_capture.store(captures)  # crops of sampled requests, kept even if the caller gave up
+            future = self.pending.pop(request_id, None)
+            if future is None or future.done():
+                continue  # the caller gave up on it
+            future.stages = stages  # recorded by the requesting thread, where its trace is
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+
+class WorkerPool:
+    """
+    Drop-in replacement for EmbeddingModel that runs the models in N worker processes, each with its
+    own ONNX sessions and intra-op thread count, so inference and the Python-side pre/post-processing
+    are not bound to one GIL.
+
+    Images are copied once into a shared memory block and the workers read them from there, only
+    the small results (embeddings, aligned crops) are pickled back. Every call goes to the worker
+    with the fewest requests in flight. A worker that exits is taken out of the routing and replaced
+    in the background, a call that gets no answer within call_timeout fails and its worker is
+    restarted, as it is most likely stuck.
+    """
+
+    def __init__(self, num_workers, intra_op_threads=1, start_timeout=300, call_timeout=60.0):
+        # spawn: the workers must not inherit the gRPC server, DB connections or threads of this process
+        self._ctx = mp.get_context("spawn")
+        self._intra_op_threads = intra_op_threads
+        self._start_timeout = start_timeout
+        self._call_timeout = call_timeout or None
+        self._workers = [_Worker(self._ctx, intra_op_threads) for _ in range(num_workers)]
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+
+        for worker in self._workers:
+            if not worker.ready.wait(start_timeout) or not worker.alive:
+                raise RuntimeError("Inference worker did not start in time.")
+        logger.info("WorkerPool: %d inference workers ready (%d intra-op threads each).", num_workers, intra_op_threads)
+
+    def _pick(self):
+        """Returns (worker, request id), the least-loaded live worker, and starts replacements for dead ones"""
+        with self._lock:
+            for index, worker in enumerate(self._workers):
+                if not worker.alive and not worker.respawning:
+                    worker.respawning = True
+                    threading.Thread(target=self._respawn, args=(index,), daemon=True).start()
+            workers = [worker for worker in self._workers if worker.alive]
+            if not workers:
+                raise RuntimeError("No inference worker available.")
+            worker = min(workers, key=lambda w: w.in_flight)
+            worker.in_flight += 1
+            return worker, next(self._request_ids)
+
+    def _respawn(self, index):
+        logger.warning("WorkerPool: inference worker %d exited, starting a new one.", index)
+        worker = _Worker(self._ctx, self._intra_op_threads)
+        if not worker.ready.wait(self._start_timeout) or not worker.alive:
+            logger.error("WorkerPool: replacement of inference worker %d did not start.", index)
+            worker.process.kill()
+            worker.alive = False  # the next call tries again
+        with self._lock:
+            self._workers[index] = worker
+
+    def _call(self, op, arrays, args=()):
+        arrays = [np.ascontiguousarray(a, dtype=np.uint8) for a in arrays]
+        layouts, size = [], 0
+        for a in arrays:
+            layouts.append((size, a.shape))
+            size += a.nbytes
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            for (offset, shape), a in zip(layouts, arrays):
+                np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)[...] = a
+
+            worker, request_id = self._pick()
+            try:
+                future = futures.Future()
+                worker.send(request_id, future, (request_id, op, shm.name, layouts, args))
+                try:
+                    return future.result(timeout=self._call_timeout)
+                except futures.TimeoutError:
+                    worker.pending.pop(request_id, None)
+                    logger.error("WorkerPool: no answer to %s within %.0f s, restarting the worker.", op,
+                                 self._call_timeout)
+                    worker.process.kill()  # its reader sees EOF, the next call replaces it
+                    raise RuntimeError("Inference worker timed out.")
+                finally:
+                    metrics.observe_stages(getattr(future, "stages", None))
+            finally:
+                with self._lock:
+                    worker.in_flight -= 1
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # Same interface as EmbeddingModel
+
+    def get_embeddings(self, images, aligned=None, boxes=None, captures=None):
+        if not images:
+            return []
+        return self._call("get_embeddings", images, (aligned, boxes, captures))
+
+    def get_embedding(self, image, aligned=False, box=None):
+        return self.get_embeddings([image], [aligned], [box])[0]
+
+    def detect_and_align(self, image, box=None, capture=None):
+        return self._call("detect_and_align", [image], (box, capture))
+
+    def embed_aligned(self, crops):
+        return self._call("embed_aligned", crops)
+
+    def close(self):
+        for worker in self._workers:
+            with worker.send_lock:
+                if worker.alive:
+                    worker.conn.send(None)
+        for worker in self._workers:
+            worker.process.join(timeout=5)
@@ -0,0 +1,82 @@
+"""
+Shared helpers of the benchmark scripts: puts backend/ on the import path and writes results.
+
+Every result is one JSON object per line, appended to the --output file (and printed), so runs on
+different commits or machines can be compared with any JSON tool.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(REPO_DIR, "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+
+def summarize(latencies, elapsed=None):
+    """Latency statistics in milliseconds of a list of durations in seconds"""
+    ms = np.asarray(latencies, dtype=np.float64) * 1000.0
+    if len(ms) == 0:
+        return {"count": 0}
+    stats = {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+    if elapsed:
+        stats["throughput_per_s"] = len(ms) / elapsed
+    return stats
+
+
+def time_calls(func, repeat, warmup=3):
+    """Calls func() warmup + repeat times and returns the durations of the last repeat calls"""
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def write_result(output, benchmark, name, params, stats):
+    result = {
+        "benchmark": benchmark,
+        "name": name,
+        "params": params,
+        "stats": stats,
+        "commit": _git_commit(),
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    line = json.dumps(result)
+    print(line)
+    if output:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+    return result
+
+
+def random_unit_vectors(count, dim=512, rng=None):
+    rng = rng or np.random.default_rng()
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
@@ -0,0 +1,184 @@
+"""
+Micro-benchmarks of the recognition stages, one result line per stage.
+
+    python bench_stages.py --image face.jpg --output results.jsonl
+
+Stages: base64 decode, cv2.imdecode, EmbeddingModel.get_embedding (detection + recognition) and
+embed_aligned (recognition only), then the gallery search in each variant: the window query, the
+ANN index query, the prototype query, and the in-memory gallery as float32 and int8. Search queries
+are stored embeddings with noise added, so they look like new photos of enrolled people.
+--skip-model / --skip-search run only one half, the search half needs a filled database (see
+generate_gallery.py).
+"""
+import argparse
+import base64
+import time
+
+import cv2
+import numpy as np
+
+from _common import summarize, time_calls, write_result  # also puts backend/ on the path
+
+from sqlalchemy import event, text
+
+VARIANTS = ("window", "ann", "ann_halfvec", "prototype", "memory", "memory_int8")
+
+
+def bench_decode(image_path, repeat, output):
+    with open(image_path, "rb") as f:
+        jpeg = f.read()
+    encoded = base64.b64encode(jpeg).decode()
+    params = {"image": image_path, "bytes": len(jpeg)}
+
+    def b64():
+        return base64.b64decode(encoded)
+
+    def imdecode():
+        return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+
+    write_result(output, "stages", "base64_decode", params, summarize(time_calls(b64, repeat)))
+    write_result(output, "stages", "imdecode", params, summarize(time_calls(imdecode, repeat)))
+    return imdecode()
+
+
+def bench_model(image, repeat, output):
+    from embedding_model import EmbeddingModel
+    model = EmbeddingModel()
+    params = {"shape": list(image.shape)}
+
+    write_result(output, "stages", "get_embedding", params,
+                 summarize(time_calls(lambda: model.get_embedding(image), repeat)))
+    write_result(output, "stages", "detect", params, summarize(time_calls(lambda: model.detect(image), repeat)))
+    face = model.detect(image)
+    if face is not None:
+        # The box an edge detector would send along, detection then runs on a smaller region
+        box = tuple(float(v) for v in face.bbox)
+        write_result(output, "stages", "detect_face_box", dict(params, face_box=[round(v) for v in box]),
+                     summarize(time_calls(lambda: model.detect(image, box), repeat)))
+    crop = model.detect_and_align(image)
+    if crop is not None:
+        write_result(output, "stages", "embed_aligned", params,
+                     summarize(time_calls(lambda: model.embed_aligned([crop]), repeat)))
+
+
+def _queries(db, count, noise, seed):
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT embedding::text FROM face_embeddings ORDER BY random() LIMIT :count"), {"count": count}
+        ).fetchall()
+    rng = np.random.default_rng(seed)
+    queries = []
+    for (embedding,) in rows:
+        query = db.parse_vector(embedding) + rng.normal(0, noise, 512).astype(np.float32)
+        queries.append(query / np.linalg.norm(query))
+    return queries
+
+
+def _search_function(db, variant, top_k):
+    if variant == "window":
+        def search(query):
+            with db.engine.connect() as conn:
+                return db._find_with_window_query(query, top_k, conn)
+    elif variant in ("ann", "ann_halfvec"):
+        def search(query):
+            db.ANN_HALFVEC = variant == "ann_halfvec"
+            return db._find_many_with_ann_query([query])[0]
+    elif variant == "prototype":
+        def search(query):
+            with db.engine.connect() as conn:
+                return db._find_with_prototype_query(query, conn)
+    else:
+        gallery = db.Gallery(quantization="int8" if variant == "memory_int8" else "none",
+                             rerank_candidates=db.GALLERY_RERANK_CANDIDATES)
+        gallery.fetch_embeddings = db._fetch_embeddings
+        gallery.load(db.engine)
+
+        def search(query):
+            return gallery.search(query, top_k)[0]
+    return search
+
+
+def _person_id(result):
+    if result is None:
+        return None
+    if isinstance(result, dict):
+        return result["person_id"]
+    return result[0][0] if result else None  # gallery: [(person_id, similarity), ...]
+
+
+def bench_search(variants, repeat, noise, top_k, seed, output):
+    import db
+
+    # The index parameters are normally only set in ann/prototype mode, here every variant runs
+    @event.listens_for(db.engine, "connect")
+    def _index_params(dbapi_connection, connection_record):
+        with dbapi_connection.cursor() as cur:
+            cur.execute("SET ivfflat.probes = %s", (db.ANN_PROBES,))
+            cur.execute("SET hnsw.ef_search = %s", (max(40, db.ANN_CANDIDATES),))
+        dbapi_connection.commit()
+
+    with db.engine.connect() as conn:
+        people = conn.execute(text("SELECT COUNT(*) FROM people")).scalar()
+        embeddings = conn.execute(text("SELECT COUNT(*) FROM face_embeddings")).scalar()
+    queries = _queries(db, repeat, noise, seed)
+    if not queries:
+        print("The database has no embeddings, run generate_gallery.py first.")
+        return
+
+    exact = None
+    for variant in variants:
+        try:
+            search = _search_function(db, variant, top_k)
+            results, latencies = [], []
+            search(queries[0])  # warm-up
+            for query in queries:
+                started = time.perf_counter()
+                results.append(search(query))
+                latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            print(f"{variant}: skipped, {str(e)}")
+            continue
+
+        found = [_person_id(result) for result in results]
+        if variant == "window":
+            exact = found
+        stats = summarize(latencies)
+        if exact is not None:
+            stats["recall_at_1"] = float(np.mean([a == b for a, b in zip(found, exact)]))
+        params = {"variant": variant, "people": people, "embeddings": embeddings, "top_k": top_k,
+                  "noise": noise, "ann_candidates": db.ANN_CANDIDATES, "ann_probes": db.ANN_PROBES,
+                  "prototype_candidates": db.PROTOTYPE_CANDIDATES,
+                  "rerank_candidates": db.GALLERY_RERANK_CANDIDATES}
+        write_result(output, "stages", "search", params, stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the recognition stages.")
+    parser.add_argument("--image", help="face photo (JPEG/PNG) for the decode and model stages")
+    parser.add_argument("--repeat", type=int, default=100, help="timed calls per stage")
+    parser.add_argument("--variants", default=",".join(VARIANTS),
+                        help=f"search variants, comma separated (default: all of {', '.join(VARIANTS)})")
+    parser.add_argument("--noise", type=float, default=0.02, help="noise added to the stored embeddings")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-model", action="store_true")
+    parser.add_argument("--skip-search", action="store_true")
+    parser.add_argument("--output", help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    if not args.skip_model:
+        if not args.image:
+            parser.error("--image is required unless --skip-model is given")
+        image = bench_decode(args.image, args.repeat, args.output)
+        if image is None:
+            parser.error(f"could not decode {args.image}")
+        bench_model(image, args.repeat, args.output)
+    if not args.skip_search:
+        variants = [v.strip() for v in args.variants.split(",") if v.strip()]
+        # The exact results are the reference for recall, so the window query runs first
+        variants.sort(key=lambda v: v != "window")
+        bench_search(variants, args.repeat, args.noise, args.top_k, args.seed, args.output)
+
+
+if __name__ == "__main__":
+    main()
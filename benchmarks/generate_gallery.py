@@ -0,0 +1,152 @@
+"""
+Fills the database with a synthetic gallery: N people with M random normalized 512-d embeddings each.
+
+    python generate_gallery.py --people 100000 --embeddings 3
+
+Each person gets a random direction and their embeddings are noisy copies of it, so a person's
+embeddings are closer to each other than to anyone else's, like real face embeddings. Synthetic
+people have passport numbers starting with BENCH and are removed with --clear.
+
+Meant for the throwaway database of benchmarks/docker-compose.yml (POSTGRES_PORT=5433): rows are
+written with COPY and the vector indexes are rebuilt at the end. The change notification triggers
+fire once per COPY, so a listening memory-mode gallery gets a few batched notifications per batch.
+"""
+import argparse
+import io
+import struct
+import time
+
+import numpy as np
+
+from _common import random_unit_vectors  # also puts backend/ on the path
+
+from sqlalchemy import text
+from db import engine
+
+PASSPORT_PREFIX = "BENCH"
+DIM = 512
+
+# Binary COPY row of (person_id integer, embedding vector): field count, then length + value per field.
+# pgvector's binary format is dim (int16), unused (int16) and the floats, all big-endian.
+_EMBEDDING_ROW = np.dtype([
+    ("fields", ">i2"), ("id_len", ">i4"), ("person_id", ">i4"),
+    ("vec_len", ">i4"), ("dim", ">i2"), ("unused", ">i2"), ("vec", ">f4", (DIM,)),
+])
+# (person_id integer, embedding_sum vector, centroid vector, embedding_count integer)
+_PROTOTYPE_ROW = np.dtype([
+    ("fields", ">i2"), ("id_len", ">i4"), ("person_id", ">i4"),
+    ("sum_len", ">i4"), ("sum_dim", ">i2"), ("sum_unused", ">i2"), ("sum", ">f4", (DIM,)),
+    ("centroid_len", ">i4"), ("centroid_dim", ">i2"), ("centroid_unused", ">i2"), ("centroid", ">f4", (DIM,)),
+    ("count_len", ">i4"), ("count", ">i4"),
+])
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_COPY_TRAILER = struct.pack(">h", -1)
+
+
+def _binary_copy(cursor, table, columns, rows):
+    buffer = io.BytesIO(_COPY_HEADER + rows.tobytes() + _COPY_TRAILER)
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)", buffer)
+
+
+def _embedding_rows(person_ids, embeddings):
+    rows = np.zeros(len(embeddings), dtype=_EMBEDDING_ROW)
+    rows["fields"], rows["id_len"], rows["vec_len"], rows["dim"] = 2, 4, 4 + 4 * DIM, DIM
+    rows["person_id"] = person_ids
+    rows["vec"] = embeddings
+    return rows
+
+
+def _prototype_rows(person_ids, embeddings_per_person):
+    sums = embeddings_per_person.sum(axis=1)
+    rows = np.zeros(len(person_ids), dtype=_PROTOTYPE_ROW)
+    rows["fields"], rows["id_len"], rows["count_len"] = 4, 4, 4
+    rows["sum_len"] = rows["centroid_len"] = 4 + 4 * DIM
+    rows["sum_dim"] = rows["centroid_dim"] = DIM
+    rows["person_id"] = person_ids
+    rows["sum"] = sums
+    rows["centroid"] = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    rows["count"] = embeddings_per_person.shape[1]
+    return rows
+
+
+def _insert_batch(cursor, first, count, per_person, flights, noise, prototypes, rng):
+    cursor.execute("SELECT nextval(pg_get_serial_sequence('people', 'id')) FROM generate_series(1, %s)", (count,))
+    person_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int32)
+
+    people = io.StringIO()
+    for i, person_id in enumerate(person_ids, first):
+        people.write(f"{person_id}\tBench\t{i}\t{20 + i % 60}\tXX\tBX{i % flights:04d}\t{PASSPORT_PREFIX}{i:09d}\n")
+    people.seek(0)
+    cursor.copy_expert("COPY people (id, name, surname, age, nationality, flight_no, passport_no) FROM STDIN", people)
+
+    centers = random_unit_vectors(count, DIM, rng)
+    embeddings = centers[:, None, :] + rng.standard_normal((count, per_person, DIM)).astype(np.float32) * noise
+    embeddings /= np.linalg.norm(embeddings, axis=2, keepdims=True)
+    _binary_copy(cursor, "face_embeddings", "person_id, embedding",
+                 _embedding_rows(np.repeat(person_ids, per_person), embeddings.reshape(-1, DIM)))
+    if prototypes:
+        _binary_copy(cursor, "person_prototypes", "person_id, embedding_sum, centroid, embedding_count",
+                     _prototype_rows(person_ids, embeddings))
+
+
+def clear():
+    with engine.begin() as conn:
+        deleted = conn.execute(text("DELETE FROM people WHERE passport_no LIKE :prefix"),
+                               {"prefix": PASSPORT_PREFIX + "%"}).rowcount
+    print(f"Removed {deleted} synthetic people.")
+
+
+def generate(people, per_person, flights=100, noise=0.03, batch_size=10000, prototypes=True, seed=0):
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        first = conn.execute(text("SELECT COUNT(*) FROM people WHERE passport_no LIKE :prefix"),
+                             {"prefix": PASSPORT_PREFIX + "%"}).scalar()
+    rng = np.random.default_rng([seed, first])  # a second run adds different people
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for start in range(0, people, batch_size):
+            count = min(batch_size, people - start)
+            _insert_batch(cursor, first + start, count, per_person, flights, noise, prototypes, rng)
+            raw.commit()
+            done = start + count
+            print(f"{done}/{people} people, {done * per_person} embeddings "
+                  f"({done / (time.perf_counter() - started):.0f} people/s)")
+
+        # The ivfflat lists were picked on an empty table, rebuild them on the real distribution
+        print("Rebuilding vector indexes and statistics...")
+        cursor.execute("SET maintenance_work_mem = '1GB'")
+        cursor.execute("REINDEX TABLE face_embeddings")
+        cursor.execute("REINDEX TABLE person_prototypes")
+        raw.commit()
+        raw.autocommit = True
+        cursor.execute("ANALYZE people")
+        cursor.execute("ANALYZE face_embeddings")
+        cursor.execute("ANALYZE person_prototypes")
+    finally:
+        raw.close()
+    print(f"Generated {people} people x {per_person} embeddings in {time.perf_counter() - started:.1f}s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic face embedding gallery to the database.")
+    parser.add_argument("--people", type=int, default=1000, help="people to add (1k to 1M)")
+    parser.add_argument("--embeddings", type=int, default=3, help="embeddings per person")
+    parser.add_argument("--flights", type=int, default=100, help="people are spread over this many flights")
+    parser.add_argument("--noise", type=float, default=0.03, help="spread of a person's embeddings")
+    parser.add_argument("--batch-size", type=int, default=10000, help="people per transaction")
+    parser.add_argument("--no-prototypes", action="store_true", help="don't fill person_prototypes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clear", action="store_true", help="remove the synthetic people first")
+    args = parser.parse_args()
+
+    if args.clear:
+        clear()
+    if args.people > 0:
+        generate(args.people, args.embeddings, args.flights, args.noise, args.batch_size,
+                 not args.no_prototypes, args.seed)
+
+
+if __name__ == "__main__":
+    main()
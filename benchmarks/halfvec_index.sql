@@ -0,0 +1,3 @@
+-- The half precision HNSW index of db/init.sql (commented out there), so that bench_stages.py's
+-- ann_halfvec variant walks an index instead of scanning the table. generate_gallery.py rebuilds it.
+CREATE INDEX ON face_embeddings USING hnsw ((embedding::halfvec(512)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
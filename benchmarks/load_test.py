@@ -0,0 +1,123 @@
+"""
+gRPC load generator for a running backend (server.py), reports throughput and latency percentiles.
+
+    python load_test.py --image face.jpg --concurrency 1,4,16,64 --duration 30 --output results.jsonl
+
+Each concurrency level is a closed loop: that many threads send requests back to back over
+--channels shared connections for --duration seconds, after --warmup seconds that are not counted.
+NOT_FOUND (no face or no match) is a normal answer and is counted as such, other codes are errors.
+Every request has its own source id, so the result cache never answers it; --cache sends them all
+from the same source to measure the cached path instead.
+"""
+import argparse
+import base64
+import itertools
+import threading
+import time
+from collections import Counter
+
+import grpc
+
+from _common import summarize, write_result  # also puts backend/ on the path
+
+import facerecognizer_pb2 as pb2
+import facerecognizer_pb2_grpc as pb2_grpc
+
+RPCS = ("RecognizeV2", "Recognize", "RecognizeBatchV2")
+
+
+def _request_factory(rpc, image_bytes, batch_size, cache):
+    counter = itertools.count()
+
+    def source_id():
+        return "loadtest" if cache else f"loadtest-{next(counter)}"
+
+    if rpc == "Recognize":
+        image_base64 = base64.b64encode(image_bytes).decode()
+        return lambda: pb2.FaceRequest(image_base64=image_base64, source_id=source_id())
+    image = pb2.Image(encoded=image_bytes)
+    if rpc == "RecognizeBatchV2":
+        return lambda: pb2.FaceBatchRequestV2(images=[image] * batch_size, source_id=source_id())
+    return lambda: pb2.FaceRequestV2(image=image, source_id=source_id())
+
+
+def run_level(address, rpc, image_bytes, concurrency, duration, warmup, channels, timeout, batch_size, cache):
+    # A local subchannel pool per channel, otherwise channels to the same address share one connection
+    grpc_channels = [grpc.insecure_channel(address, options=[("grpc.use_local_subchannel_pool", 1)])
+                     for _ in range(channels)]
+    stubs = [getattr(pb2_grpc.FaceRecognizerStub(channel), rpc) for channel in grpc_channels]
+    for channel in grpc_channels:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    make_request = _request_factory(rpc, image_bytes, batch_size, cache)
+
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    latencies, codes = [], Counter()
+    lock = threading.Lock()
+
+    def worker(stub):
+        own_latencies, own_codes = [], Counter()
+        while True:
+            request = make_request()
+            sent = time.perf_counter()
+            if sent >= stop_at:
+                break
+            try:
+                stub(request, timeout=timeout)
+                code = grpc.StatusCode.OK
+            except grpc.RpcError as e:
+                code = e.code()
+            if sent >= measure_from:
+                own_latencies.append(time.perf_counter() - sent)
+                own_codes[code.name] += 1
+        with lock:
+            latencies.extend(own_latencies)
+            codes.update(own_codes)
+
+    threads = [threading.Thread(target=worker, args=(stubs[i % len(stubs)],)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for channel in grpc_channels:
+        channel.close()
+
+    answered = codes["OK"] + codes["NOT_FOUND"]
+    stats = summarize(latencies, duration)
+    stats["codes"] = dict(codes)
+    stats["error_rate"] = 1 - answered / max(1, sum(codes.values()))
+    if rpc == "RecognizeBatchV2":
+        stats["faces_per_s"] = stats.get("throughput_per_s", 0) * batch_size
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running FaceRecognizer backend.")
+    parser.add_argument("--address", default="localhost:50051")
+    parser.add_argument("--image", required=True, help="face photo (JPEG/PNG) sent in every request")
+    parser.add_argument("--rpc", choices=RPCS, default="RecognizeV2")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated levels, one run each")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=5, help="unmeasured seconds before each level")
+    parser.add_argument("--channels", type=int, default=1, help="gRPC connections shared by the threads")
+    parser.add_argument("--timeout", type=float, default=10, help="deadline per call in seconds")
+    parser.add_argument("--batch-size", type=int, default=8, help="images per RecognizeBatchV2 call")
+    parser.add_argument("--cache", action="store_true", help="same source id for all requests (result cache)")
+    parser.add_argument("--output", help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        image_bytes = f.read()
+
+    for concurrency in (int(c) for c in args.concurrency.split(",") if c.strip()):
+        stats = run_level(args.address, args.rpc, image_bytes, concurrency, args.duration, args.warmup,
+                          args.channels, args.timeout, args.batch_size, args.cache)
+        params = {"address": args.address, "rpc": args.rpc, "concurrency": concurrency,
+                  "duration": args.duration, "channels": args.channels, "image_bytes": len(image_bytes),
+                  "batch_size": args.batch_size if args.rpc == "RecognizeBatchV2" else 1, "cache": args.cache}
+        write_result(args.output, "load_test", args.rpc, params, stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,4 +23,70 @@ CREATE TABLE face_embeddings (
 
 -- Indexes for efficient querying
 CREATE INDEX ON face_embeddings USING ivfflat (embedding vector_cosine_ops) WITH (lists = 50);
-CREATE INDEX ON face_embeddings (person_id);
\ No newline at end of file
+-- HNSW alternative to the ivfflat index above (pgvector >= 0.5.0). Better recall/latency trade-off and it does
+-- not need to be rebuilt as the gallery grows, at the cost of slower inserts. Use one of the two (ANN_INDEX=hnsw):
+-- CREATE INDEX ON face_embeddings USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+-- Half precision HNSW index for ANN_HALFVEC=1 (pgvector >= 0.7.0), half the size of the index above:
+-- CREATE INDEX ON face_embeddings USING hnsw ((embedding::halfvec(512)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX ON face_embeddings (person_id);
+-- Scoped searches (SearchScope on the recognition requests) only look at the passengers of some flights
+CREATE INDEX ON people (flight_no);
+
+-- Flights served by each checkpoint/kiosk group, used by SearchScope.checkpoint_id
+CREATE TABLE checkpoint_flights (
+    checkpoint_id TEXT NOT NULL,
+    flight_no TEXT NOT NULL,
+    PRIMARY KEY (checkpoint_id, flight_no)
+);
+
+-- Per-person prototype for SEARCH_MODE=prototype: running sum and count of the person's embeddings and
+-- their normalized centroid. Searches pick the closest people by centroid first, then compare only
+-- their embeddings. Maintained by the backend in the same transaction as the embedding writes.
+CREATE TABLE person_prototypes (
+    person_id INTEGER PRIMARY KEY REFERENCES people(id) ON DELETE CASCADE,
+    embedding_sum VECTOR(512) NOT NULL,
+    centroid VECTOR(512) NOT NULL,
+    embedding_count INTEGER NOT NULL
+);
+CREATE INDEX ON person_prototypes USING ivfflat (centroid vector_cosine_ops) WITH (lists = 50);
+
+-- Change notifications, used by the backend's in-memory gallery (SEARCH_MODE=memory) to stay in sync
+-- with other writers. Statement-level, so a bulk insert sends one notification per 200 changed rows
+-- instead of one per row. Payload format: "<table>:<operation>:<row id>/<person id>,<row id>/<person id>,..."
+CREATE OR REPLACE FUNCTION notify_face_embeddings_change() RETURNS trigger AS $$
+BEGIN
+    -- changed_rows is the transition table of the trigger: the new rows, or the old ones on DELETE
+    IF TG_TABLE_NAME = 'people' THEN
+        PERFORM pg_notify('face_embeddings_changed', 'people:' || TG_OP || ':' || string_agg(id || '/' || id, ','))
+        FROM (SELECT id, (row_number() OVER () - 1) / 200 AS chunk FROM changed_rows) chunks
+        GROUP BY chunk;
+    ELSE
+        PERFORM pg_notify('face_embeddings_changed',
+                          'face_embeddings:' || TG_OP || ':' || string_agg(id || '/' || person_id, ','))
+        FROM (SELECT id, person_id, (row_number() OVER () - 1) / 200 AS chunk FROM changed_rows) chunks
+        GROUP BY chunk;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A trigger with a transition table can only have one event
+CREATE TRIGGER people_insert_notify
+    AFTER INSERT ON people REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
+CREATE TRIGGER people_update_notify
+    AFTER UPDATE ON people REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
+CREATE TRIGGER people_delete_notify
+    AFTER DELETE ON people REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
+
+CREATE TRIGGER face_embeddings_insert_notify
+    AFTER INSERT ON face_embeddings REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
+CREATE TRIGGER face_embeddings_update_notify
+    AFTER UPDATE ON face_embeddings REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
+CREATE TRIGGER face_embeddings_delete_notify
+    AFTER DELETE ON face_embeddings REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_face_embeddings_change();
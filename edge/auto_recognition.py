@@ -0,0 +1,117 @@
+import threading
+import time
+
+from pipeline import LatestFrame
+
+
+class AutoRecognizer:
+    """
+    Recognizes every face track once, without a button press.
+
+    Follows the pipeline snapshots on its own thread, so the camera and detection loops never wait
+    for it. For each track it keeps the frame where the face was detected with the best quality
+    (detector confidence times box area). Once the track has min_hits detections, that frame goes to
+    the backend with a non-blocking call, and the answer is kept until the track has been gone for
+    expire_after seconds. "No match" is an answer too: the track stays unknown and is not sent again.
+    Only a call that failed without an answer (unreachable, deadline, server busy, cancelled) is retried
+    after retry_after seconds. The current results are published as one snapshot for the UI.
+    """
+
+    def __init__(self, source, recognize_async, min_hits=3, expire_after=2.0, retry_after=2.0):
+        self.source = source  # LatestFrame with pipeline snapshots
+        # (frame, face, callback) -> None, callback(result, retry=False) gets the result or None for no
+        # match, retry=True when the call failed without an answer
+        self.recognize_async = recognize_async
+        self.min_hits = min_hits
+        self.expire_after = expire_after
+        self.retry_after = retry_after  # wait before retrying a track whose request failed
+        self.results = LatestFrame()  # list of finished tracks for the UI
+        self.requests_sent = 0
+        self.running = False
+        self._tracks = {}  # track id -> state dict
+        self._lock = threading.Lock()  # results arrive on gRPC threads
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        version = 0
+        while self.running:
+            version, snapshot = self.source.wait_newer(version)
+            if snapshot is not None:
+                self._observe(snapshot)
+
+    def _observe(self, snapshot):
+        now = time.monotonic()
+        to_send = []
+        with self._lock:
+            for face in snapshot["faces"]:
+                track = self._tracks.get(face["track_id"])
+                if track is None:
+                    track = self._tracks[face["track_id"]] = {
+                        "state": "new", "quality": 0.0, "frame": None, "face": None, "result": None,
+                        "next_attempt": 0.0,
+                    }
+                track["last_seen"] = now
+
+                # Predicted boxes only move the last detection, they say nothing about quality
+                if track["state"] == "new" and not face.get("predicted"):
+                    _, _, w, h = face["box"]
+                    quality = float(face["prob"]) * w * h
+                    if quality > track["quality"]:
+                        track["quality"], track["frame"], track["face"] = quality, snapshot["frame"], face
+
+                if (track["state"] == "new" and face["hits"] >= self.min_hits and track["frame"] is not None
+                        and now >= track["next_attempt"]):
+                    track["state"] = "pending"
+                    to_send.append((face["track_id"], track["frame"], track["face"]))
+
+            expired = [track_id for track_id, track in self._tracks.items()
+                       if now - track["last_seen"] > self.expire_after]
+            for track_id in expired:
+                del self._tracks[track_id]
+
+        for track_id, frame, face in to_send:
+            try:
+                self.recognize_async(frame, face, lambda result, retry=False, track_id=track_id:
+                                     self._on_result(track_id, result, retry))
+                self.requests_sent += 1
+            except Exception as e:
+                print(f"Auto recognition error: {str(e)}")
+                with self._lock:
+                    track = self._tracks.get(track_id)
+                    if track is not None:
+                        track["state"] = "new"
+                        track["next_attempt"] = now + self.retry_after
+        if expired:
+            self._publish()
+
+    def _on_result(self, track_id, result, retry=False):
+        with self._lock:
+            track = self._tracks.get(track_id)
+            if track is None:
+                return  # the passenger left before the answer came
+            if retry:
+                # No answer (e.g. UNAVAILABLE, DEADLINE_EXCEEDED), try again while in view
+                track["state"] = "new"
+                track["next_attempt"] = time.monotonic() + self.retry_after
+                return
+            # A match, or None for an unknown face, either way final for this track
+            track["state"] = "done"
+            track["result"] = result
+            track["frame"] = None  # no longer needed, don't keep the frame alive
+        self._publish()
+
+    def _publish(self):
+        with self._lock:
+            results = [
+                {"track_id": track_id, "face_location": track["face"]["box"], "result": track["result"]}
+                for track_id, track in self._tracks.items() if track["state"] == "done"
+            ]
+        self.results.publish(results)
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from pipeline import LatestFrame
+
+
+def _mjpeg_part(jpeg):
+    return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
+
+class FrameBroadcaster:
+    """
+    Encodes every new processed frame to JPEG exactly once and fans the same bytes out to all
+    /video_feed clients.
+
+    One encoder thread follows the pipeline output and publishes the JPEG bytes as a versioned
+    snapshot, it only runs while someone is watching. Each subscriber sends the newest encoded frame
+    at most max_fps times per second and skips whatever was published in between, so a slow client
+    never holds back the encoder or the other clients.
+    """
+
+    def __init__(self, source, key="display_frame", quality=95):
+        self.source = source  # LatestFrame with pipeline snapshots
+        self.key = key
+        self.quality = quality
+        self.output = LatestFrame()  # encoded JPEG bytes
+        self.encoded_frames = 0
+        self.subscribers = 0
+        self._subscribers_changed = threading.Condition()
+        self._thread = None
+        # Shown until the first frame arrives, encoded once
+        self.idle_frame = self._encode(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    def _encode(self, frame):
+        ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buffer.tobytes() if ok else None
+
+    def _subscribe(self):
+        with self._subscribers_changed:
+            self.subscribers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._subscribers_changed.notify_all()
+
+    def _unsubscribe(self):
+        with self._subscribers_changed:
+            self.subscribers -= 1
+
+    def _run(self):
+        version = 0
+        while True:
+            with self._subscribers_changed:
+                self._subscribers_changed.wait_for(lambda: self.subscribers > 0)
+
+            version, snapshot = self.source.wait_newer(version)
+            if snapshot is None:
+                continue
+            jpeg = self._encode(snapshot[self.key])
+            if jpeg is not None:
+                self.output.publish(jpeg)
+                self.encoded_frames += 1
+
+    def stream(self, is_active, max_fps=25):
+        """Multipart MJPEG generator for one client, runs while is_active() is true"""
+        interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self._subscribe()
+        try:
+            version = 0
+            while is_active():
+                new_version, jpeg = self.output.wait_newer(version)
+                if jpeg is None:
+                    # Nothing encoded yet, repeat the idle frame about once per wait timeout
+                    yield _mjpeg_part(self.idle_frame)
+                    continue
+                if new_version == version:
+                    continue
+                version = new_version
+
+                sent = time.monotonic()
+                yield _mjpeg_part(jpeg)
+                # Frame rate cap, frames published meanwhile are skipped
+                remaining = interval - (time.monotonic() - sent)
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            self._unsubscribe()
@@ -1,14 +1,241 @@
 import grpc
+import itertools
+import json
+import os
+import threading
 import facerecognizer_pb2 as pb2
 import facerecognizer_pb2_grpc as pb2_grpc
+from utils import image_to_jpeg_bytes
+import tracing
+
+# How the v2 calls send frames: "jpeg" (compressed bytes) or "raw" (uncompressed BGR pixels, for a
+# backend on the same host or a fast local network where encoding costs more than the bytes)
+IMAGE_TRANSPORT = os.getenv("IMAGE_TRANSPORT", "jpeg")
+# Identifies this kiosk to the backend, repeated frames of the same passenger are answered from its result cache
+KIOSK_ID = os.getenv("KIOSK_ID", "")
+# Optional search scope: only passengers of these flights (comma separated) and/or of the flights of this checkpoint
+SEARCH_FLIGHTS = [f.strip() for f in os.getenv("SEARCH_FLIGHTS", "").split(",") if f.strip()]
+CHECKPOINT_ID = os.getenv("CHECKPOINT_ID", "")
+
+BACKEND_ADDRESS = os.getenv("BACKEND_ADDRESS", "localhost:50051")
+GRPC_CHANNELS = int(os.getenv("GRPC_CHANNELS", 1))  # persistent connections, calls are spread round robin
+RECOGNIZE_TIMEOUT = float(os.getenv("RECOGNIZE_TIMEOUT", 5))  # seconds, deadline of the recognition calls
+ENROLL_TIMEOUT = float(os.getenv("ENROLL_TIMEOUT", 30))  # seconds, deadline of the registration calls
+GRPC_COMPRESSION = os.getenv("GRPC_COMPRESSION", "none")  # "gzip" compresses requests that carry images
+
+# Recognition is read-only, so it is safe to retry when the backend is briefly unreachable.
+# Registration calls write to the database and are never retried.
+_RETRY_SERVICE_CONFIG = {
+    "methodConfig": [{
+        "name": [
+            {"service": "facerecognizer.FaceRecognizer", "method": method}
+            for method in ("Recognize", "RecognizeV2", "RecognizeBatch", "RecognizeBatchV2")
+        ],
+        "retryPolicy": {
+            "maxAttempts": 3,
+            "initialBackoff": "0.1s",
+            "maxBackoff": "1s",
+            "backoffMultiplier": 2,
+            "retryableStatusCodes": ["UNAVAILABLE"],
+        },
+    }]
+}
+
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.enable_retries", 1),
+    ("grpc.service_config", json.dumps(_RETRY_SERVICE_CONFIG)),
+    # Without this, channels with the same target share one connection and a pool would not be one
+    ("grpc.use_local_subchannel_pool", 1),
+]
+
+# Failures that say nothing about the face, a later call can still answer it. NOT_FOUND (no match) is an answer.
+RETRY_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.RESOURCE_EXHAUSTED}
+
+
+def image_message(frame, aligned=False, face_box=None):
+    """
+    Builds a v2 Image message from a BGR frame, aligned=True marks a pre-aligned 112x112 face crop.
+    face_box (x, y, w, h) is where the face is in the frame, the backend then detects it in that region only.
+    """
+    with tracing.span("encode", transport=IMAGE_TRANSPORT):
+        message = _image_message(frame, aligned)
+    if face_box is not None:
+        x, y, w, h = face_box
+        message.face_box.CopyFrom(pb2.FaceBox(x=float(x), y=float(y), width=float(w), height=float(h)))
+    return message
+
+
+def _image_message(frame, aligned):
+    if IMAGE_TRANSPORT == "raw":
+        height, width = frame.shape[:2]
+        return pb2.Image(raw=pb2.RawImage(
+            width=width,
+            height=height,
+            layout=pb2.RawImage.BGR,
+            data=frame.tobytes()
+        ), aligned_face=aligned)
+    return pb2.Image(encoded=image_to_jpeg_bytes(frame), aligned_face=aligned)
+
+
+def _scoped(request):
+    """Adds the kiosk's search scope to a recognition request, if one is configured"""
+    if SEARCH_FLIGHTS or CHECKPOINT_ID:
+        request.scope.flight_nos.extend(SEARCH_FLIGHTS)
+        request.scope.checkpoint_id = CHECKPOINT_ID
+    return request
+
+
+def _compression(name):
+    return grpc.Compression.Gzip if name == "gzip" else grpc.Compression.NoCompression
+
+
+class FaceRecognizerClient:
+    """
+    Long-lived connection to the backend.
+
+    Holds `channels` persistent channels with keepalive and spreads the calls over them round robin.
+    Every call gets a deadline, recognition calls are retried on UNAVAILABLE, and requests that carry
+    images can be gzip compressed. The methods return the raw responses and raise grpc.RpcError,
+    the module functions below turn them into the dicts the web app uses.
+    """
+
+    def __init__(self, target=BACKEND_ADDRESS, channels=GRPC_CHANNELS, recognize_timeout=RECOGNIZE_TIMEOUT,
+                 enroll_timeout=ENROLL_TIMEOUT, compression=GRPC_COMPRESSION):
+        self.target = target
+        self.recognize_timeout = recognize_timeout
+        self.enroll_timeout = enroll_timeout
+        self.compression = _compression(compression)
+        self._channels = [grpc.insecure_channel(target, options=CHANNEL_OPTIONS) for _ in range(max(1, channels))]
+        # Traced UI requests send their trace context along and get an rpc span per call
+        self._stubs = [pb2_grpc.FaceRecognizerStub(grpc.intercept_channel(channel, tracing.TracingInterceptor()))
+                       for channel in self._channels]
+        self._next = itertools.count()
+
+    def _stub(self):
+        return self._stubs[next(self._next) % len(self._stubs)]
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def recognize(self, base64_img):
+        request = _scoped(pb2.FaceRequest(image_base64=base64_img, source_id=KIOSK_ID))
+        return self._stub().Recognize(request, timeout=self.recognize_timeout, compression=self.compression)
+
+    def recognize_v2(self, frame, aligned=False, face_box=None):
+        request = _scoped(pb2.FaceRequestV2(image=image_message(frame, aligned, face_box), source_id=KIOSK_ID))
+        return self._stub().RecognizeV2(request, timeout=self.recognize_timeout, compression=self.compression)
+
+    def recognize_v2_future(self, frame, aligned=False, face_box=None):
+        """Non-blocking recognize_v2, returns a grpc.Future"""
+        request = _scoped(pb2.FaceRequestV2(image=image_message(frame, aligned, face_box), source_id=KIOSK_ID))
+        return self._stub().RecognizeV2.future(request, timeout=self.recognize_timeout,
+                                               compression=self.compression)
+
+    def recognize_batch(self, base64_images):
+        request = _scoped(pb2.FaceBatchRequest(images=base64_images, source_id=KIOSK_ID))
+        return self._stub().RecognizeBatch(request, timeout=self.recognize_timeout, compression=self.compression)
+
+    def recognize_stream(self, base64_images):
+        """Long-lived call, no deadline, the caller ends it by exhausting the image iterable"""
+        requests = (_scoped(pb2.FaceRequest(image_base64=image, source_id=KIOSK_ID)) for image in base64_images)
+        return self._stub().RecognizeStream(requests, compression=self.compression)
+
+    def register_person(self, base64_img, name, surname, age, nationality, flight_no, passport_no):
+        request = pb2.RegisterPersonRequest(
+            name=name,
+            surname=surname,
+            age=age,
+            nationality=nationality,
+            flight_no=flight_no,
+            passport_no=passport_no,
+            image_base64=base64_img
+        )
+        return self._stub().RegisterPerson(request, timeout=self.enroll_timeout, compression=self.compression)
+
+    def add_embedding(self, base64_img, person_id):
+        request = pb2.AddEmbeddingRequest(person_id=person_id, image_base64=base64_img)
+        return self._stub().AddEmbedding(request, timeout=self.enroll_timeout, compression=self.compression)
+
+    def add_embedding_v2(self, frame, person_id, aligned=False, face_box=None):
+        request = pb2.AddEmbeddingRequestV2(person_id=person_id, image=image_message(frame, aligned, face_box))
+        return self._stub().AddEmbeddingV2(request, timeout=self.enroll_timeout, compression=self.compression)
+
+    def register_complete_person(self, name, surname, age, nationality, flight_no, passport_no, images):
+        request = pb2.RegisterCompletePersonRequest(
+            name=name,
+            surname=surname,
+            age=int(age),
+            nationality=nationality,
+            flight_no=flight_no,
+            passport_no=passport_no,
+            images=images
+        )
+        return self._stub().RegisterCompletePerson(request, timeout=self.enroll_timeout,
+                                                   compression=self.compression)
+
+
+class AsyncFaceRecognizerClient:
+    """grpc.aio version of FaceRecognizerClient for asyncio callers, one channel per client"""
+
+    def __init__(self, target=BACKEND_ADDRESS, recognize_timeout=RECOGNIZE_TIMEOUT, enroll_timeout=ENROLL_TIMEOUT,
+                 compression=GRPC_COMPRESSION):
+        self.recognize_timeout = recognize_timeout
+        self.enroll_timeout = enroll_timeout
+        self.compression = _compression(compression)
+        self._channel = grpc.aio.insecure_channel(target, options=CHANNEL_OPTIONS)
+        self._stub = pb2_grpc.FaceRecognizerStub(self._channel)
+
+    async def close(self):
+        await self._channel.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def recognize_v2(self, frame, aligned=False, face_box=None):
+        request = _scoped(pb2.FaceRequestV2(image=image_message(frame, aligned, face_box), source_id=KIOSK_ID))
+        return await self._stub.RecognizeV2(request, timeout=self.recognize_timeout, compression=self.compression)
+
+    async def recognize_batch_v2(self, frames, aligned=False):
+        request = _scoped(pb2.FaceBatchRequestV2(images=[image_message(frame, aligned) for frame in frames],
+                                                 source_id=KIOSK_ID))
+        return await self._stub.RecognizeBatchV2(request, timeout=self.recognize_timeout,
+                                                 compression=self.compression)
+
+    async def add_embedding_v2(self, frame, person_id, aligned=False, face_box=None):
+        request = pb2.AddEmbeddingRequestV2(person_id=person_id, image=image_message(frame, aligned, face_box))
+        return await self._stub.AddEmbeddingV2(request, timeout=self.enroll_timeout, compression=self.compression)
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """Client shared by the module functions, created on first use"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = FaceRecognizerClient()
+        return _default_client
 
 
 def send_face(base64_img: str):
-    channel = grpc.insecure_channel('localhost:50051')
-    stub = pb2_grpc.FaceRecognizerStub(channel)
-    request = pb2.FaceRequest(image_base64=base64_img)
     try:
-        response = stub.Recognize(request)
+        response = default_client().recognize(base64_img)
         print(
             f"Matching person: {response.name} {response.surname}\n(similarity: {response.similarity})\npasaport no: {response.passport_no}\nage: {response.age}\nflight no: {response.flight_no}")
 
@@ -27,20 +254,78 @@ def send_face(base64_img: str):
         return None
 
 
+def _face_result_to_dict(result):
+    if not result.success:
+        return None
+    face = result.face
+    return {
+        "name": face.name,
+        "surname": face.surname,
+        "age": face.age,
+        "nationality": face.nationality,
+        "passport_no": face.passport_no,
+        "flight_no": face.flight_no,
+        "similarity": face.similarity
+    }
+
+
+def send_face_v2(frame, aligned=False, face_box=None):
+    """Same as send_face, but sends the frame as bytes instead of a base64 string"""
+    try:
+        response = default_client().recognize_v2(frame, aligned, face_box)
+        return _face_result_to_dict(pb2.FaceResult(success=True, face=response))
+    except grpc.RpcError as rpc_error:
+        print(f"GRPC error: {rpc_error.details()}")
+        return None
+
+
+def send_face_v2_async(frame, callback, aligned=False, face_box=None):
+    """
+    Non-blocking send_face_v2, returns right after sending the request. callback gets the result dict
+    (or None) on a gRPC thread once the response arrives, and retry=True when the call failed for a
+    reason worth retrying (see RETRY_CODES) rather than with an answer like NOT_FOUND (no match).
+    """
+    call = default_client().recognize_v2_future(frame, aligned, face_box)
+
+    def on_done(future):
+        try:
+            response = future.result()
+        except grpc.FutureCancelledError:
+            callback(None, retry=True)
+            return
+        except grpc.RpcError as rpc_error:
+            print(f"GRPC error: {rpc_error.details()}")
+            callback(None, retry=rpc_error.code() in RETRY_CODES)
+            return
+        callback(_face_result_to_dict(pb2.FaceResult(success=True, face=response)))
+
+    call.add_done_callback(on_done)
+    return call
+
+
+def send_faces_batch(base64_images):
+    """Recognizes several images in one call, returns a result dict (or None) per image"""
+    try:
+        response = default_client().recognize_batch(base64_images)
+        return [_face_result_to_dict(result) for result in response.results]
+    except grpc.RpcError as rpc_error:
+        print(f"GRPC error: {rpc_error.details()}")
+        return [None] * len(base64_images)
+
+
+def recognize_stream(base64_images):
+    """
+    Opens a RecognizeStream call for an iterable of base64 images (e.g. a kiosk feed) and yields a
+    result dict (or None) for each of them, in order.
+    """
+    for result in default_client().recognize_stream(base64_images):
+        yield _face_result_to_dict(result)
+
+
 def register_new_person(base64_img, name, surname, age, nationality, flight_no, passport_no):
     """first registers a person, then adds the first embedding"""
-    channel = grpc.insecure_channel('localhost:50051')
-    stub = pb2_grpc.FaceRecognizerStub(channel)
-    request = pb2.RegisterPersonRequest(
-        name=name,
-        surname=surname,
-        age=age,
-        nationality=nationality,
-        flight_no=flight_no,
-        passport_no=passport_no,
-        image_base64=base64_img
-    )
-    response = stub.RegisterPerson(request)
+    response = default_client().register_person(base64_img, name, surname, age, nationality, flight_no,
+                                                 passport_no)
     print("Registered Sucesfully:" if response.success else "Register failed:", response.message)
     print(f"Sucessfull first register, person_id: {response.person_id}")  # debug
     return response
@@ -48,37 +333,22 @@ def register_new_person(base64_img, name, surname, age, nationality, flight_no,
 
 def add_embedding_to_person_by_id(base64_img, person_id):
     """Adds an embedding to a person by their ID."""
-    channel = grpc.insecure_channel('localhost:50051')
-    stub = pb2_grpc.FaceRecognizerStub(channel)
-    request = pb2.AddEmbeddingRequest(
-        person_id=person_id,
-        image_base64=base64_img
-    )
-    response = stub.AddEmbedding(request)
-    return response
+    return default_client().add_embedding(base64_img, person_id)
+
+
+def add_embedding_to_person_by_id_v2(frame, person_id, aligned=False, face_box=None):
+    """Same as add_embedding_to_person_by_id, but sends the frame as bytes"""
+    return default_client().add_embedding_v2(frame, person_id, aligned, face_box)
 
 
 def register_person_with_embeddings(name, surname, age, nationality, flight_no, passport_no, images):
     """
     Registers a person with multiple images and returns the response.
     """
-    channel = grpc.insecure_channel('localhost:50051')
-    stub = pb2_grpc.FaceRecognizerStub(channel)
-
     try:
-        # Create grpc request
-        request = pb2.RegisterCompletePersonRequest(
-            name=name,
-            surname=surname,
-            age=int(age),
-            nationality=nationality,
-            flight_no=flight_no,
-            passport_no=passport_no,
-            images=images
-        )
-
         # Send the request to the server
-        response = stub.RegisterCompletePerson(request)
+        response = default_client().register_complete_person(name, surname, age, nationality, flight_no,
+                                                             passport_no, images)
 
         return {
             "success": response.success,
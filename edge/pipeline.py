@@ -0,0 +1,267 @@
+import itertools
+import threading
+import time
+
+import cv2
+
+
+class LatestFrame:
+    """
+    Latest-value handoff between pipeline stages.
+
+    Producers publish a new immutable snapshot by swapping one reference under the condition's lock,
+    which keeps the versions distinct when several threads publish (e.g. recognition results arriving
+    on gRPC threads). Readers just take the current reference and never wait. The condition also
+    wakes consumers that sleep until something newer arrives.
+    """
+
+    def __init__(self):
+        self._latest = (0, None)  # (version, value), replaced as a whole
+        self._changed = threading.Condition()
+
+    def publish(self, value):
+        with self._changed:
+            self._latest = (self._latest[0] + 1, value)
+            self._changed.notify_all()
+
+    def get(self):
+        """Returns (version, value) of the latest snapshot"""
+        return self._latest
+
+    def wait_newer(self, version, timeout=1.0):
+        """Waits until a snapshot newer than version is published, returns (version, value)"""
+        latest = self._latest
+        if latest[0] > version:
+            return latest
+        with self._changed:
+            self._changed.wait_for(lambda: self._latest[0] > version, timeout)
+        return self._latest
+
+
+class StageStats:
+    """Frames per second and processing latency of a pipeline stage (exponential moving averages)"""
+
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.frames = 0
+        self.fps = 0.0
+        self.latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self._last_tick = None
+
+    def tick(self, latency=None):
+        now = time.perf_counter()
+        if self._last_tick is not None and now > self._last_tick:
+            self.fps += self.smoothing * (1.0 / (now - self._last_tick) - self.fps)
+        self._last_tick = now
+        self.frames += 1
+        if latency is not None:
+            latency_ms = latency * 1000.0
+            self.latency_ms += self.smoothing * (latency_ms - self.latency_ms)
+            self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+
+    def snapshot(self):
+        return {
+            "frames": self.frames,
+            "fps": round(self.fps, 1),
+            "latency_ms": round(self.latency_ms, 1),
+            "max_latency_ms": round(self.max_latency_ms, 1),
+        }
+
+
+def _iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+class FaceTracker:
+    """
+    Lightweight box tracker for the frames between two MTCNN passes.
+
+    Detections are matched to tracks by IoU. Between detections each track moves with its last
+    velocity, and its landmarks move with it. A track is dropped after max_misses detection passes
+    without a match.
+    """
+
+    def __init__(self, min_iou=0.3, max_misses=2):
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, detections):
+        """Matches a fresh detection pass to the tracks, returns the tracked faces"""
+        unmatched = list(range(len(self.tracks)))
+        matched_tracks = []
+        for face in sorted(detections, key=lambda f: -f["prob"]):
+            best, best_iou = None, self.min_iou
+            for i in unmatched:
+                iou = _iou(self.tracks[i]["box"], face["box"])
+                if iou >= best_iou:
+                    best, best_iou = i, iou
+
+            if best is None:
+                track = {"track_id": next(self._ids), "hits": 0, "misses": 0, "velocity": (0.0, 0.0)}
+            else:
+                track = self.tracks[best]
+                unmatched.remove(best)
+                # From the last detected box, "box" has already been moved by predict(). Per detection
+                # pass, the track may have missed some since then
+                (px, py, _, _), (x, y, _, _) = track["detected_box"], face["box"]
+                passes = track["misses"] + 1
+                track["velocity"] = ((x - px) / passes, (y - py) / passes)
+            track.update(face)
+            track["detected_box"] = face["box"]
+            track["hits"] += 1
+            track["misses"] = 0
+            track["predicted"] = False
+            matched_tracks.append(track)
+
+        for i in unmatched:
+            track = self.tracks[i]
+            track["misses"] += 1
+            if track["misses"] <= self.max_misses:
+                matched_tracks.append(track)
+        self.tracks = matched_tracks
+        return self.faces()
+
+    def predict(self, steps):
+        """Moves the tracks for a frame without detection, steps is the number of frames per detection pass"""
+        for track in self.tracks:
+            vx, vy = track["velocity"]
+            dx, dy = vx / steps, vy / steps
+            x, y, w, h = track["box"]
+            track["box"] = (int(round(x + dx)), int(round(y + dy)), w, h)
+            if track.get("landmarks") is not None:
+                track["landmarks"] = track["landmarks"] + (dx, dy)
+            track["predicted"] = True
+        return self.faces()
+
+    def faces(self):
+        return [dict(track) for track in self.tracks if track["misses"] == 0]
+
+
+class CaptureStage:
+    """Reads the camera as fast as it delivers frames and publishes them, nothing else runs here"""
+
+    def __init__(self, source=0):
+        self.source = source
+        self.output = LatestFrame()
+        self.stats = StageStats()
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        camera = cv2.VideoCapture(self.source)
+        try:
+            while self.running:
+                ret, frame = camera.read()
+                if not ret:
+                    print("Couldn't open camera.")
+                    break
+                self.output.publish(frame)
+                self.stats.tick()
+        finally:
+            self.running = False
+            camera.release()
+
+
+class DetectionStage:
+    """
+    Runs the face detector on every detect_every-th frame and the tracker on the frames in between,
+    draws the overlay and publishes a snapshot dict with the raw frame, the display frame and the faces.
+    Only the newest captured frame is processed, frames that arrived meanwhile are skipped.
+    """
+
+    def __init__(self, source, detect, render, detect_every=3):
+        self.source = source  # LatestFrame with raw camera frames
+        self.detect = detect  # frame -> list of face dicts with "box", "prob", "landmarks"
+        self.render = render  # (display frame, faces) -> None, draws the overlay in place
+        self.detect_every = max(1, detect_every)
+        self.tracker = FaceTracker()
+        self.output = LatestFrame()
+        self.stats = StageStats()
+        self.detection_stats = StageStats()
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        version = 0
+        frame_index = 0
+        while self.running:
+            version, frame = self.source.wait_newer(version)
+            if frame is None:
+                continue
+            started = time.perf_counter()
+
+            if frame_index % self.detect_every == 0:
+                detection_started = time.perf_counter()
+                faces = self.tracker.update(self.detect(frame))
+                self.detection_stats.tick(time.perf_counter() - detection_started)
+            else:
+                faces = self.tracker.predict(self.detect_every)
+            frame_index += 1
+
+            display_frame = frame.copy()
+            self.render(display_frame, faces)
+            self.output.publish({
+                "frame": frame,
+                "display_frame": display_frame,
+                "faces": faces,
+                "timestamp": time.time(),
+            })
+            self.stats.tick(time.perf_counter() - started)
+
+
+class EdgePipeline:
+    """Capture -> detection/tracking -> latest processed snapshot for the web app"""
+
+    def __init__(self, detect, render, camera_source=0, detect_every=3):
+        self.capture = CaptureStage(camera_source)
+        self.detection = DetectionStage(self.capture.output, detect, render, detect_every)
+
+    @property
+    def running(self):
+        return self.capture.running
+
+    def start(self):
+        self.capture.start()
+        # The detection thread outlives a camera failure, it just waits for new frames
+        if not self.detection.running:
+            self.detection.start()
+
+    def stop(self):
+        self.capture.stop()
+        self.detection.stop()
+
+    def latest(self):
+        """Latest processed snapshot dict, None before the first frame"""
+        return self.detection.output.get()[1]
+
+    def stats(self):
+        return {
+            "capture": self.capture.stats.snapshot(),
+            "processing": self.detection.stats.snapshot(),
+            "detection": self.detection.detection_stats.snapshot(),
+        }
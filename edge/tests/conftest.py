@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The edge modules import each other by name, like when web_app.py runs from edge/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
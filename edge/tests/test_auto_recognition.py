@@ -0,0 +1,46 @@
+from auto_recognition import AutoRecognizer
+from pipeline import LatestFrame
+
+
+def _snapshot(hits=3):
+    face = {"track_id": 1, "box": (10, 10, 80, 80), "prob": 0.99, "hits": hits, "predicted": False}
+    return {"frame": object(), "faces": [face]}
+
+
+def test_failed_result_is_retried():
+    calls = []
+    recognizer = AutoRecognizer(LatestFrame(), lambda frame, face, callback: calls.append(callback), retry_after=0)
+    recognizer._observe(_snapshot())
+    assert len(calls) == 1
+    recognizer._observe(_snapshot())
+    assert len(calls) == 1  # pending, not sent twice
+
+    calls[0](None, retry=True)  # e.g. UNAVAILABLE
+    recognizer._observe(_snapshot())
+    assert len(calls) == 2
+
+    calls[1]({"name": "Ada", "similarity": 0.9})
+    recognizer._observe(_snapshot())
+    assert len(calls) == 2
+    assert recognizer.results.get()[1][0]["result"]["name"] == "Ada"
+
+
+def test_failed_result_waits_retry_after():
+    calls = []
+    recognizer = AutoRecognizer(LatestFrame(), lambda frame, face, callback: calls.append(callback), retry_after=60)
+    recognizer._observe(_snapshot())
+    calls[0](None, retry=True)
+    recognizer._observe(_snapshot())
+    assert len(calls) == 1
+    assert recognizer.results.get()[1] is None
+
+
+def test_no_match_is_final():
+    calls = []
+    recognizer = AutoRecognizer(LatestFrame(), lambda frame, face, callback: calls.append(callback), retry_after=0)
+    recognizer._observe(_snapshot())
+    calls[0](None)  # NOT_FOUND, an unknown passenger
+    for _ in range(3):
+        recognizer._observe(_snapshot())
+    assert len(calls) == 1
+    assert recognizer.results.get()[1] == [{"track_id": 1, "face_location": (10, 10, 80, 80), "result": None}]
@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+
+from pipeline import FaceTracker, LatestFrame
+
+STEPS = 3  # frames per detection pass, like DETECT_EVERY_N_FRAMES=3
+SPEED = 6  # pixels per frame
+
+
+def _face(frame):
+    x = 100 + SPEED * frame
+    return {"box": (x, 50, 80, 80), "prob": 0.99, "landmarks": np.array([[x + 20.0, 80.0], [x + 60.0, 80.0]])}
+
+
+def test_constant_motion_is_predicted_between_detections():
+    tracker = FaceTracker()
+    for frame in range(0, 10 * STEPS):
+        if frame % STEPS == 0:
+            faces = tracker.update([_face(frame)])
+            if frame >= 2 * STEPS:
+                assert tracker.tracks[0]["velocity"] == (SPEED * STEPS, 0)
+        else:
+            faces = tracker.predict(STEPS)
+        if frame >= STEPS:
+            # Once the velocity is known, the predicted frames follow the face exactly
+            assert faces[0]["box"] == _face(frame)["box"]
+            np.testing.assert_allclose(faces[0]["landmarks"], _face(frame)["landmarks"])
+    assert len(tracker.tracks) == 1 and tracker.tracks[0]["hits"] == 10
+
+
+def test_velocity_over_a_missed_pass():
+    tracker = FaceTracker()
+    tracker.update([_face(0)])
+    tracker.predict(STEPS)
+    tracker.predict(STEPS)
+    tracker.update([_face(STEPS)])
+    for _ in range(STEPS - 1):
+        tracker.predict(STEPS)
+    tracker.update([])  # missed pass, the track keeps moving
+    for _ in range(STEPS - 1):
+        tracker.predict(STEPS)
+    tracker.update([_face(3 * STEPS)])
+    assert tracker.tracks[0]["velocity"] == (SPEED * STEPS, 0)
+
+
+def test_concurrent_publishers_get_distinct_versions():
+    latest = LatestFrame()
+    threads = [threading.Thread(target=lambda: [latest.publish(i) for i in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert latest.get()[0] == 4000
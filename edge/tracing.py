@@ -0,0 +1,152 @@
+"""
+Request tracing on the edge, the first half of a trace that continues in the backend.
+
+@traced starts a trace for a TRACE_SAMPLE_RATE share of the UI requests. Stages inside it are timed
+with `with span("encode"):`, and every unary gRPC call made while it runs becomes an rpc span and
+carries the W3C `traceparent` header, so the backend adds its spans (decode, detection, embedding,
+SQL statements) under it.
+
+Finished spans are written as JSON lines to TRACE_FILE by a background thread, in the same format
+as backend/tracing.py. `python backend/trace_report.py edge/traces.jsonl backend/traces.jsonl`
+summarizes them.
+"""
+import collections
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import grpc
+from dotenv import load_dotenv
+
+load_dotenv()
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.0))  # share of UI requests traced, 0 disables tracing
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+SERVICE = "edge"
+
+# (trace id, span id) of the innermost open span of this thread, None when not traced
+_current = contextvars.ContextVar("trace_span", default=None)
+
+Span = collections.namedtuple("Span", "trace_id span_id")
+
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class _Writer:
+    """Appends finished spans to TRACE_FILE on a background thread, drops spans if it falls behind"""
+
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                records = [self._queue.get()]
+                while not self._queue.empty() and len(records) < 1000:
+                    records.append(self._queue.get_nowait())
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+                f.flush()
+
+
+_writer = _Writer(TRACE_FILE)
+
+
+def record(name, start, duration, parent=None, span_id=None, **attrs):
+    """Writes a finished span that started at `start` (epoch seconds) as a child of parent (default: current)"""
+    parent = parent or _current.get()
+    if parent is None:
+        return
+    _writer.write({
+        "trace_id": parent.trace_id, "span_id": span_id or _new_id(64), "parent_id": parent.span_id,
+        "name": name, "service": SERVICE, "start": start, "duration_ms": duration * 1000.0, "attrs": attrs,
+    })
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the with block as a child span of the current span, does nothing when not traced"""
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    child = Span(parent.trace_id, _new_id(64))
+    token = _current.set(child)
+    start, started = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        record(name, start, time.perf_counter() - started, parent, child.span_id, **attrs)
+
+
+def traced(name):
+    """Decorator that traces a sampled share of the calls of a (Flask view) function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if TRACE_SAMPLE_RATE <= 0 or _current.get() is not None or random.random() >= TRACE_SAMPLE_RATE:
+                return func(*args, **kwargs)
+            token = _current.set(Span(_new_id(128), None))
+            try:
+                with span(name):
+                    return func(*args, **kwargs)
+            finally:
+                _current.reset(token)
+        return wrapper
+    return decorator
+
+
+class _ClientCallDetails(collections.namedtuple(
+        "_ClientCallDetails", "method timeout metadata credentials wait_for_ready compression"),
+        grpc.ClientCallDetails):
+    pass
+
+
+class TracingInterceptor(grpc.UnaryUnaryClientInterceptor):
+    """Adds the traceparent of the current span to unary calls and records an rpc span per call"""
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        parent = _current.get()
+        if parent is None:
+            return continuation(client_call_details, request)
+
+        span_id = _new_id(64)
+        metadata = list(client_call_details.metadata or [])
+        metadata.append(("traceparent", f"00-{parent.trace_id}-{span_id}-01"))
+        details = _ClientCallDetails(client_call_details.method, client_call_details.timeout, metadata,
+                                     client_call_details.credentials, client_call_details.wait_for_ready,
+                                     client_call_details.compression)
+        method = client_call_details.method.rsplit("/", 1)[-1]
+        start, started = time.time(), time.perf_counter()
+        call = continuation(details, request)
+
+        # Recorded when the call finishes, also for non-blocking calls (.future())
+        def on_done(future):
+            code = future.code()
+            record("rpc", start, time.perf_counter() - started, parent, span_id, method=method,
+                   code=code.name if code is not None else None)
+
+        call.add_done_callback(on_done)
+        return call
@@ -1,5 +1,16 @@
 import cv2
 import base64
+import numpy as np
+
+# ArcFace 5-point landmark template for a 112x112 crop (left eye, right eye, nose, left and right mouth corner),
+# the same template InsightFace uses on the backend
+ARCFACE_TEMPLATE = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041]
+], dtype=np.float32)
 
 
 def image_to_base64(image):
@@ -7,3 +18,22 @@ def image_to_base64(image):
     _, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
     base64_str = base64.b64encode(buffer).decode('utf-8')
     return base64_str
+
+
+def image_to_jpeg_bytes(image, quality=95):
+    """Encode an image as JPEG bytes, for the v2 (bytes) gRPC messages."""
+    _, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes()
+
+
+def align_face(image, landmarks, size=112):
+    """
+    Crop and align a face with its 5 MTCNN landmarks to the ArcFace template, so the backend can skip
+    detection and only run the recognition model. Returns None if the landmarks are unusable.
+    """
+    src = np.asarray(landmarks, dtype=np.float32).reshape(5, 2)
+    dst = ARCFACE_TEMPLATE * (size / 112.0)
+    matrix, _ = cv2.estimateAffinePartial2D(src, dst, method=cv2.LMEDS)
+    if matrix is None:
+        return None
+    return cv2.warpAffine(image, matrix, (size, size), borderValue=0.0)
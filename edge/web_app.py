@@ -1,181 +1,189 @@
 from flask import Flask, render_template, Response, request, jsonify
 import cv2
 import threading
-import time
-import numpy as np
+import json
 import os
 from facenet_pytorch import MTCNN
-from utils import image_to_base64
-from client import send_face, register_new_person, add_embedding_to_person_by_id
+from utils import image_to_base64, align_face
+from client import send_face_v2, send_face_v2_async, register_new_person, add_embedding_to_person_by_id_v2
+from pipeline import EdgePipeline
+from broadcaster import FrameBroadcaster
+from auto_recognition import AutoRecognizer
+from tracing import traced, span
 from dotenv import load_dotenv
 
 load_dotenv()  # Load environment variables from .env file, not implemented yet
 
+# Send 112x112 face crops aligned with the MTCNN landmarks instead of full frames, the backend then skips detection
+SEND_ALIGNED_FACES = os.getenv("SEND_ALIGNED_FACES", "0") == "1"
+
 app = Flask(__name__)
 
 # Global variables
 mtcnn = MTCNN(keep_all=True, device='cpu')
-camera = None
-camera_active = False
-current_frame = None
-processed_frame = None
-last_faces = []
 registration_active = False
 person_id = None
 registration_data = {}
 registration_count = 0
 
-# For thread safety
-frame_lock = threading.Lock()
-
-
-def camera_thread():
-    """Thread for capturing video from the camera"""
-    global camera, camera_active, current_frame, processed_frame, last_faces
+# Serializes registration steps, the camera pipeline never waits for it
+registration_lock = threading.Lock()
 
-    camera = cv2.VideoCapture(0)
-    while camera_active:
-        ret, frame = camera.read()
-        if not ret:
-            print("Couldn't open camera.")
-            break
+# MTCNN runs on every DETECT_EVERY_N_FRAMES-th frame, a box tracker covers the frames in between
+DETECT_EVERY_N_FRAMES = int(os.getenv("DETECT_EVERY_N_FRAMES", 3))
+CAMERA_SOURCE = int(os.getenv("CAMERA_SOURCE", 0))
+MJPEG_MAX_FPS = float(os.getenv("MJPEG_MAX_FPS", 25))  # default per client cap, ?fps= overrides it
+MJPEG_QUALITY = int(os.getenv("MJPEG_QUALITY", 95))
+# Recognize each stable face track once on its own, the button keeps working either way
+AUTO_RECOGNITION = os.getenv("AUTO_RECOGNITION", "0") == "1"
+AUTO_RECOGNITION_MIN_HITS = int(os.getenv("AUTO_RECOGNITION_MIN_HITS", 3))  # detections before a track counts as stable
 
-        with frame_lock:
-            current_frame = frame.copy()
 
-            # Detecting faces
-            faces = detect_faces(current_frame)
-            last_faces = faces
+def render_overlay(display_frame, faces):
+    """Draws the detected faces and the status text on the display frame"""
+    for face in faces:
+        x, y, w, h = face["box"]
+        cv2.rectangle(display_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
 
-            # Prepare the frame for display with detected faces
-            display_frame = current_frame.copy()
-            for face in faces:
-                x, y, w, h = face["box"]
-                cv2.rectangle(display_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-            # Add text to the frame
-            if len(faces) > 0:
-                cv2.putText(display_frame, "FACE FOUND", (10, 30),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
-            else:
-                cv2.putText(display_frame, "Waiting a face...", (10, 30),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 0, 255), 2)
+    # Add text to the frame
+    if len(faces) > 0:
+        cv2.putText(display_frame, "FACE FOUND", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
+    else:
+        cv2.putText(display_frame, "Waiting a face...", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 0, 255), 2)
 
-            # Registeration mode
-            if registration_active:
-                cv2.putText(display_frame, f"Register mode: {registration_count + 1}/5 poses", (10, 60),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.65, (255, 0, 0), 2)
-
-            processed_frame = display_frame
-
-        # wait for a short period to control frame rate
-        time.sleep(0.03)  # ~30 FPS
-
-    if camera:
-        camera.release()
+    # Registeration mode
+    if registration_active:
+        cv2.putText(display_frame, f"Register mode: {registration_count + 1}/5 poses", (10, 60),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.65, (255, 0, 0), 2)
 
 
 def detect_faces(frame, threshold=0.95):
     """Detect faces in the given frame using MTCNN."""
     try:
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        boxes, probs = mtcnn.detect(rgb_frame)
+        boxes, probs, points = mtcnn.detect(rgb_frame, landmarks=True)
         faces = []
         if boxes is not None:
-            for box, prob in zip(boxes, probs):
+            for box, prob, landmarks in zip(boxes, probs, points):
                 if prob is not None and prob > threshold:
                     x1, y1, x2, y2 = [int(b) for b in box]
                     w, h = x2 - x1, y2 - y1
-                    faces.append({"box": (x1, y1, w, h), "prob": prob})
+                    faces.append({"box": (x1, y1, w, h), "prob": prob, "landmarks": landmarks})
         return faces
     except Exception as e:
         print(f"Face detection error: {str(e)}")
         return []
 
 
-def generate_frames():
-    """Generator function to yield frames for video streaming."""
-    global processed_frame
+# Capture thread -> detection/tracking thread -> latest snapshot, read by the routes without locking
+pipeline = EdgePipeline(detect_faces, render_overlay, CAMERA_SOURCE, DETECT_EVERY_N_FRAMES)
+# Encodes each processed frame once for all /video_feed clients
+broadcaster = FrameBroadcaster(pipeline.detection.output, quality=MJPEG_QUALITY)
 
-    while camera_active:
-        if processed_frame is not None:
-            # Make JPG
-            _, buffer = cv2.imencode('.jpg', processed_frame)
-            frame_bytes = buffer.tobytes()
 
-            # Return HTTP multipart response format
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        else:
-            # If no frame is available, yield a black frame
-            black_frame = np.zeros((480, 640, 3), dtype=np.uint8)
-            _, buffer = cv2.imencode('.jpg', black_frame)
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+def backend_image(frame, face):
+    """
+    Returns the image to send to the backend, whether it is a pre-aligned face crop, and for full
+    frames the face box, which lets the backend detect the face at a lower resolution
+    """
+    if SEND_ALIGNED_FACES and face.get("landmarks") is not None:
+        crop = align_face(frame, face["landmarks"])
+        if crop is not None:
+            return crop, True, None
+    return frame, False, face["box"]
 
-        # Refresh rate control
-        time.sleep(0.04)  # ~25 FPS
+
+def recognize_track_async(frame, face, callback):
+    image, aligned, face_box = backend_image(frame, face)
+    send_face_v2_async(image, callback, aligned, face_box)
+
+
+# One backend call per face track instead of one per click
+auto_recognizer = AutoRecognizer(pipeline.detection.output, recognize_track_async, AUTO_RECOGNITION_MIN_HITS)
 
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', auto_recognition=AUTO_RECOGNITION)
 
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(),
+    max_fps = request.args.get("fps", default=MJPEG_MAX_FPS, type=float)
+    return Response(broadcaster.stream(lambda: pipeline.running, max_fps),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
 @app.route('/start_camera', methods=['POST'])
 def start_camera():
-    global camera_active
-
-    if not camera_active:
-        camera_active = True
-        threading.Thread(target=camera_thread, daemon=True).start()
+    if not pipeline.running:
+        pipeline.start()
         return jsonify({"success": True, "message": "Cam started"})
 
     return jsonify({"success": True, "message": "Cam already running"})
 
 
+@app.route('/pipeline_stats')
+def pipeline_stats():
+    """FPS and latency of the capture, processing and detection stages"""
+    stats = pipeline.stats()
+    stats["auto_recognition"] = {"enabled": AUTO_RECOGNITION, "requests_sent": auto_recognizer.requests_sent}
+    stats["video_feed"] = {"subscribers": broadcaster.subscribers, "encoded_frames": broadcaster.encoded_frames}
+    return jsonify(stats)
+
+
+@app.route('/recognition_events')
+def recognition_events():
+    """Server-sent events with the auto recognition results of the tracks currently in view"""
+    def stream():
+        version = 0
+        while True:
+            new_version, results = auto_recognizer.results.wait_newer(version, timeout=15.0)
+            if new_version == version:
+                yield ": keepalive\n\n"
+                continue
+            version = new_version
+            yield f"data: {json.dumps(results)}\n\n"
+
+    return Response(stream(), mimetype='text/event-stream')
+
+
 @app.route('/recognize_face', methods=['POST'])
+@traced("recognize_face")
 def recognize_face():
-    global current_frame, last_faces
+    snapshot = pipeline.latest()
+    if snapshot is None:
+        return jsonify({"success": False, "message": "Cam not ready"})
 
-    with frame_lock:
-        if current_frame is None:
-            return jsonify({"success": False, "message": "Cam not ready"})
+    faces = snapshot["faces"]
+    if not faces:
+        return jsonify({"success": False, "message": "No face detected in the image"})
 
-        if not last_faces:
-            return jsonify({"success": False, "message": "No face detected in the image"})
-
-        try:
-            # Transform the current frame to base64
-            base64_img = image_to_base64(current_frame)
-
-            # Send to backend
-            recognition_result = send_face(base64_img)
-
-            if recognition_result:
-                # Returns the recognition result with additional face location
-                recognition_result["face_location"] = last_faces[0]["box"]
-                return jsonify({
-                    "success": True,
-                    "result": recognition_result
-                })
-            else:
-                return jsonify({
-                    "success": False,
-                    "message": "No face recognized or error in recognition"
-                })
-        except Exception as e:
+    try:
+        # Send to backend as bytes
+        with span("align"):
+            image, aligned, face_box = backend_image(snapshot["frame"], faces[0])
+        recognition_result = send_face_v2(image, aligned, face_box)
+
+        if recognition_result:
+            # Returns the recognition result with additional face location
+            recognition_result["face_location"] = faces[0]["box"]
+            return jsonify({
+                "success": True,
+                "result": recognition_result
+            })
+        else:
             return jsonify({
                 "success": False,
-                "message": f"Error: {str(e)}"
+                "message": "No face recognized or error in recognition"
             })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": f"Error: {str(e)}"
+        })
 
 
 
@@ -205,9 +213,10 @@ def start_registration():
 
 
 @app.route('/capture_registration', methods=['POST'])
+@traced("capture_registration")
 def capture_registration():
     """Captures a registration photo and processes it for embedding"""
-    global current_frame, registration_active, registration_data, registration_count, person_id, last_faces
+    global registration_active, registration_data, registration_count, person_id
 
     if not registration_active:
         return jsonify({
@@ -215,25 +224,28 @@ def capture_registration():
             "message": "Registration is not active, please start registration first"
         })
 
-    with frame_lock:
-        if current_frame is None:
+    with span("lock_wait"):
+        registration_lock.acquire()
+    try:
+        snapshot = pipeline.latest()
+        if snapshot is None:
             return jsonify({
                 "success": False,
                 "message": "Camera not ready"
             })
 
-        if not last_faces:
+        faces = snapshot["faces"]
+        if not faces:
             return jsonify({
                 "success": False,
                 "message": "No face detected in the image"
             })
 
         try:
-            # Transform the current frame to base64
-            base64_img = image_to_base64(current_frame)
-
             if registration_count == 0:
-                # first photo - register new person
+                # first photo - register new person (v1 RPC, takes base64)
+                with span("encode"):
+                    base64_img = image_to_base64(snapshot["frame"])
                 response = register_new_person(
                     base64_img,
                     registration_data["name"],
@@ -269,7 +281,9 @@ def capture_registration():
                         "message": "Person ID not found, please start registration again"
                     })
 
-                response = add_embedding_to_person_by_id(base64_img, person_id)
+                with span("align"):
+                    image, aligned, face_box = backend_image(snapshot["frame"], faces[0])
+                response = add_embedding_to_person_by_id_v2(image, person_id, aligned, face_box)
 
                 if response.success:
                     registration_count += 1
@@ -304,6 +318,8 @@ def capture_registration():
                 "success": False,
                 "message": f"Error: {str(e)}"
             })
+    finally:
+        registration_lock.release()
 
 
 @app.route('/cancel_registration', methods=['POST'])
@@ -318,6 +334,7 @@ def cancel_registration():
 
 
 @app.route('/submit_complete_registration', methods=['POST'])
+@traced("submit_complete_registration")
 def submit_complete_registration():
     data = request.json
 
@@ -379,9 +396,10 @@ def submit_complete_registration():
 
 
 if __name__ == "__main__":
-    # Start the camera thread
-    camera_active = True
-    threading.Thread(target=camera_thread, daemon=True).start()
+    # Start the camera pipeline
+    pipeline.start()
+    if AUTO_RECOGNITION:
+        auto_recognizer.start()
 
     # Start the Flask web application
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)